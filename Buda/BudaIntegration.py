@@ -6,6 +6,7 @@ from Buda.BudaPersistence import BudaCsvPersistence
 
 from core.BaseIntegration import BaseCryptoIntegration
 from core.configCore import MarketConfig
+from core.RateLimiter import get_rate_limiter
 import core.Constants as constants
 
 from dateutil import tz
@@ -17,6 +18,7 @@ logger = logging.getLogger('FortacrypLogger')
 class BudaIntegration(BaseCryptoIntegration):
     def __init__(self, config: BudaMarketConfig):
         super().__init__(config, BudaCsvPersistence('./'))
+        self.rate_limiter = get_rate_limiter('Buda', getattr(config, 'sleep_time_sec', None))
         self.should_log = True
 
     def _generate_url(self, market_config: MarketConfig) -> str:
@@ -1,8 +1,11 @@
 from dataclasses import dataclass
+from operator import itemgetter
 from typing import List, Union, Dict
 
+import numpy as np
 import pandas as pd
 
+from core.CandleAggregator import CandleAggregator, HOUR
 from core.configCore import BaseConfig, MarketConfig
 
 
@@ -15,8 +18,9 @@ class MarketsId:
 
 
 class BudaMarketConfig(BaseConfig):
-    sleep_time_sec: int = 10  # time intervals betweern calls. Increase to prevent being blocked by ddos policies
-    sleep_time_after_block: int = 60 * 5  # 5 min
+    # time intervals betweern calls, the rate of buda's token bucket. Increase to prevent being blocked by ddos policies
+    sleep_time_sec: int = 10
+    sleep_time_after_block: int = 60 * 5  # 5 min, longest wait of the backoff after a failed request
     # the string must match the pandas offset aliases
     # http://pandas.pydata.org/pandas-docs/stable/user_guide/timeseries.html#offset-aliases
     resample_interval: str = '1H'
@@ -46,6 +50,66 @@ class BudaMarketConfig(BaseConfig):
         return ['sleep_time_sec', 'sleep_time_after_block', 'resample_interval', 'btc', 'eth', 'ltc', 'bch']
 
 
+# columns of the raw trades, as they come in the entries of the buda response
+BUDA_TRADE_DTYPE = np.dtype([('timestamp', 'i8'), ('amount', 'f8'), ('price', 'f8'), ('direction', 'i1')])
+
+
+def parse_raw_entries(entries: list) -> np.ndarray:
+    """
+    Parses the entries of a buda trades response ([timestamp ms, amount, price, direction, ...], with the
+    numbers usually as strings) into typed columns, without creating an object per trade
+    :param entries: the entries list of the json response
+    :return: an array of BUDA_TRADE_DTYPE
+    """
+    trades = np.empty(len(entries), dtype=BUDA_TRADE_DTYPE)
+    if len(entries) == 0:
+        return trades
+
+    # one pass per column, numpy parses the strings straight into the typed arrays
+    trades['timestamp'] = np.array(list(map(itemgetter(0), entries)), dtype=np.int64)
+    trades['amount'] = np.array(list(map(itemgetter(1), entries)), dtype=np.float64)
+    trades['price'] = np.array(list(map(itemgetter(2), entries)), dtype=np.float64)
+    # 0 for buy, 1 for sell
+    trades['direction'] = np.fromiter(map('sell'.__eq__, map(itemgetter(3), entries)), np.int8, len(entries))
+    return trades
+
+
+def resample_hourly(trades: np.ndarray) -> pd.DataFrame:
+    """
+    Resamples the trades into hourly ohlcv candles, with the same output than
+    DataFrame.resample('1H').ohlc().fillna(method='ffill') plus the sum of the amounts as volume: the candles
+    start at the hour, and the hours without trades repeat the previous candle with 0 volume
+    :param trades: array of BUDA_TRADE_DTYPE, in any order
+    :return: the ohlcv dataframe indexed by date
+    """
+    if len(trades) == 0:
+        return pd.DataFrame(columns=['open', 'high', 'low', 'close', 'volume'],
+                            index=pd.DatetimeIndex([], name='date'), dtype=np.float64)
+
+    aggregator = CandleAggregator((HOUR,))
+    aggregator.add_batch(trades['timestamp'] / 1000, trades['price'], trades['amount'])
+    aggregator.flush()
+    candles = aggregator.pop_closed()
+
+    # the hours without trades take the candle of the last hour with trades
+    slots = ((candles['date'] - candles['date'][0]) // HOUR).astype(np.intp)
+    size = int(slots[-1]) + 1
+    candle = np.full(size, -1, dtype=np.intp)
+    candle[slots] = np.arange(len(candles))
+    candle = np.maximum.accumulate(candle)
+
+    volume = np.zeros(size)
+    volume[slots] = candles['volume']
+
+    return pd.DataFrame({
+        'open': candles['open'][candle],
+        'high': candles['high'][candle],
+        'low': candles['low'][candle],
+        'close': candles['close'][candle],
+        'volume': volume
+    }, index=pd.date_range(pd.Timestamp(int(candles['date'][0]), unit='s'), periods=size, freq='H', name='date'))
+
+
 class BudaMarketTradeEntry:
     _TIMESAMP_INDEX: int = 0
     _AMOUNT_INDEX: int = 1
@@ -102,15 +166,23 @@ class BudaMarketTradeEntry:
 #   trade_list.merge(trade_list_ext)
 #
 class BudaMarketTradeList:
+    """
+    Until resampled, trade_list holds the raw trades as typed columns (an array of BUDA_TRADE_DTYPE). After
+    resample_ohlcv it is the hourly ohlcv dataframe
+    """
+
     def __init__(self, existing_entries: Union[List[BudaMarketTradeEntry], pd.DataFrame] = None,
                  filter_timestamp: int = None):
 
-        self.trade_list: Union[List[BudaMarketTradeEntry], pd.DataFrame] = []
+        self.trade_list: Union[np.ndarray, pd.DataFrame] = np.empty(0, dtype=BUDA_TRADE_DTYPE)
         self.filter_timestamp: int = filter_timestamp
 
         if existing_entries is not None:
-            if isinstance(existing_entries, (list, pd.DataFrame)):
+            if isinstance(existing_entries, pd.DataFrame):
                 self.trade_list = existing_entries
+            elif isinstance(existing_entries, list):
+                self.trade_list = parse_raw_entries([[entry.timestamp, entry.amount, entry.price, entry.direction]
+                                                     for entry in existing_entries])
             else:
                 raise AssertionError("The existing values must be a list or Dataframe type")
 
@@ -118,26 +190,13 @@ class BudaMarketTradeList:
         if self.is_resampled():
             raise AssertionError("Assertion Error: this instance must not be resampled to be able to append raw data.")
 
-        for entry in new_entries:
-            self.trade_list.append(BudaMarketTradeEntry(entry))
-
+        self.trade_list = np.concatenate((self.trade_list, parse_raw_entries(new_entries)))
         return self.trade_list
 
     def resample_ohlcv(self) -> pd.DataFrame:
-        self.trade_list = pd.DataFrame([entry.to_dict() for entry in self.trade_list]).set_index('timestamp')
-        # parses the index from timestamp in seconds to a format understandable for pandas
-        self.trade_list.set_index(self.trade_list.index.values.astype('M8[ms]'), inplace=True)
-        # self.trade_list.set_index(pd.to_datetime(self.trade_list.index, unit='ms').
-        #                           tz_localize('Etc/GMT-4'),
-        #                           inplace=True)
-
         self._filter_by_timestamp()
 
-        ohlcv = self.trade_list['price'].resample('1H').ohlc().fillna(method='ffill')
-        ohlcv['volume'] = self.trade_list['amount'].resample('1H').sum()
-
-        ohlcv.index.name = 'date'
-        self.trade_list = ohlcv
+        self.trade_list = resample_hourly(self.trade_list)
         return self.trade_list
 
     def append_and_resample(self, new_entries: list) -> pd.DataFrame:
@@ -164,8 +223,8 @@ class BudaMarketTradeList:
         return self.trade_list
 
     def _filter_by_timestamp(self) -> None:
-        if self.filter_timestamp is not None and isinstance(self.trade_list, pd.DataFrame):
-            self.trade_list = self.trade_list[self.trade_list.timestamp > self.filter_timestamp]
+        if self.filter_timestamp is not None and not self.is_resampled():
+            self.trade_list = self.trade_list[self.trade_list['timestamp'] > self.filter_timestamp]
 
     def is_resampled(self) -> bool:
         return isinstance(self.trade_list, pd.DataFrame)
@@ -1,7 +1,11 @@
-import pandas as pd
 import os
+from collections import deque
+from typing import Deque
+
+import pandas as pd
 
 from Buda.BudaIntegrationConfig import BudaMarketTradeList
+from config import BaseConfig
 
 
 class BudaPersistenceBase:
@@ -18,9 +22,21 @@ class BudaPersistenceBase:
 
 
 class BudaCsvPersistence(BudaPersistenceBase):
+    """
+    Stores the hourly ohlc of the trades in a csv file per market. The csv is read only once, and the
+    resampled data is kept in memory as a list of chunks in chronological order. Each new page is merged only
+    with the candle at the edge of the chunk it touches, so persisting a page doesnt depend on the size of
+    the history. The csv is written every flush_every pages, and when flush is called at the end of a recovery.
+    Meanwhile is_flushed is False, so the integration doesnt save the timestamps of the pages in the config
+    """
+
     # path should point to a folder
-    def __init__(self, path: str):
+    def __init__(self, path: str, flush_every: int = BaseConfig.Exchanges.Buda.flush_every_pages):
         self.path = path
+        self.flush_every: int = flush_every
+        self._chunks: Deque[pd.DataFrame] = deque()
+        self._is_loaded: bool = False
+        self._pending_pages: int = 0
 
         if os.path.isfile(path):
             self.path = os.path.dirname(path)
@@ -28,6 +44,14 @@ class BudaCsvPersistence(BudaPersistenceBase):
         if not self.path.endswith('/'):
             self.path = self.path + '/'
 
+    def set_market(self, market):
+        if market != self.market:
+            self.flush()
+            self._chunks = deque()
+            self._is_loaded = False
+
+        super().set_market(market)
+
     def persist(self, market_list: BudaMarketTradeList) -> None:
         """
         Makes sure the trades are merged with the stored ohcl data before calling the persistor
@@ -35,16 +59,91 @@ class BudaCsvPersistence(BudaPersistenceBase):
         if self.market is None:
             raise AttributeError('market attribute of the instance should not be None')
 
-        path = os.path.join(self.path, 'Buda_' + self.market + '.csv')
+        if not self._is_loaded:
+            self._load()
+
         if not market_list.is_resampled():
+            if len(market_list.trade_list) == 0:
+                return
+
             market_list.resample_ohlcv()
 
-        if os.path.isfile(path):
-            stored = pd.read_csv(path, sep=',', encoding='utf-8', parse_dates=True, index_col='date')
+        self._merge_page(market_list.trade_list)
+        self._pending_pages += 1
+
+        if self._pending_pages >= self.flush_every:
+            self.flush()
 
-            stored_market_list = BudaMarketTradeList()
-            stored_market_list.trade_list = stored
+    def flush(self) -> None:
+        """
+        Writes the whole ohlc to the csv, if some page has been persisted since the last time
+        """
+        if self.market is None or self._pending_pages == 0:
+            return
 
-            market_list.merge(stored_market_list)
+        ohlc = pd.concat(list(self._chunks))
+        ohlc.to_csv(self._get_save_path(), encoding='utf-8')
+        self._chunks = deque([ohlc])
+        self._pending_pages = 0
 
-        market_list.trade_list.to_csv(path, encoding='utf-8')
+    def is_flushed(self) -> bool:
+        """
+        True if every page persisted is written to the csv
+        """
+        return self._pending_pages == 0
+
+    def _merge_page(self, page: pd.DataFrame) -> None:
+        if len(self._chunks) == 0:
+            self._chunks.append(page)
+
+        elif page.index[-1] <= self._chunks[0].index[0]:
+            # older page, usually while recovering the history backwards
+            first = self._chunks.popleft()
+            self._push_chunk(first.iloc[1:], left=True)
+            self._chunks.appendleft(_merge_ohlc(page, first.iloc[:1]))
+
+        elif page.index[0] >= self._chunks[-1].index[-1]:
+            # newer page, while updating
+            last = self._chunks.pop()
+            self._push_chunk(last.iloc[:-1], left=False)
+            self._chunks.append(_merge_ohlc(last.iloc[-1:], page))
+
+        else:
+            # the page overlaps the stored data, there is no other way than merging everything
+            self._chunks = deque([_merge_ohlc(pd.concat(list(self._chunks)), page)])
+
+    def _push_chunk(self, chunk: pd.DataFrame, left: bool) -> None:
+        if len(chunk) == 0:
+            return
+
+        if left:
+            self._chunks.appendleft(chunk)
+        else:
+            self._chunks.append(chunk)
+
+    def _load(self) -> None:
+        path = self._get_save_path()
+        if os.path.isfile(path):
+            stored = pd.read_csv(path, sep=',', encoding='utf-8', parse_dates=True, index_col='date')
+            if len(stored) > 0:
+                self._chunks.append(stored)
+
+        self._is_loaded = True
+
+    def _get_save_path(self) -> str:
+        return os.path.join(self.path, 'Buda_' + self.market + '.csv')
+
+
+def _merge_ohlc(older: pd.DataFrame, newer: pd.DataFrame) -> pd.DataFrame:
+    """
+    Merges two hourly ohlc dataframes, in the same way BudaMarketTradeList.merge does, but assuming the
+    candles of older are previous to the candles of newer (they can share the hour at the edge)
+    """
+    merged = pd.concat([older, newer])
+    return merged.resample('1H').agg({
+        'open': 'first',
+        'high': 'max',
+        'low': 'min',
+        'close': 'last',
+        'volume': 'sum'
+    }).fillna(method='ffill')
@@ -1,10 +1,14 @@
 from unittest import TestCase, mock
 import numpy as np
+import pandas as pd
 import json
+import os
+import tempfile
 import urllib.parse as urlparse
 
 from Buda.BudaIntegration import BudaIntegration
-from Buda.BudaIntegrationConfig import BudaMarketTradeList, BudaMarketConfig
+from Buda.BudaIntegrationConfig import BudaMarketTradeList, BudaMarketConfig, parse_raw_entries, resample_hourly
+from Buda.BudaPersistence import BudaCsvPersistence
 from core.configCore import MarketConfig
 
 
@@ -95,6 +99,132 @@ class BudaMarketTradeListTest(TestCase):
         self.assertTrue(tl1.trade_list.equals(tl_copy1.trade_list))
 
 
+def pandas_resample(entries: list) -> pd.DataFrame:
+    # the resampling done with pandas before resample_hourly, used as reference
+    df = pd.DataFrame([{'timestamp': int(entry[0]), 'amount': float(entry[1]), 'price': float(entry[2])}
+                       for entry in entries]).set_index('timestamp')
+    df.set_index(df.index.values.astype('M8[ms]'), inplace=True)
+    df.sort_index(inplace=True)
+
+    ohlcv = df['price'].resample('1H').ohlc().fillna(method='ffill')
+    ohlcv['volume'] = df['amount'].resample('1H').sum()
+    ohlcv.index.name = 'date'
+    return ohlcv
+
+
+class ResampleHourlyTests(TestCase):
+    def setUp(self):
+        self.li = get_entries_list()
+
+    def assert_same_as_pandas(self, entries: list):
+        expected = pandas_resample(entries)
+        resampled = resample_hourly(parse_raw_entries(entries))
+
+        self.assertTrue(np.array_equal(expected.index.values, resampled.index.values))
+        for column in ['open', 'high', 'low', 'close', 'volume']:
+            self.assertTrue(np.allclose(expected[column].to_numpy(), resampled[column].to_numpy()), column)
+
+    def test_parse_string_entries(self):
+        # buda sends the numbers as strings
+        entries = [[str(entry[0]), str(entry[1]), str(entry[2]), entry[3]] for entry in self.li]
+        entries[0][3] = 'sell'
+        trades = parse_raw_entries(entries)
+
+        self.assertEqual(trades['timestamp'][0], 1552966701233)
+        self.assertEqual(trades['amount'][1], 2)
+        self.assertAlmostEqual(trades['price'][2], 0.3)
+        self.assertEqual(list(trades['direction'][:2]), [1, 0])
+
+    def test_same_as_pandas(self):
+        self.assert_same_as_pandas(self.li)
+
+    def test_string_entries_same_as_pandas(self):
+        self.assert_same_as_pandas([[str(entry[0]), str(entry[1]), str(entry[2]), entry[3]] for entry in self.li])
+
+    def test_unsorted_entries_same_as_pandas(self):
+        # the pages of buda come newest first
+        self.assert_same_as_pandas(list(reversed(self.li)))
+        self.assert_same_as_pandas(self.li[7:] + self.li[:7])
+
+    def test_gaps_are_forward_filled(self):
+        resampled = resample_hourly(parse_raw_entries(self.li))
+        # there are no trades at 06:00, it repeats the candle of 05:00 with no volume
+        empty_hour = resampled.loc[pd.Timestamp('2019-03-19 06:00')]
+        previous_hour = resampled.loc[pd.Timestamp('2019-03-19 05:00')]
+
+        self.assertEqual(empty_hour['volume'], 0)
+        for column in ['open', 'high', 'low', 'close']:
+            self.assertEqual(empty_hour[column], previous_hour[column])
+
+    def test_empty_entries(self):
+        resampled = resample_hourly(parse_raw_entries([]))
+        self.assertEqual(len(resampled), 0)
+        self.assertEqual(list(resampled.columns), ['open', 'high', 'low', 'close', 'volume'])
+
+    def test_filter_timestamp(self):
+        # only the trades after the filter are resampled, the filter itself is excluded
+        trade_list = BudaMarketTradeList(filter_timestamp=self.li[6][0])
+        trade_list.append_and_resample(self.li)
+
+        self.assertTrue(trade_list.trade_list.equals(resample_hourly(parse_raw_entries(self.li[7:]))))
+        self.assertEqual(trade_list.trade_list.index[0], pd.Timestamp('2019-03-19 09:00'))
+        self.assertEqual(trade_list.trade_list['volume'].iloc[0], 17)
+
+
+class BudaCsvPersistenceTests(TestCase):
+    def setUp(self):
+        self.li = get_entries_list()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'Buda_btc.csv')
+        self.expected = BudaMarketTradeList().append_and_resample(self.li)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def persist_pages(self, persistor: BudaCsvPersistence, pages: list):
+        persistor.set_market('btc')
+        for page in pages:
+            trade_list = BudaMarketTradeList()
+            trade_list.append_raw(page)
+            persistor.persist(trade_list)
+
+    def read_stored(self) -> pd.DataFrame:
+        return pd.read_csv(self.path, parse_dates=True, index_col='date')
+
+    def test_backwards_pages_match_resampling_everything(self):
+        persistor = BudaCsvPersistence(self.tmp_dir.name)
+        # the same page order of a recovery: from the newest trades to the oldest
+        self.persist_pages(persistor, [self.li[10:], self.li[7:10], self.li[:7]])
+        self.assertFalse(os.path.isfile(self.path))
+
+        persistor.flush()
+        stored = self.read_stored()
+        self.assertTrue(np.allclose(self.expected.to_numpy(), stored.to_numpy()))
+        self.assertTrue((self.expected.index == stored.index).all())
+
+    def test_newer_pages_append_to_stored_csv(self):
+        persistor = BudaCsvPersistence(self.tmp_dir.name)
+        self.persist_pages(persistor, [self.li[:8]])
+        persistor.flush()
+
+        # a new instance, as a later update would do
+        persistor = BudaCsvPersistence(self.tmp_dir.name)
+        self.persist_pages(persistor, [self.li[8:]])
+        persistor.flush()
+
+        self.assertTrue(np.allclose(self.expected.to_numpy(), self.read_stored().to_numpy()))
+
+    def test_flush_every_pages(self):
+        persistor = BudaCsvPersistence(self.tmp_dir.name, flush_every=2)
+        self.persist_pages(persistor, [self.li[10:]])
+        self.assertFalse(os.path.isfile(self.path))
+        self.assertFalse(persistor.is_flushed())
+
+        self.persist_pages(persistor, [self.li[:10]])
+        self.assertEqual(len(self.expected), len(self.read_stored()))
+        self.assertTrue(persistor.is_flushed())
+
+
 class MockResponse:
     def __init__(self, json_data: dict, status_code):
         self.text = json.dumps(json_data)
@@ -123,8 +253,9 @@ class BudaIntegrationTests(TestCase):
         # date utils gettz works as expected when used from cli, but fails when unittesting on
         # ubuntu (in windows works well) maybe it is related to mocking open() function (?)
         buda.should_log = False
+        buda.rate_limiter = None
 
-        with mock.patch('core.BaseIntegration.requests.get', side_effect=self.mock_request_get):
+        with mock.patch.object(buda.requests, 'get', side_effect=self.mock_request_get):
             buda.recover_btc()
 
         self.assertGreaterEqual(self.request_call_count, 3)
@@ -136,15 +267,46 @@ class BudaIntegrationTests(TestCase):
 
         buda = BudaIntegration(configuration)
         buda.should_log = False
+        buda.rate_limiter = None
 
-        with mock.patch('core.BaseIntegration.requests.get', side_effect=self.mock_request_get):
+        with mock.patch.object(buda.requests, 'get', side_effect=self.mock_request_get):
             self.should_block = True
             buda.recover_btc()
 
-        self.assertEqual(args[0].call_count, 3)
+        # without rate limiter, the only wait is the backoff after being blocked
+        self.assertEqual(args[0].call_count, 1)
         self.assertEqual(self.request_call_count, 3)
         self.assertTrue(self.market_config.recovered_all)
 
+    def test_config_saved_only_when_the_csv_is_written(self, *args):
+        configuration = BudaMarketConfig()
+        configuration.btc = self.market_config
+
+        buda = BudaIntegration(configuration)
+        buda.should_log = False
+        buda.rate_limiter = None
+        buda.persistor = mock.Mock()
+        # the second of the 3 pages fills the pages kept in memory, so the csv is written
+        buda.persistor.is_flushed.side_effect = [False, True, False]
+
+        with mock.patch.object(configuration, 'persist') as persist, \
+                mock.patch.object(buda.requests, 'get', side_effect=self.mock_request_get):
+            buda.recover_btc()
+
+        # after the second page, and at the end once the persistor is flushed
+        self.assertEqual(2, persist.call_count)
+        buda.persistor.flush.assert_called_once()
+
+    def test_rate_limit_from_config(self, *args):
+        configuration = BudaMarketConfig()
+        configuration.sleep_time_sec = 15
+        configuration.sleep_time_after_block = 120
+
+        buda = BudaIntegration(configuration)
+        self.assertAlmostEqual(1 / 15, buda.rate_limiter.rate)
+        self.assertEqual(1, buda.rate_limiter.capacity)
+        self.assertEqual(120, buda.backoff.max_sec)
+
     def test_ending_after_last_stored_is_less_than_config(self, *args):
         configuration = BudaMarketConfig()
         self.market_config.last_stored_timestamp = get_entries_list()[10][0]
@@ -153,8 +315,9 @@ class BudaIntegrationTests(TestCase):
         configuration.btc = self.market_config
         buda = BudaIntegration(configuration)
         buda.should_log = False
+        buda.rate_limiter = None
 
-        with mock.patch('core.BaseIntegration.requests.get', side_effect=self.mock_request_get):
+        with mock.patch.object(buda.requests, 'get', side_effect=self.mock_request_get):
             self.should_block = True
             buda.recover_btc()
 
@@ -3,12 +3,10 @@ import sys
 import os
 import logging
 
-from Buda.BudaIntegration import BudaIntegration
-from core.BaseIntegration import IntegrationMarkets
-from core.config import config
-from core.orm.createTables import create_tables
-from cryptoCompare.CryptoCompareIntegration import CryptoCompareIntegration
-from krakenWebSocket.KrakenIntegration import KrakenIntegration, KrakenHistoricalDataIntegration
+from config import BaseConfig
+
+# the integrations are imported inside each handler, so a command only pays the import of what it uses
+# (e.g. the csv commands dont load SQLAlchemy nor create the database engine)
 
 logging.basicConfig(format='%(asctime)s:%(funcName)s:%(lineno)d - %(levelname)s: %(message)s')
 logger = logging.getLogger('FortacrypLogger')
@@ -25,10 +23,15 @@ if chat_id is None:
 
 
 def handle_crypto_compare(parsed_args):
+    from core.config import config
+    from cryptoCompare.CryptoCompareIntegration import CryptoCompareIntegration
+
     config_dict = config
     crypto_compare = CryptoCompareIntegration(config_dict.crypto_compare)
 
-    if parsed_args.market == 'btc':
+    if parsed_args.backfill:
+        crypto_compare.backfill(parsed_args.market, workers=parsed_args.workers)
+    elif parsed_args.market == 'btc':
         crypto_compare.recover_btc()
     elif parsed_args.market == 'ltc':
         crypto_compare.recover_ltc()
@@ -41,6 +44,9 @@ def handle_crypto_compare(parsed_args):
 
 
 def handle_buda(parsed_args):
+    from core.config import config
+    from Buda.BudaIntegration import BudaIntegration
+
     config_dict = config
     buda = BudaIntegration(config_dict.buda)
 
@@ -57,22 +63,59 @@ def handle_buda(parsed_args):
 
 
 def handle_kraken_websocket(parsed_args):
+    from core.BaseIntegration import IntegrationMarkets, recover_concurrently
+    from krakenWebSocket.KrakenIntegration import KrakenHistoricalDataIntegration
+    from krakenWebSocket.KrakenPersistors import KrakenPersistor
+
     # kraken = KrakenIntegration(config_dict.crypto_compare)
     # kraken.subscribe()
-    kraken = KrakenHistoricalDataIntegration()
-    kraken.recover(IntegrationMarkets.BTC)
+    if parsed_args.market == 'all':
+        # one integration (and csv persistor) per market, all of them sharing kraken's rate limit
+        recover_concurrently(lambda market: KrakenHistoricalDataIntegration(KrakenPersistor(market.value)))
+    else:
+        market = IntegrationMarkets(parsed_args.market)
+        kraken = KrakenHistoricalDataIntegration(KrakenPersistor(market.value))
+        kraken.recover(market)
 
 
 def handle_create_tables(parsed_args):
+    from core.orm.createTables import create_tables
+
     create_tables()
 
 
+def handle_migrate(parsed_args):
+    from core.orm.createTables import create_indexes
+
+    created, failed = create_indexes(dedupe=parsed_args.dedupe)
+    if len(failed) > 0:
+        logger.error('Could not create the indexes {}. Run migrate --dedupe to remove the duplicated rows'
+                     .format(', '.join(failed)))
+        sys.exit(1)
+
+    if len(created) == 0:
+        logger.info('Database is already up to date')
+
+
+def handle_to_parquet(parsed_args):
+    from core.Enums import Mnemonic
+    from core.ParquetPersistor import ParquetPersistor, convert_csv
+
+    persistor = ParquetPersistor(parsed_args.exchange, parsed_args.path)
+    frames = convert_csv(parsed_args.csv, persistor, Mnemonic(parsed_args.market))
+    logger.info('{} frames stored in {}'.format(frames, os.path.join(parsed_args.path, parsed_args.exchange)))
+
+
 def config_crypto_compare_parser(subparser: argparse.ArgumentParser):
     subparser.allow_abbrev = False
     subparser.set_defaults(func=handle_crypto_compare)
-    subparser.usage = 'python %(prog)s cryptoCompare {btc, eth, ltc, eth}'
+    subparser.usage = 'python %(prog)s cryptoCompare {btc, eth, ltc, eth} [--backfill [--workers N]]'
     subparser.description = 'Recovers data from cryptocompare.com and stores it in a csv file'
     subparser.add_argument('market', choices=['btc', 'eth', 'ltc', 'bch'])
+    subparser.add_argument('--backfill', action='store_true',
+                           help='recover all the history requesting many pages at the same time')
+    subparser.add_argument('--workers', type=int, default=BaseConfig.Exchanges.CryptoCompare.backfill_workers,
+                           help='pages requested at the same time by --backfill')
 
 
 def config_buda_exchange_parser(subparser: argparse.ArgumentParser):
@@ -86,8 +129,9 @@ def config_buda_exchange_parser(subparser: argparse.ArgumentParser):
 def config_kraken_socket_parser(subparser: argparse.ArgumentParser):
     subparser.allow_abbrev = False
     subparser.set_defaults(func=handle_kraken_websocket)
-    subparser.usage = 'pyton %(prog)s kraken'
+    subparser.usage = 'pyton %(prog)s kraken [btc, eth, ltc, bch, all]'
     subparser.description = 'Subscribe to kraken websocket and launches the alert system'
+    subparser.add_argument('market', nargs='?', default='btc', choices=['btc', 'eth', 'ltc', 'bch', 'all'])
 
 
 def config_create_tables_parser(subparser: argparse.ArgumentParser):
@@ -97,6 +141,29 @@ def config_create_tables_parser(subparser: argparse.ArgumentParser):
     subparser.description = 'Create the database tables based on the vendor provider configured in config.py'
 
 
+def config_migrate_parser(subparser: argparse.ArgumentParser):
+    subparser.allow_abbrev = False
+    subparser.set_defaults(func=handle_migrate)
+    subparser.usage = 'python %(prog)s migrate [--dedupe]'
+    subparser.description = 'Adds the missing indexes to a database created with a previous version'
+    subparser.add_argument('--dedupe', action='store_true',
+                           help='remove the duplicated ohlc and trades rows, that prevent the unique indexes '
+                                'from being created')
+
+
+def config_to_parquet_parser(subparser: argparse.ArgumentParser):
+    subparser.allow_abbrev = False
+    subparser.set_defaults(func=handle_to_parquet)
+    subparser.usage = 'python %(prog)s to-parquet csv {Buda, CryptoCompare, Kraken} {btc, eth, ltc, bch} [--path]'
+    subparser.description = 'Stores the ohlc of a csv created by the integrations, or of the .ohlc file where ' \
+                            'kraken stores its ohlc, in parquet files partitioned by exchange, market and month. ' \
+                            'Needs pyarrow'
+    subparser.add_argument('csv', help='path of the csv or .ohlc file')
+    subparser.add_argument('exchange', choices=['Buda', 'CryptoCompare', 'Kraken'])
+    subparser.add_argument('market', choices=['btc', 'eth', 'ltc', 'bch'])
+    subparser.add_argument('--path', default=BaseConfig.Parquet.path, help='root folder of the parquet files')
+
+
 parser = argparse.ArgumentParser()
 parser.usage = 'python %(prog)s <command> [market]'
 
@@ -123,6 +190,12 @@ config_kraken_socket_parser(kraken_parser)
 create_table_parser = subparsers.add_parser('create-tables', help='Create the database tables')
 config_create_tables_parser(create_table_parser)
 
+migrate_parser = subparsers.add_parser('migrate', help='Add the missing indexes to an existing database')
+config_migrate_parser(migrate_parser)
+
+to_parquet_parser = subparsers.add_parser('to-parquet', help='Convert a csv of ohlc data to parquet')
+config_to_parquet_parser(to_parquet_parser)
+
 argc = len(sys.argv)
 if argc <= 1:
     parser.print_help()
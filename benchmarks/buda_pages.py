@@ -0,0 +1,49 @@
+"""
+Measures the cost of parsing and resampling a page of buda trades, as BudaIntegration does with each
+response, for pages of different sizes. The entries are generated like the api sends them, with the numbers
+as strings.
+
+python -m benchmarks.buda_pages --sizes 100 100000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from Buda.BudaIntegrationConfig import BudaMarketTradeList
+
+
+def _generate_entries(trades: int) -> list:
+    rng = np.random.RandomState(0)
+    timestamps = 1552966701233 + np.cumsum(rng.randint(1000, 120000, trades))
+    amounts = rng.exponential(0.1, trades)
+    prices = 4000000 + np.cumsum(rng.normal(0, 1000, trades))
+    directions = rng.choice(['buy', 'sell'], trades)
+
+    return [[str(t), '{:.8f}'.format(a), '{:.1f}'.format(p), d, i]
+            for i, (t, a, p, d) in enumerate(zip(timestamps.tolist(), amounts.tolist(), prices.tolist(), directions))]
+
+
+def run(sizes, repeat: int) -> None:
+    for size in sizes:
+        entries = _generate_entries(size)
+        elapsed = []
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            trade_list = BudaMarketTradeList()
+            trade_list.append_raw(entries)
+            trade_list.resample_ohlcv()
+            elapsed.append(time.perf_counter() - start)
+
+        best = min(elapsed)
+        print('{} trades per page: {:.2f} ms per page ({:.2f} us per trade)'.format(size, best * 1000,
+                                                                                best * 1e6 / size))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the parsing of buda trade pages')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 100000])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat)
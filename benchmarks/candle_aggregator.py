@@ -0,0 +1,56 @@
+"""
+Measures the trades per second consumed by core.CandleAggregator, one by one with add (as the websocket does)
+and as columns with add_batch (as the rest recoveries do), building hourly candles alone or 1m, 5m, 1h and 1d
+candles at the same time. The trades arrive slightly out of order, within the grace window.
+
+python -m benchmarks.candle_aggregator --trades 1000000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from core.CandleAggregator import CandleAggregator, MINUTE, HOUR, DAY
+
+_GRACE_SEC = 5
+
+
+def _generate_trades(trades: int) -> (np.ndarray, np.ndarray, np.ndarray):
+    rng = np.random.RandomState(0)
+    epoch = 1546300800 + np.cumsum(rng.exponential(2, trades)) + rng.uniform(-1, 1, trades)
+    price = 4000 + np.cumsum(rng.normal(0, 1, trades))
+    volume = rng.exponential(0.5, trades)
+    return epoch, price, volume
+
+
+def _one_by_one(aggregator: CandleAggregator, epoch: np.ndarray, price: np.ndarray, volume: np.ndarray) -> None:
+    for timestamp, trade_price, trade_volume in zip(epoch.tolist(), price.tolist(), volume.tolist()):
+        aggregator.add(timestamp, trade_price, trade_volume)
+
+
+def _batches(aggregator: CandleAggregator, epoch: np.ndarray, price: np.ndarray, volume: np.ndarray) -> None:
+    for start in range(0, len(epoch), 1000):
+        aggregator.add_batch(epoch[start:start + 1000], price[start:start + 1000], volume[start:start + 1000])
+
+
+def run(trades: int) -> None:
+    epoch, price, volume = _generate_trades(trades)
+
+    for intervals in ((HOUR,), (MINUTE, 5 * MINUTE, HOUR, DAY)):
+        for name, add in (('add', _one_by_one), ('add_batch (1000)', _batches)):
+            aggregator = CandleAggregator(intervals, grace_sec=_GRACE_SEC)
+            start = time.perf_counter()
+            add(aggregator, epoch, price, volume)
+            aggregator.flush()
+            elapsed = time.perf_counter() - start
+
+            candles = sum(len(aggregator.pop_closed(interval)) for interval in intervals)
+            print('{} intervals, {:<18}{:12.0f} trades/s ({} candles)'.format(
+                len(intervals), name, trades / elapsed, candles))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the candle aggregator')
+    parser.add_argument('--trades', type=int, default=1000000)
+    args = parser.parse_args()
+    run(args.trades)
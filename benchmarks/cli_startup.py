@@ -0,0 +1,68 @@
+"""
+Measures the import cost of the CLI commands: the time to import FortacryptCLI plus the modules imported
+by the handler of the command, in a fresh interpreter each time. Also shows whether SQLAlchemy (and with it
+the database engine) is loaded, since only the kraken and the database commands need it.
+
+python -m benchmarks.cli_startup --repeat 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# modules imported by the handler of each command
+_COMMANDS = {
+    'buda': ['core.config', 'Buda.BudaIntegration'],
+    'cryptoCompare': ['core.config', 'cryptoCompare.CryptoCompareIntegration'],
+    'kraken': ['core.BaseIntegration', 'krakenWebSocket.KrakenIntegration', 'krakenWebSocket.KrakenPersistors'],
+}
+
+_SCRIPT = """
+import contextlib, importlib, io, json, sys, time
+start = time.perf_counter()
+sys.argv = ['FortacryptCLI.py']
+with contextlib.redirect_stdout(io.StringIO()):
+    import FortacryptCLI
+for module in {modules}:
+    importlib.import_module(module)
+print(json.dumps({{'elapsed': time.perf_counter() - start, 'sqlalchemy': 'sqlalchemy' in sys.modules}}))
+"""
+
+
+def _measure(modules, repeat: int) -> (float, bool):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    samples = []
+    loads_sqlalchemy = False
+
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-c', _SCRIPT.format(modules=modules)], cwd=root,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise ImportError(process.stderr.decode().strip().splitlines()[-1])
+
+        result = json.loads(process.stdout.decode().strip().splitlines()[-1])
+        samples.append(result['elapsed'])
+        loads_sqlalchemy = result['sqlalchemy']
+
+    return statistics.median(samples), loads_sqlalchemy
+
+
+def run(repeat: int) -> None:
+    for command, modules in _COMMANDS.items():
+        try:
+            elapsed, loads_sqlalchemy = _measure(modules, repeat)
+        except ImportError as e:
+            print('{}: cannot be imported. {}'.format(command, e))
+            continue
+
+        print('{}: {:.0f} ms (median of {}), sqlalchemy loaded: {}'.format(command, elapsed * 1000, repeat,
+                                                                         loads_sqlalchemy))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the startup time of the cli commands')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    run(args.repeat)
@@ -0,0 +1,71 @@
+"""
+Measures the newest ohlc lookup of the kraken persistor, done through the session of the orm, as it was
+written before (python `and` between the predicates, so only the currency was filtered), with both
+predicates, and with the baked query of core.orm.queries. Uses its own sqlite database, with the
+composite index, in a temporary folder.
+
+python -m benchmarks.kraken_lookup --rows 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.ohlc_lookup import _fill_table, _EXCHANGES, _CURRENCIES
+from core.model.models import OHLC
+from core.orm import queries
+from core.orm.orm import Base
+
+
+def _single_predicate(session, exchange_id: int, currency_id: int):
+    return session.query(OHLC) \
+        .filter(OHLC.currency_id == currency_id and OHLC.exchange_id == exchange_id) \
+        .order_by(OHLC.date.desc()).first()
+
+
+def _both_predicates(session, exchange_id: int, currency_id: int):
+    return session.query(OHLC) \
+        .filter(OHLC.exchange_id == exchange_id, OHLC.currency_id == currency_id) \
+        .order_by(OHLC.date.desc()).first()
+
+
+def _measure(session_maker, lookup, repeat: int) -> float:
+    elapsed = 0.0
+    for i in range(repeat):
+        session = session_maker()
+        start = time.perf_counter()
+        lookup(session, i % _EXCHANGES + 1, i % _CURRENCIES + 1)
+        elapsed += time.perf_counter() - start
+        session.close()
+
+    return elapsed * 1000 / repeat
+
+
+def run(rows: int, repeat: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(tmp_dir, 'benchmark.db'))
+        Base.metadata.create_all(engine)
+        session_maker = sessionmaker(bind=engine)
+        _fill_table(engine, rows)
+
+        lookups = (('exchange predicate dropped', _single_predicate),
+                   ('both predicates', _both_predicates),
+                   ('baked query', queries.get_newest_ohlc))
+
+        for name, lookup in lookups:
+            # the first call warms the caches of sqlite and of the baked query
+            _measure(session_maker, lookup, 1)
+            print('{:<28}{:.3f} ms per lookup'.format(name, _measure(session_maker, lookup, repeat)))
+
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the newest ohlc lookup of the kraken persistor')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
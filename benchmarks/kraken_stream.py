@@ -0,0 +1,110 @@
+"""
+Measures the messages per second that the kraken socket handler decodes and turns into tickets: json.loads
+followed by the parser of the trade messages as it was written before (a mapper dict built per message),
+against each json decoder installed (see core.JsonDecoder) followed by _ticket_list_to_dict. Uses a stream
+recorded from the socket, one frame per line, or a generated one with the same shape (trade messages of the
+four pairs and a heartbeat every few messages).
+
+python -m benchmarks.kraken_stream --frames 200000
+python -m benchmarks.kraken_stream --file kraken_frames.txt
+"""
+import argparse
+import json
+import random
+import time
+from typing import List
+
+from core.JsonDecoder import get_decoder
+from krakenWebSocket import KrakenConstants as Constants
+from krakenWebSocket.KrakenIntegration import _ticket_list_to_dict
+
+_PAIRS = {'XBT/USD': 9000.0, 'ETH/USD': 200.0, 'BCH/USD': 250.0, 'LTC/USD': 60.0}
+
+
+def _generate_frames(frames: int) -> List[str]:
+    rng = random.Random(0)
+    timestamp = 1561485600.0
+    stream = []
+
+    for i in range(frames):
+        timestamp += rng.random()
+        if i % 10 == 9:
+            stream.append(json.dumps({'event': 'heartbeat'}))
+            continue
+
+        pair = rng.choice(list(_PAIRS))
+        trades = [['{:.5f}'.format(_PAIRS[pair] * (1 + rng.uniform(-0.001, 0.001))),
+                   '{:.8f}'.format(rng.expovariate(2)), '{:.6f}'.format(timestamp + j / 1000),
+                   rng.choice('bs'), rng.choice('lm'), ''] for j in range(rng.randint(1, 5))]
+        stream.append(json.dumps([0, trades, 'trade', pair]))
+
+    return stream
+
+
+def _legacy_ticket_list_to_dict(socket_trade: list) -> dict:
+    mapper = {
+        'XBT/USD': 'btc',
+        'ETH/USD': 'eth',
+        'BCH/USD': 'bch',
+        'LTC/USD': 'ltc'
+    }
+
+    trade_list = socket_trade[Constants.TRADE_LIST]
+    trade = {
+        'market': mapper[socket_trade[Constants.MARKET_INDEX]],
+        'timestamp': float(trade_list[-1][Constants.TIME_INDEX]),
+        'price': float(trade_list[-1][Constants.PRICE_INDEX])
+    }
+
+    volume = 0
+    for entry in trade_list:
+        volume += float(entry[Constants.VOLUME_INDEX])
+
+    trade['volume'] = volume
+    return trade
+
+
+def _measure(stream: List[str], loads, to_dict, repeat: int = 5) -> float:
+    # the best of the runs, the others are slowed down by whatever else the machine is doing
+    elapsed = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for frame in stream:
+            message = loads(frame)
+            if isinstance(message, list):
+                to_dict(message)
+
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    return len(stream) / elapsed
+
+
+def run(stream: List[str]) -> None:
+    print('{} frames'.format(len(stream)))
+    print('    {:<32}{:10.0f} messages/s'.format('json + previous parser',
+                                                 _measure(stream, json.loads, _legacy_ticket_list_to_dict)))
+
+    for name in ('json', 'ujson', 'orjson'):
+        try:
+            loads = get_decoder(name)
+        except ImportError:
+            print('    {:<32}{:>10}'.format(name + ' + _ticket_list_to_dict', 'not installed'))
+            continue
+
+        print('    {:<32}{:10.0f} messages/s'.format(name + ' + _ticket_list_to_dict',
+                                                     _measure(stream, loads, _ticket_list_to_dict)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the decoding of the kraken socket messages')
+    parser.add_argument('--frames', type=int, default=200000, help='frames of the generated stream')
+    parser.add_argument('--file', help='stream recorded from the socket, one frame per line')
+    args = parser.parse_args()
+
+    if args.file is not None:
+        with open(args.file) as file:
+            frames = [line.strip() for line in file if line.strip() != '']
+    else:
+        frames = _generate_frames(args.frames)
+
+    run(frames)
@@ -0,0 +1,75 @@
+"""
+Measures the lookups the kraken recovery does on its stored history: the most recent timestamp, asked before
+every request, and reading a range of candles. Compares the csv the persistor used to store (loaded with
+pandas) against the memory mapped binary store. Uses its own files in a temporary folder.
+
+python -m benchmarks.ohlc_binary_store --rows 100000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from core.OhlcBinaryStore import OhlcBinaryStore, OHLC_RECORD_DTYPE
+
+
+def _generate_records(rows: int) -> np.ndarray:
+    records = np.zeros(rows, dtype=OHLC_RECORD_DTYPE)
+    records['timestamp'] = 1356998400 + np.arange(rows) * 3600
+    for column in ('open', 'high', 'low', 'close'):
+        records[column] = 4000 + np.arange(rows) * 0.01
+    records['volume'] = 10
+    return records
+
+
+def _best_of(repeat: int, function) -> float:
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed.append(time.perf_counter() - start)
+
+    return min(elapsed)
+
+
+def run(rows: int, repeat: int) -> None:
+    records = _generate_records(rows)
+    # a month in the middle of the history
+    start, end = int(records['timestamp'][rows // 2]), int(records['timestamp'][rows // 2] + 720 * 3600)
+
+    with tempfile.TemporaryDirectory() as folder:
+        csv_path = os.path.join(folder, 'kraken_btc_.csv')
+        pd.DataFrame(records).to_csv(csv_path)
+        store_path = os.path.join(folder, 'kraken_btc_.ohlc')
+        OhlcBinaryStore(store_path).append(records)
+
+        def csv_last():
+            return int(pd.read_csv(csv_path)['timestamp'].values[-1])
+
+        def csv_range():
+            stored = pd.read_csv(csv_path)
+            return stored[(stored['timestamp'] >= start) & (stored['timestamp'] < end)]
+
+        # a new store each time, so the file is opened and mapped again like a new process would do
+        def store_last():
+            return OhlcBinaryStore(store_path).last_timestamp()
+
+        def store_range():
+            return OhlcBinaryStore(store_path).range(start, end)
+
+        print('{} hourly candles'.format(rows))
+        print('last timestamp  csv: {:8.3f} ms   binary store: {:8.3f} ms'.format(
+            _best_of(repeat, csv_last) * 1000, _best_of(repeat, store_last) * 1000))
+        print('720 candles     csv: {:8.3f} ms   binary store: {:8.3f} ms'.format(
+            _best_of(repeat, csv_range) * 1000, _best_of(repeat, store_range) * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the lookups on the stored kraken ohlc')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
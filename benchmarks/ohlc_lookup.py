@@ -0,0 +1,96 @@
+"""
+Measures the latency of the newest/oldest ohlc lookups done by the persistors, with and without the
+composite index on (exchange_id, currency_id, date). Uses its own sqlite database in a temporary folder.
+
+python -m benchmarks.ohlc_lookup --rows 10000000
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+from core.model.models import OHLC
+from core.orm.orm import Base
+
+_EXCHANGES = 2
+_CURRENCIES = 4
+
+
+def _generate_rows(rows: int):
+    start = datetime(2000, 1, 1)
+    series = _EXCHANGES * _CURRENCIES
+
+    for i in range(rows):
+        # each exchange/currency pair gets its own hourly serie, interleaved like a real ingestion would do
+        date = start + timedelta(hours=i // series)
+        exchange_id = i % _EXCHANGES + 1
+        currency_id = (i // _EXCHANGES) % _CURRENCIES + 1
+        yield 100.0, 101.0, 99.0, 100.5, 10.0, date.strftime('%Y-%m-%d %H:%M:%S.%f'), exchange_id, currency_id
+
+
+def _fill_table(engine, rows: int) -> None:
+    connection = engine.raw_connection()
+    try:
+        connection.executemany('INSERT INTO {} (open, high, low, close, volume, date, exchange_id, currency_id) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(OHLC.__tablename__), _generate_rows(rows))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def _measure_lookups(session_maker, repeat: int) -> (float, float):
+    elapsed = {'newest': 0.0, 'oldest': 0.0}
+    orders = (('newest', OHLC.date.desc()), ('oldest', OHLC.date.asc()))
+
+    for i in range(repeat):
+        exchange_id = i % _EXCHANGES + 1
+        currency_id = i % _CURRENCIES + 1
+
+        for name, order in orders:
+            session = session_maker()
+            start = time.perf_counter()
+            session.query(OHLC) \
+                .filter(OHLC.exchange_id == exchange_id, OHLC.currency_id == currency_id) \
+                .order_by(order).first()
+            elapsed[name] += time.perf_counter() - start
+            session.close()
+
+    return elapsed['newest'] * 1000 / repeat, elapsed['oldest'] * 1000 / repeat
+
+
+def run(rows: int, repeat: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = sqlalchemy.create_engine('sqlite:///' + os.path.join(tmp_dir, 'benchmark.db'))
+        Base.metadata.create_all(engine)
+        session_maker = sessionmaker(bind=engine)
+
+        for index in OHLC.__table__.indexes:
+            index.drop(engine)
+
+        start = time.perf_counter()
+        _fill_table(engine, rows)
+        print('Inserted {} rows in {:.1f} s'.format(rows, time.perf_counter() - start))
+
+        newest, oldest = _measure_lookups(session_maker, repeat)
+        print('Without index: newest {:.2f} ms, oldest {:.2f} ms'.format(newest, oldest))
+
+        start = time.perf_counter()
+        for index in OHLC.__table__.indexes:
+            index.create(engine)
+        print('Index created in {:.1f} s'.format(time.perf_counter() - start))
+
+        newest, oldest = _measure_lookups(session_maker, repeat)
+        print('With index: newest {:.2f} ms, oldest {:.2f} ms'.format(newest, oldest))
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the newest/oldest ohlc lookups')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
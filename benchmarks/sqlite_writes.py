@@ -0,0 +1,85 @@
+"""
+Measures the write throughput of an ingestion loop over sqlite, doing per batch what KrakenPersistor does:
+look up the newest frame of the market and insert the new frames, commiting them. Compares the default engine
+of sqlalchemy (a new connection per session, rollback journal) with the engine of core.orm.orm.build_engine
+(pooled connections, write ahead log), opening a session per call or keeping one for the whole loop.
+Uses its own databases in a temporary folder.
+
+python -m benchmarks.sqlite_writes --batches 500
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+
+from core.model.models import OHLC
+from core.orm import queries
+from core.orm.orm import Base, build_engine
+
+_FRAMES_PER_BATCH = 24
+
+
+def _batch_rows(batch: int) -> list:
+    start = datetime(2019, 1, 1) + timedelta(hours=batch * _FRAMES_PER_BATCH)
+    return [{'open': 100.0, 'high': 101.0, 'low': 99.0, 'close': 100.5, 'volume': 10.0,
+             'date': start + timedelta(hours=i), 'exchange_id': 1, 'currency_id': 1}
+            for i in range(_FRAMES_PER_BATCH)]
+
+
+def _persist(session, batch: int) -> None:
+    queries.get_newest_ohlc(session, 1, 1)
+    session.execute(OHLC.__table__.insert(), _batch_rows(batch))
+    session.commit()
+
+
+def _session_per_call(session_maker, batches: int) -> None:
+    for batch in range(batches):
+        # the lookup and the insert open their own session, as the persistor does outside a unit of work
+        session = session_maker()
+        queries.get_newest_ohlc(session, 1, 1)
+        session.close()
+
+        session = session_maker()
+        session.execute(OHLC.__table__.insert(), _batch_rows(batch))
+        session.commit()
+        session.close()
+
+
+def _single_session(session_maker, batches: int) -> None:
+    session = session_maker()
+    try:
+        for batch in range(batches):
+            _persist(session, batch)
+    finally:
+        session.close()
+
+
+def _measure(engine, loop, batches: int) -> float:
+    Base.metadata.create_all(engine)
+    start = time.perf_counter()
+    loop(sessionmaker(bind=engine), batches)
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+    return batches * _FRAMES_PER_BATCH / elapsed
+
+
+def run(batches: int) -> None:
+    with tempfile.TemporaryDirectory() as folder:
+        setups = (('default engine, session per call', sqlalchemy.create_engine, _session_per_call),
+                  ('pooled + wal, session per call', build_engine, _session_per_call),
+                  ('pooled + wal, unit of work', build_engine, _single_session))
+
+        for i, (name, engine_factory, loop) in enumerate(setups):
+            engine = engine_factory('sqlite:///' + os.path.join(folder, 'benchmark{}.db'.format(i)))
+            print('{:<36}{:10.0f} frames/s'.format(name, _measure(engine, loop, batches)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the ingestion loop writes over sqlite')
+    parser.add_argument('--batches', type=int, default=500)
+    args = parser.parse_args()
+    run(args.batches)
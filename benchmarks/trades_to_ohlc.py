@@ -0,0 +1,54 @@
+"""
+Measures the time to resample trades into hourly ohlc frames, with the columnar implementation and
+with the list of TradesEntry wrapper used by the persistors.
+
+python -m benchmarks.trades_to_ohlc --trades 10000000
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from core.model.CoreModels import TradesEntry
+from core.utils import trades_to_ohlc_array, trade_entries_to_ohlc_frames
+
+
+def _generate_trades(trades: int) -> (np.ndarray, np.ndarray, np.ndarray):
+    rng = np.random.RandomState(0)
+    # a few seconds between trades, so there are hundreds of them per frame
+    epoch = 1546300800 + np.cumsum(rng.exponential(5, trades))
+    price = 4000 + np.cumsum(rng.normal(0, 1, trades))
+    volume = rng.exponential(0.5, trades)
+    return epoch, price, volume
+
+
+def run(trades: int, entries: int) -> None:
+    epoch, price, volume = _generate_trades(trades)
+
+    start = time.perf_counter()
+    ohlc = trades_to_ohlc_array(epoch, price, volume)
+    elapsed = time.perf_counter() - start
+    print('Columnar: {} trades into {} frames in {:.3f} s ({:.0f} ns/trade)'.format(
+        trades, len(ohlc), elapsed, elapsed * 1e9 / trades))
+
+    # building millions of dataclasses is slow by itself, so the wrapper is measured on a sample
+    entries = min(entries, trades)
+    base = datetime(1970, 1, 1)
+    trade_list = [TradesEntry(price=p, volume=v, direction='buy', date=base + timedelta(seconds=e))
+                  for e, p, v in zip(epoch[:entries].tolist(), price[:entries].tolist(), volume[:entries].tolist())]
+
+    start = time.perf_counter()
+    frames = trade_entries_to_ohlc_frames(trade_list)
+    elapsed = time.perf_counter() - start
+    print('TradesEntry wrapper: {} trades into {} frames in {:.3f} s ({:.0f} ns/trade)'.format(
+        entries, len(frames), elapsed, elapsed * 1e9 / entries))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the trades to ohlc resampling')
+    parser.add_argument('--trades', type=int, default=10000000)
+    parser.add_argument('--entries', type=int, default=1000000,
+                        help='trades used to measure the TradesEntry wrapper')
+    args = parser.parse_args()
+    run(args.trades, args.entries)
@@ -1,3 +1,7 @@
+import os
+import tempfile
+
+
 class BaseConfig:
     class DBConnection:
         db_provider = 'sqlite'  # can be any of 'mysql', 'postgres', 'sqlserver', sqlite
@@ -5,6 +9,35 @@ class BaseConfig:
         username = None
         password = None
         db_name = None
+        insert_chunk_size = 5000  # rows inserted per statement (and per commit) on bulk inserts
+        newest_ohlc_check_sec = 3600  # the persistors re-read their cached newest frame after this. None: never
+        pool_size = 5  # connections kept open by the engine. Should be >= the markets recovered concurrently
+        max_overflow = 10  # connections opened over pool_size when all of them are in use, closed when released
+        pool_pre_ping = True  # checks a connection before using it, so connections closed by the server are replaced
+        pool_recycle = 3600  # seconds. Connections older than this are replaced (mysql closes them after 8 hours)
+        sqlite_wal = True  # write ahead log and synchronous=NORMAL with sqlite: faster commits, readers dont block
+
+    class Http:
+        pool_connections = 4  # number of hosts whose connections are kept alive
+        pool_maxsize = 8  # connections kept alive per host. Should be >= the markets recovered concurrently
+        connect_timeout = 5  # seconds
+        read_timeout = 30  # seconds
+
+    class Json:
+        # library that decodes the websocket messages and the rest responses: 'orjson', 'ujson', 'json' (the
+        # standard library) or 'auto', the first of them that is installed
+        decoder = 'auto'
+
+    class RateLimit:
+        # the state of the token buckets is stored here, so every process of this machine shares the budget
+        # of each exchange. Set it to None to share it only between the markets of the same process
+        state_path = os.path.join(tempfile.gettempdir(), 'fortacryp_rate_limits.db')
+        backoff_base_sec = 1  # first wait after a failed request (429, 5xx or network errors)
+        backoff_max_sec = 300
+
+    class Parquet:
+        path = 'parquet'  # root folder of the parquet files, one subfolder per exchange and market
+        row_group_size = 24 * 7  # hourly frames per row group, the unit skipped when reading a date range
 
     class DBNames:
         exchange = 'exchanges'
@@ -15,11 +48,36 @@ class BaseConfig:
     class Exchanges:
         class Kraken:
             url = 'https://www.kraken.com'
-            sleep_time_between_requests = 1
+            requests_per_sec = 1  # budget of the public endpoints
+            burst = 1
             ms_ts = True
             recover_from = 1420081200 * (10 ** 9)  # 01/01/2015 00:00 in nanoseconds
+            websocket_window = 720  # hourly candles kept in memory by the websocket, 30 days
+            # messages of the websocket waiting to be processed, and what to do when there are more:
+            # 'block' the socket, 'drop_oldest' or 'coalesce' the trades of the same pair and hour in a single message
+            write_behind_size = 1000
+            write_behind_policy = 'coalesce'
+            pairs_per_connection = 10  # subscriptions (channel and pair) per connection of the asyncio socket
+            ping_interval_sec = 5  # kraken sends a heartbeat every second, so this long without messages needs a ping
+            pong_timeout_sec = 5  # a connection that doesnt answer the ping in this time is reconnected
+            backfill_max_pages = 20  # pages of 1000 trades recovered from the rest api after a reconnection
+            candle_grace_sec = 5  # trades this late are still merged into the hourly candle, stored after that
 
         class Buda:
             url = 'https://www.buda.com/chile'
+            # only used when the json config has no sleep_time_sec, that sets the interval between requests.
+            # Conservative, Buda blocks the clients that abuse the public api
+            requests_per_sec = 0.1
+            burst = 1
             ms_ts = False
             recover_from = 123
+            flush_every_pages = 100  # pages kept in memory before writing the csv. It is also written at the end
+
+        class CryptoCompare:
+            url = 'https://min-api.cryptocompare.com'
+            # only used when the json config has no sleep_time_sec, that sets the interval between requests.
+            # Conservative for the free plan. Tune it to the budget of your api key
+            requests_per_sec = 5
+            burst = 10
+            backfill_workers = 4  # pages requested at the same time by the backfill mode
+            backfill_max_attempts = 5  # a page failing this many times (429, 5xx or network errors) aborts the backfill
@@ -1,13 +1,17 @@
+import asyncio
+import contextlib
 import datetime
-import json
 from abc import ABC, abstractmethod
-import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import Union, Optional
+from typing import Union, Optional, Callable, Sequence
 
 import requests
 from core.configCore import MarketConfig
 from core.Constants import *
+from core.HttpSession import get_shared_session
+from core.JsonDecoder import response_json
+from core.RateLimiter import TokenBucket, ExponentialBackoff, check_response
 
 
 class IntegrationMarkets(Enum):
@@ -36,6 +40,12 @@ class BaseCryptoIntegration(ABC):
         """
         self.config = config
         self.persistor = persistor
+        self.requests = get_shared_session()  # easier to test by injecting a mock
+        # integrations should set the token bucket of their exchange, see core.RateLimiter.get_rate_limiter
+        self.rate_limiter: Optional[TokenBucket] = None
+        # sleep_time_after_block of the json config is the longest wait after a failed request
+        max_sec = getattr(config, 'sleep_time_after_block', None)
+        self.backoff = ExponentialBackoff() if max_sec is None else ExponentialBackoff(max_sec=max_sec)
 
     def recover_btc(self, market_id='btc') -> None:
         self._generic_recover(market_id, persistor_name='btc', property_name='btc')
@@ -104,17 +114,15 @@ class BaseCryptoIntegration(ABC):
                     store_last_timestamp = False
                     market_config.most_recent_timestamp = self._get_first_timestamp_from_response(resp_json)
 
-                self.config.persist()
+                self._persist_config()
                 self._do_loging(REQUESTED, market_config)
+                self.backoff.reset()
 
-                if hasattr(self.config, 'sleep_time_sec'):
-                    time.sleep(self.config.sleep_time_sec)
-
-            except (requests.RequestException, ConnectionError):
+            except (requests.RequestException, ConnectionError) as e:
                 self._do_loging(EXCEPTION, market_config)
-                if hasattr(self.config, 'sleep_time_after_exception'):
-                    time.sleep(self.config.sleep_time_after_exception)
+                self.backoff.wait(e)
 
+        self._flush_persistor()
         market_config.last_stored_timestamp = market_config.most_recent_timestamp
         market_config.current_request_timestamp = None
         self.config.persist()
@@ -128,6 +136,7 @@ class BaseCryptoIntegration(ABC):
         while not market_config.recovered_all:
             self._do_not_all_recovered_iteration(market_config)
 
+        self._flush_persistor()
         market_config.most_recent_timestamp = market_config.last_stored_timestamp
         market_config.recovered_all = True  # have you ever tried to ctrl+S more than once, just to be sure?
         market_config.current_request_timestamp = None
@@ -137,9 +146,10 @@ class BaseCryptoIntegration(ABC):
         """
         Inner function for the iteration when the historical data has not been recovered before.
         Calls the function that makes the request to the server, updates the config file and persist it
-        to the disk. Has some logic to wait a little in between calls to prevent the server think we are
-        making a ddos attack. Has a little logic to wait even more time in case of error comunicating with
-        the server, mainly in case the server block us either way.
+        to the disk. The requests wait for the rate limiter of the exchange to prevent the server think we are
+        making a ddos attack, and wait even more time (exponentially) in case of error comunicating with
+        the server, mainly in case the server block us either way. Responses that would fail again if retried
+        (see core.RateLimiter.check_response) raise ResponseError.
         :param market_config: subconfiguration for a certain cryptocurrency
         :return:
         """
@@ -156,33 +166,31 @@ class BaseCryptoIntegration(ABC):
             if market_config.current_request_timestamp is not None:
                 market_config.first_stored_timestamp = int(market_config.current_request_timestamp)
 
-            self.config.persist()
+            self._persist_config()
             self._do_loging(REQUESTED, market_config)
-
-            if hasattr(self.config, 'sleep_time_sec'):
-                time.sleep(self.config.sleep_time_sec)
+            self.backoff.reset()
 
         except (requests.RequestException, ConnectionError) as e:
             self._do_loging(EXCEPTION, market_config, exception=e)
-            if hasattr(self.config, 'sleep_time_after_exception'):
-                time.sleep(self.config.sleep_time_after_exception)
+            self.backoff.wait(e)
 
     def _do_request(self, market_config: MarketConfig) -> dict:
         """
         Execute the request call to the server, calls the function to persist the response data,
         updates the config to standarize the way we know wich timestamp we have got, so we can
         send it to server to chain requests. Raises an error in case the server does not respond
-        with status 200 OK.
+        with status 200 OK: RetryableResponseError (a ConnectionError) or ResponseError.
         :param market_config: subconfiguration for a certain cryptocurrency
         :return: the response json transformed into a python dictionary
         """
         url = self._generate_url(market_config)
-        r = requests.get(url)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
 
-        if r.status_code != 200:
-            raise ConnectionError(r.status_code)
+        r = self.requests.get(url)
+        check_response(r)
 
-        resp_json = json.loads(r.text)
+        resp_json = response_json(r)
         self._persist_new_entries(resp_json, market_config)
 
         current_request_timestamp = self._get_last_timestamp_from_response(resp_json)
@@ -193,6 +201,27 @@ class BaseCryptoIntegration(ABC):
 
         return resp_json
 
+    def _persist_config(self) -> None:
+        """
+        Saves the config after a page, unless the persistor keeps pages in memory that are not written yet
+        (its is_flushed method returns False). Otherwise an interrupted recovery would resume after pages
+        that were never stored. Having an is_flushed method is optional for a persistor
+        :return: nothing
+        """
+        if callable(getattr(self.persistor, 'is_flushed', None)) and not self.persistor.is_flushed():
+            return
+
+        self.config.persist()
+
+    def _flush_persistor(self) -> None:
+        """
+        Asks the persistor to write to disk whatever it has been keeping staged between requests.
+        Having a flush method is optional for a persistor
+        :return: nothing
+        """
+        if callable(getattr(self.persistor, 'flush', None)):
+            self.persistor.flush()
+
     def _validate_persistor(self) -> bool:
         if hasattr(self.persistor, 'set_market') and \
                 callable(self.persistor.set_market) and \
@@ -283,7 +312,9 @@ class CoreIntegration(ABC):
     def __init__(self, configuration=None, persistor=None):
         self.config = configuration
         self.persistor = persistor
-        self.requests = requests
+        self.requests = get_shared_session()
+        self.rate_limiter: Optional[TokenBucket] = None
+        self.backoff = ExponentialBackoff()
 
     def recover(self, market: IntegrationMarkets):
         if not hasattr(self.config, market.value):
@@ -291,30 +322,74 @@ class CoreIntegration(ABC):
         else:
             self.do_main_loop(getattr(self.config, market.value))
 
+    async def recover_async(self, market: IntegrationMarkets, executor: Optional[ThreadPoolExecutor] = None):
+        if not hasattr(self.config, market.value):
+            self.do_logging(CRITICAL, None, f'Configuration has no attribute {market.value}')
+        else:
+            await self.do_main_loop_async(getattr(self.config, market.value), executor)
+
     def do_main_loop(self, market_config):
         last_data = None
-        while not self.is_ending_condition_achieved(last_data):
+        with self._unit_of_work():
+            while not self.is_ending_condition_achieved(last_data):
+                try:
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.acquire()
+
+                    response_list = self.do_request(market_config)
+                    self.persistor.persist(response_list)
+                    last_data = self._on_persisted(response_list, market_config)
+
+                except (requests.RequestException, ConnectionError) as e:
+                    self.do_logging(EXCEPTION, market_config, str(e))
+                    self.backoff.wait(e)
+
+        self.do_logging(RECOVERED, market_config)
+
+    def _unit_of_work(self):
+        """
+        The unit of work of the persistor, e.g. a single database session for the whole loop instead of one per
+        call (see kraken.KrakenPersistors.KrakenPersistor). Having a unit_of_work method is optional for a
+        persistor. The async loop doesnt use it, since its calls run in the threads of the executor
+        """
+        unit_of_work = getattr(self.persistor, 'unit_of_work', None)
+        return unit_of_work() if callable(unit_of_work) else contextlib.nullcontext()
+
+    async def do_main_loop_async(self, market_config, executor: Optional[ThreadPoolExecutor] = None):
+        """
+        Same as do_main_loop, but the blocking calls (requests and persistence) run in the executor, so
+        many markets can be recovered concurrently from the same event loop. Every request waits for a token
+        of the rate limiter, which should be shared by all the markets of the exchange.
+        """
+        loop = asyncio.get_event_loop()
+        last_data = None
+        while not await loop.run_in_executor(executor, self.is_ending_condition_achieved, last_data):
             try:
-                response_list = self.do_request(market_config)
-                self.persistor.persist(response_list)
-                last_data = self.update_last_data(response_list)
-                from_date = _timestamp_to_str(self.get_older_entry_ts(response_list))
-                to_date = _timestamp_to_str(self.get_most_recent_entry_ts(response_list))
-                self.do_logging(UPDATED, market_config, f'Recovered data from {from_date} to {to_date} GMT-0')
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire_async()
+
+                response_list = await loop.run_in_executor(executor, self.do_request, market_config)
+                await loop.run_in_executor(executor, self.persistor.persist, response_list)
+                last_data = self._on_persisted(response_list, market_config)
 
             except (requests.RequestException, ConnectionError) as e:
                 self.do_logging(EXCEPTION, market_config, str(e))
-                if hasattr(self.config, 'sleep_time_after_exception'):
-                    time.sleep(self.config.sleep_time_after_exception)
+                await asyncio.sleep(self.backoff.next_delay(e))
 
         self.do_logging(RECOVERED, market_config)
 
+    def _on_persisted(self, response_list, market_config):
+        self.backoff.reset()
+        from_date = _timestamp_to_str(self.get_older_entry_ts(response_list))
+        to_date = _timestamp_to_str(self.get_most_recent_entry_ts(response_list))
+        self.do_logging(UPDATED, market_config, f'Recovered data from {from_date} to {to_date} GMT-0')
+        return self.update_last_data(response_list)
+
     def do_request(self, market_config):
         r = self.requests.get(self.generate_url(market_config))
-        if r.status_code != 200:
-            raise ConnectionError(f'Response code: {r.status_code} from server')
+        check_response(r)
 
-        return self.parse_response_to_list(json.loads(r.text), market_config)
+        return self.parse_response_to_list(response_json(r), market_config)
 
     @abstractmethod
     def generate_url(self, market_config) -> str:
@@ -344,3 +419,20 @@ class ForwardRecoverIntegration(CoreIntegration, ABC):
     @abstractmethod
     def get_most_recent_entry_ts(self, data_list) -> int:
         pass
+
+
+def recover_concurrently(integration_factory: Callable[[IntegrationMarkets], CoreIntegration],
+                         markets: Sequence[IntegrationMarkets] = tuple(IntegrationMarkets)) -> None:
+    """
+    Recovers many markets of the same exchange concurrently from a single process. Each market gets its own
+    integration instance (and so its own persistor), but all of them should share the rate limiter of the
+    exchange, so the total time is bounded by the rate limit instead of by the sum of the requests latency.
+    :param integration_factory: returns a new integration for the market passed
+    :param markets: markets to recover. All of them by default
+    """
+    async def recover_all():
+        with ThreadPoolExecutor(max_workers=max(1, len(markets))) as executor:
+            await asyncio.gather(*[integration_factory(market).recover_async(market, executor)
+                                   for market in markets])
+
+    asyncio.run(recover_all())
@@ -1,19 +1,49 @@
+import time
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from typing import List, Optional, Union, Dict, Tuple
 
+from config import BaseConfig
 from core.Enums import Mnemonic
-from core.model.CoreModels import OhlcFrame, TradesEntry
+from core.model.CoreModels import OhlcFrame, TradesEntry, OhlcBatch, TradeBatch
 from core.model.models import OHLC
 from core.utils import trade_entries_to_ohlc_frames, map_ohlc_to_frame
 
 
+Frames = Union[List[OhlcFrame], OhlcBatch]
+Entries = Union[List[TradesEntry], TradeBatch]
+
+
 class BasePersistor(ABC):
+    """
+    The methods that receive frames or trades accept either a list of dataclasses or an array backed batch.
+    The newest stored frame of each market is cached, and kept up to date by the writes of the persistor, as
+    it is supposed to be the only writer of its exchange. The cache is verified against the storage every
+    newest_check_sec seconds (never if None)
+    """
+    def __init__(self, newest_check_sec: Optional[float] = BaseConfig.DBConnection.newest_ohlc_check_sec):
+        self.newest_check_sec: Optional[float] = newest_check_sec
+        self._newest: Dict[Mnemonic, Tuple[OhlcFrame, float]] = {}  # frame and time of the last check
+
     @abstractmethod
-    def persist_ohlc(self, tick_list: List[OhlcFrame], nemo: Mnemonic) -> None:
+    def persist_ohlc(self, tick_list: Frames, nemo: Mnemonic) -> None:
         raise NotImplementedError()
 
     @abstractmethod
-    def persist_entry(self, entry_list: List[TradesEntry], nemo: Mnemonic) -> None:
+    def persist_entry(self, entry_list: Entries, nemo: Mnemonic) -> None:
+        raise NotImplementedError()
+
+    def upsert_ohlc(self, tick_list: Frames, nemo: Mnemonic) -> None:
+        """
+        Inserts complete frames, overwriting the stored ones with the same date instead of merging them.
+        Persisting the same frames twice should leave the storage as persisting them once. The implementations
+        must invalidate the cached newest frame of the market, as the upserted frames can replace it
+        """
+        raise NotImplementedError()
+
+    def upsert_entry(self, entry_list: Entries, nemo: Mnemonic) -> None:
+        """
+        Inserts trades, ignoring the ones that are already stored
+        """
         raise NotImplementedError()
 
     def get_oldest_ohlc(self, nemo: Mnemonic) -> OhlcFrame:
@@ -36,25 +66,79 @@ class BasePersistor(ABC):
         raise NotImplementedError()
 
     @staticmethod
-    def trades_to_ohlc(trade_list: List[TradesEntry]) -> List[OhlcFrame]:
+    def trades_to_ohlc(trade_list: Entries) -> Frames:
         return trade_entries_to_ohlc_frames(trade_list)
 
-    def merge_ohlc_with_last(self, tick_list: List[OhlcFrame], nemo: Mnemonic) -> (
-            Optional[OHLC], List[OhlcFrame]):
-        last = self._get_newest_ohlc_dto(nemo)
+    def get_cached_newest_ohlc(self, nemo: Mnemonic) -> Optional[OhlcFrame]:
+        """
+        Same than get_newest_ohlc, but the storage is only read when the market is not cached or the cache
+        must be verified
+        """
+        cached = self._newest.get(nemo)
+        if cached is not None:
+            frame, checked_at = cached
+            if self.newest_check_sec is None or time.monotonic() - checked_at < self.newest_check_sec:
+                return frame
+
+        frame = self.get_newest_ohlc(nemo)
+        if frame is not None:
+            self._newest[nemo] = (frame, time.monotonic())
+        else:
+            # there is nothing to cache until the first frame of the market is stored
+            self._newest.pop(nemo, None)
+
+        return frame
+
+    def invalidate_newest_ohlc(self, nemo: Optional[Mnemonic] = None) -> None:
+        """
+        Forces the next merge to read the newest frame from the storage. Should be called when a write fails
+        or when the storage is modified by someone else
+        :param nemo: the market to invalidate, or None to invalidate all of them
+        """
+        if nemo is None:
+            self._newest.clear()
+        else:
+            self._newest.pop(nemo, None)
+
+    def merge_ohlc_with_last(self, tick_list: Frames, nemo: Mnemonic) -> (Optional[OhlcFrame], Frames):
+        """
+        Discards the frames older than the newest stored one, and merges the frame with its same date into it
+        :return: the newest stored frame merged with the new one (None if they dont collide) and the frames
+        that should be inserted
+        """
+        last = self.get_cached_newest_ohlc(nemo)
+        to_update = None
 
         if last is not None:
-            def filter_func(ohlc_frame: OhlcFrame):
-                return ohlc_frame.date >= last.date
+            if isinstance(tick_list, OhlcBatch):
+                tick_list = tick_list.since(last.date)
+            else:
+                tick_list = [ohlc_frame for ohlc_frame in tick_list if ohlc_frame.date >= last.date]
+
+            if len(tick_list) > 0 and tick_list[0].date == last.date:
+                first_frame = tick_list[0]
+                # a new frame, so the cached one is not modified if the write fails
+                to_update = OhlcFrame(open=last.open,
+                                      high=max(first_frame.high, last.high),
+                                      low=min(first_frame.low, last.low),
+                                      close=first_frame.close,
+                                      date=last.date,
+                                      volume=last.volume + first_frame.volume)
+                tick_list = tick_list[1:]
 
-            tick_list = list(filter(filter_func, tick_list))
-            first_frame = tick_list[0]
+        return to_update, tick_list
 
-            if first_frame.date == last.date:
-                last.close = first_frame.close
-                last.low = min(first_frame.low, last.low)
-                last.high = max(first_frame.high, last.high)
-                last.volume += first_frame.volume
-                tick_list.pop(0)
+    def _set_newest_ohlc(self, nemo: Mnemonic, to_update: Optional[OhlcFrame], new: Frames) -> None:
+        """
+        Updates the cache after storing the result of merge_ohlc_with_last
+        """
+        newest = new[-1] if len(new) > 0 else to_update
+        if newest is None:
+            return
 
-        return last, tick_list
+        cached = self._newest.get(nemo)
+        if cached is None:
+            self._newest[nemo] = (newest, time.monotonic())
+        elif newest.date >= cached[0].date:
+            # a write is not a verification, so the time of the last check is kept
+            self._newest[nemo] = (newest, cached[1])
@@ -0,0 +1,250 @@
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from core.model.CoreModels import OHLC_DTYPE
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+# positions in the state of an open candle: [open, high, low, close, volume, first trade ts, last trade ts]
+_OPEN, _HIGH, _LOW, _CLOSE, _VOLUME, _FIRST, _LAST = range(7)
+_CLOSED_SIDES = ('left', 'right')
+
+
+class CandleAggregator:
+    """
+    Builds the ohlcv candles of one or more intervals at the same time (e.g. 1m, 5m, 1h and 1d) from trades,
+    given one by one with add, or as columns with add_batch. Each trade costs O(1) per interval, since only the
+    candles that can still receive trades are kept in memory.
+
+    A candle is closed when a trade newer than its end plus grace_sec arrives. Until then, trades that arrive
+    late or out of order are merged into it (the open and close are the prices of its oldest and newest
+    trades). Later than that they are discarded and counted in late_trades. The closed candles are taken with
+    pop_closed, as arrays of OHLC_DTYPE sorted by date, and flush closes the ones still open, e.g. at the
+    end of a batch.
+
+    With closed='left' a candle covers [start, start + interval) and its date is the start, as the candles of
+    pandas resample. With closed='right' it covers (end - interval, end] and its date is the end.
+
+    aggregator = CandleAggregator((MINUTE, HOUR), grace_sec=5)
+    aggregator.add(1561485600.5, 9000.0, 0.1)
+    ...
+    hourly = aggregator.pop_closed(HOUR)
+    """
+
+    def __init__(self, intervals: Sequence[int] = (HOUR,), grace_sec: float = 0, closed: str = 'left'):
+        if len(intervals) == 0 or any(interval <= 0 for interval in intervals):
+            raise ValueError('intervals should be a list of seconds greater than 0')
+
+        if closed not in _CLOSED_SIDES:
+            raise ValueError('closed should be one of {}'.format(_CLOSED_SIDES))
+
+        self.intervals: Tuple[int, ...] = tuple(intervals)
+        self.grace_sec: float = grace_sec
+        self.closed: str = closed
+        self.watermark: Optional[float] = None  # timestamp of the newest trade
+        self.late_trades: Dict[int, int] = {interval: 0 for interval in self.intervals}
+        self._open: Dict[int, Dict[int, list]] = {interval: {} for interval in self.intervals}
+        # the candles before this one are closed. None until the first trade
+        self._closed_until: Dict[int, Optional[int]] = {interval: None for interval in self.intervals}
+        self._closed_rows: Dict[int, List[tuple]] = {interval: [] for interval in self.intervals}
+        self._closed_arrays: Dict[int, List[np.ndarray]] = {interval: [] for interval in self.intervals}
+
+    def add(self, timestamp: float, price: float, volume: float) -> None:
+        """
+        :param timestamp: seconds since the epoch
+        """
+        for interval in self.intervals:
+            bucket = self._bucket(timestamp, interval)
+            closed_until = self._closed_until[interval]
+            if closed_until is not None and bucket < closed_until:
+                self.late_trades[interval] += 1
+                continue
+
+            self._merge(interval, bucket, price, price, price, price, volume, timestamp, timestamp)
+
+        self._advance(timestamp)
+
+    def add_batch(self, epoch: np.ndarray, price: np.ndarray, volume: np.ndarray) -> None:
+        """
+        Same than calling add with each trade, in the order of their timestamps, but vectorized: the candles
+        closed by the batch itself go straight to the output, without going through the state of add
+        :param epoch: seconds since the epoch of each trade, in any order
+        :param price: price of each trade
+        :param volume: volume of each trade
+        """
+        epoch = np.asarray(epoch, dtype=np.float64)
+        price = np.asarray(price, dtype=np.float64)
+        volume = np.asarray(volume, dtype=np.float64)
+        if len(epoch) == 0:
+            return
+
+        if np.any(epoch[1:] < epoch[:-1]):
+            order = np.argsort(epoch, kind='stable')
+            epoch, price, volume = epoch[order], price[order], volume[order]
+
+        watermark = epoch[-1] if self.watermark is None else max(self.watermark, epoch[-1])
+
+        for interval in self.intervals:
+            self._add_batch(interval, epoch, price, volume, watermark)
+
+        self._advance(watermark)
+
+    def add_candle(self, interval: int, date: float, open_price: float, high: float, low: float, close: float,
+                   volume: float) -> None:
+        """
+        Merges a candle built somewhere else, e.g. the one in progress returned by a rest api, into the candle
+        of the same date. Its open and close are replaced by the ones of the trades added later
+        :param date: the date of the candle, with the same meaning than the ones of this aggregator
+        """
+        bucket = self._bucket(date, interval)
+        closed_until = self._closed_until[interval]
+        if closed_until is not None and bucket < closed_until:
+            self.late_trades[interval] += 1
+            return
+
+        start = bucket * interval
+        self._merge(interval, bucket, open_price, high, low, close, volume, start, start)
+
+    def pop_closed(self, interval: Optional[int] = None) -> np.ndarray:
+        """
+        Returns the candles closed since the last call, as an array of OHLC_DTYPE sorted by date
+        :param interval: one of the intervals of the aggregator. The first one if not given
+        """
+        interval = self.intervals[0] if interval is None else interval
+        rows, arrays = self._closed_rows[interval], self._closed_arrays[interval]
+        if len(rows) == 0 and len(arrays) == 0:
+            return np.empty(0, dtype=OHLC_DTYPE)
+
+        if len(rows) > 0:
+            arrays.append(np.array(rows, dtype=OHLC_DTYPE))
+
+        self._closed_rows[interval], self._closed_arrays[interval] = [], []
+        closed = arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+        return closed[np.argsort(closed['date'], kind='stable')]
+
+    def flush(self) -> None:
+        """
+        Closes every open candle. The trades that belong to them are discarded from now on
+        """
+        for interval in self.intervals:
+            open_candles = self._open[interval]
+            if len(open_candles) == 0:
+                continue
+
+            closed_until = max(open_candles) + 1
+            if self._closed_until[interval] is not None:
+                closed_until = max(closed_until, self._closed_until[interval])
+
+            self._close(interval, closed_until)
+
+    def current(self, interval: Optional[int] = None) -> Optional[tuple]:
+        """
+        The newest open candle, as a (date, open, high, low, close, volume) tuple. None if there is none
+        """
+        interval = self.intervals[0] if interval is None else interval
+        open_candles = self._open[interval]
+        if len(open_candles) == 0:
+            return None
+
+        bucket = max(open_candles)
+        return self._row(interval, bucket, open_candles[bucket])
+
+    def _add_batch(self, interval: int, epoch: np.ndarray, price: np.ndarray, volume: np.ndarray,
+                   watermark: float) -> None:
+        buckets = self._buckets(epoch, interval)
+        closed_until = self._closed_until[interval]
+        if closed_until is not None:
+            is_late = buckets < closed_until
+            late = int(np.count_nonzero(is_late))
+            if late > 0:
+                self.late_trades[interval] += late
+                keep = ~is_late
+                buckets, epoch, price, volume = buckets[keep], epoch[keep], price[keep], volume[keep]
+
+                if len(buckets) == 0:
+                    return
+
+        # first and last trade of each candle
+        starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+        ends = np.append(starts[1:], len(buckets)) - 1
+        candles = buckets[starts]
+        high = np.maximum.reduceat(price, starts)
+        low = np.minimum.reduceat(price, starts)
+        total = np.add.reduceat(volume, starts)
+
+        # the candles closed by this batch that were not open before, the rest are merged with add's state
+        direct = candles < self._bucket(watermark - self.grace_sec, interval)
+        open_candles = self._open[interval]
+        if len(open_candles) > 0:
+            direct &= ~np.isin(candles, np.fromiter(open_candles, np.int64, len(open_candles)))
+
+        if np.any(direct):
+            closed = np.empty(int(np.count_nonzero(direct)), dtype=OHLC_DTYPE)
+            closed['date'] = self._label(candles[direct], interval)
+            closed['open'] = price[starts[direct]]
+            closed['high'] = high[direct]
+            closed['low'] = low[direct]
+            closed['close'] = price[ends[direct]]
+            closed['volume'] = total[direct]
+            self._closed_arrays[interval].append(closed)
+
+        for i in np.flatnonzero(~direct).tolist():
+            self._merge(interval, int(candles[i]), float(price[starts[i]]), float(high[i]), float(low[i]),
+                        float(price[ends[i]]), float(total[i]), float(epoch[starts[i]]), float(epoch[ends[i]]))
+
+    def _merge(self, interval: int, bucket: int, open_price: float, high: float, low: float, close: float,
+               volume: float, first: float, last: float) -> None:
+        candle = self._open[interval].get(bucket)
+        if candle is None:
+            self._open[interval][bucket] = [open_price, high, low, close, volume, first, last]
+            return
+
+        if high > candle[_HIGH]:
+            candle[_HIGH] = high
+        if low < candle[_LOW]:
+            candle[_LOW] = low
+        if first < candle[_FIRST]:
+            candle[_OPEN], candle[_FIRST] = open_price, first
+        if last >= candle[_LAST]:
+            candle[_CLOSE], candle[_LAST] = close, last
+        candle[_VOLUME] += volume
+
+    def _advance(self, timestamp: float) -> None:
+        if self.watermark is not None and timestamp <= self.watermark:
+            return
+
+        self.watermark = timestamp
+        for interval in self.intervals:
+            # a candle is complete once a trade after its end plus the grace arrived
+            closed_until = self._bucket(timestamp - self.grace_sec, interval)
+            if self._closed_until[interval] is None or closed_until > self._closed_until[interval]:
+                self._close(interval, closed_until)
+
+    def _close(self, interval: int, closed_until: int) -> None:
+        self._closed_until[interval] = closed_until
+        open_candles = self._open[interval]
+        for bucket in [bucket for bucket in open_candles if bucket < closed_until]:
+            self._closed_rows[interval].append(self._row(interval, bucket, open_candles.pop(bucket)))
+
+    def _row(self, interval: int, bucket: int, candle: list) -> tuple:
+        return (self._label(bucket, interval), candle[_OPEN], candle[_HIGH], candle[_LOW], candle[_CLOSE],
+                candle[_VOLUME])
+
+    def _bucket(self, timestamp: float, interval: int) -> int:
+        if self.closed == 'left':
+            return math.floor(timestamp / interval)
+
+        return math.ceil(timestamp / interval) - 1
+
+    def _buckets(self, epoch: np.ndarray, interval: int) -> np.ndarray:
+        if self.closed == 'left':
+            return np.floor(epoch / interval).astype(np.int64)
+
+        return np.ceil(epoch / interval).astype(np.int64) - 1
+
+    def _label(self, bucket, interval: int):
+        return bucket * interval if self.closed == 'left' else (bucket + 1) * interval
@@ -0,0 +1,28 @@
+import os
+from typing import List
+
+# header of the hourly ohlc csv files, the ones of crypto compare that the kraken websocket keeps up to date
+OHLC_CSV_HEADER = 'time,open,high,low,close,volumefrom'
+
+
+def append_lines(lines: List[str], path: str, fsync: bool = False) -> None:
+    """
+    Appends the lines at the end of the file, with the format of the csv files of the integrations (lines
+    separated by a new line char, with no new line at the end of the file), without reading the file.
+    :param lines: lines in csv format
+    :param path: path of the file. It is created if it does not exist
+    :param fsync: waits until the lines are written to the disk
+    """
+    with open(path, 'ab+') as file:
+        file.seek(0, os.SEEK_END)
+        prefix = ''
+        if file.tell() > 0:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b'\n':
+                prefix = '\n'
+
+        file.write((prefix + '\n'.join(lines)).encode('utf-8'))
+
+        if fsync:
+            file.flush()
+            os.fsync(file.fileno())
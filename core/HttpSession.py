@@ -0,0 +1,43 @@
+from typing import Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import BaseConfig
+
+
+class PooledSession(requests.Session):
+    """
+    requests session that keeps the connections alive between requests, so a long backfill pays the tcp and tls
+    handshake once per host instead of once per page. It has the same interface than the requests module,
+    so it can be injected wherever an integration uses self.requests. Every request gets a default timeout.
+    """
+
+    def __init__(self, pool_connections: int = BaseConfig.Http.pool_connections,
+                 pool_maxsize: int = BaseConfig.Http.pool_maxsize,
+                 timeout: Tuple[float, float] = (BaseConfig.Http.connect_timeout, BaseConfig.Http.read_timeout)):
+        super().__init__()
+        self.timeout: Tuple[float, float] = timeout
+
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+_shared_session: Optional[PooledSession] = None
+
+
+def get_shared_session() -> PooledSession:
+    """
+    Returns the session shared by all integrations of this process. It is created on the first call
+    """
+    global _shared_session
+    if _shared_session is None:
+        _shared_session = PooledSession()
+
+    return _shared_session
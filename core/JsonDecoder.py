@@ -0,0 +1,47 @@
+import json
+from typing import Callable, Union, Any
+
+from config import BaseConfig
+
+Decoder = Callable[[Union[str, bytes]], Any]
+
+_DECODERS = ('orjson', 'ujson', 'json')  # in the order tried by 'auto'
+
+
+def get_decoder(name: str = BaseConfig.Json.decoder) -> Decoder:
+    """
+    Returns the loads function of a json library. orjson and ujson are optional dependencies, several times faster
+    than the standard library decoding the small messages of the websockets
+    :param name: 'orjson', 'ujson', 'json' or 'auto', the first of them that is installed
+    """
+    if name == 'auto':
+        for candidate in _DECODERS:
+            try:
+                return get_decoder(candidate)
+            except ImportError:
+                continue
+
+    if name == 'json':
+        return json.loads
+
+    if name not in _DECODERS:
+        raise ValueError('Unknown json decoder {}. Decoders: {}'.format(name, _DECODERS + ('auto',)))
+
+    try:
+        module = __import__(name)
+    except ImportError as e:
+        raise ImportError('The json decoder {0} is not installed. Install it with: pip install {0}'.format(name)) from e
+
+    return module.loads
+
+
+loads: Decoder = get_decoder()
+
+
+def response_json(response) -> Any:
+    """
+    Decodes the body of a response of requests. The bytes are decoded directly when possible, instead of
+    building the text of the response first
+    """
+    content = getattr(response, 'content', None)
+    return loads(content if isinstance(content, bytes) else response.text)
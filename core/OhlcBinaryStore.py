@@ -0,0 +1,122 @@
+import os
+from typing import Optional
+
+import numpy as np
+
+# one fixed width record per hourly candle, 48 bytes. timestamp is the open of the frame as seconds since the epoch
+OHLC_RECORD_DTYPE = np.dtype([('timestamp', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'),
+                              ('close', '<f8'), ('volume', '<f8')])
+
+_MAGIC = b'FCOHLC01'
+# magic + record size, so a file written with another record layout is never misread
+_HEADER = _MAGIC + np.int64(OHLC_RECORD_DTYPE.itemsize).tobytes()
+
+
+class OhlcBinaryStore:
+    """
+    Append only file of OHLC_RECORD_DTYPE records sorted by timestamp, read through numpy.memmap. As every
+    record has the same size, the last one is read without touching the rest of the file, a timestamp is
+    found with a binary search over the mapped column, and a range of records is returned as a read only view
+    of the mapping (no copy, the pages are loaded by the os when they are read)
+    """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self._map: Optional[np.memmap] = None
+        self._length: Optional[int] = None
+
+    def __len__(self) -> int:
+        if self._length is None:
+            self._length = self._read_length()
+
+        return self._length
+
+    def append(self, records: np.ndarray, fsync: bool = False) -> int:
+        """
+        Appends the records newer than the last stored one at the end of the file
+        :param records: array of OHLC_RECORD_DTYPE sorted by timestamp
+        :param fsync: waits until the records are written to the disk
+        :return: the number of records appended
+        """
+        last = self.last_timestamp()
+        if last is not None:
+            records = records[records['timestamp'] > last]
+
+        if len(records) == 0:
+            return 0
+
+        is_new = not os.path.isfile(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'ab') as file:
+            if is_new:
+                file.write(_HEADER)
+
+            file.write(np.ascontiguousarray(records, dtype=OHLC_RECORD_DTYPE).tobytes())
+
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+
+        # the mapping only covers the previous size of the file
+        self._map = None
+        self._length = len(self) + len(records)
+        return len(records)
+
+    def last(self) -> Optional[np.void]:
+        records = self.view()
+        return records[-1] if len(records) > 0 else None
+
+    def last_timestamp(self) -> Optional[int]:
+        last = self.last()
+        return int(last['timestamp']) if last is not None else None
+
+    def search(self, timestamp: int, side: str = 'left') -> int:
+        """
+        :return: the index where a record with the given timestamp is, or would be inserted. With side='right'
+        the index after the records with that timestamp
+        """
+        return int(np.searchsorted(self.view()['timestamp'], timestamp, side=side))
+
+    def range(self, start: Optional[int] = None, end: Optional[int] = None) -> np.ndarray:
+        """
+        :return: a read only view of the records with timestamp in [start, end). None means no limit
+        """
+        first = self.search(start) if start is not None else 0
+        last = self.search(end) if end is not None else len(self)
+        return self.view()[first:last]
+
+    def view(self) -> np.ndarray:
+        """
+        :return: all the records as a read only array backed by the file
+        """
+        if len(self) == 0:
+            return np.empty(0, dtype=OHLC_RECORD_DTYPE)
+
+        if self._map is None:
+            self._map = np.memmap(self.path, dtype=OHLC_RECORD_DTYPE, mode='r', offset=len(_HEADER),
+                                  shape=(len(self),))
+
+        return self._map
+
+    def close(self) -> None:
+        self._map = None
+        self._length = None
+
+    def _read_length(self) -> int:
+        if not os.path.isfile(self.path) or os.path.getsize(self.path) == 0:
+            return 0
+
+        with open(self.path, 'rb') as file:
+            header = file.read(len(_HEADER))
+
+        if header != _HEADER:
+            raise ValueError('{} is not an ohlc binary store with records of {} bytes'
+                             .format(self.path, OHLC_RECORD_DTYPE.itemsize))
+
+        data_size = os.path.getsize(self.path) - len(_HEADER)
+        length = data_size // OHLC_RECORD_DTYPE.itemsize
+
+        if data_size % OHLC_RECORD_DTYPE.itemsize != 0:
+            # a write interrupted in the middle of a record. The incomplete record is discarded
+            os.truncate(self.path, len(_HEADER) + length * OHLC_RECORD_DTYPE.itemsize)
+
+        return length
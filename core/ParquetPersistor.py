@@ -0,0 +1,257 @@
+import os
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import numpy as np
+
+from config import BaseConfig
+from core.BasePersistor import BasePersistor, Frames, Entries
+from core.Enums import Mnemonic
+from core.model.CoreModels import OhlcBatch, TradesEntry, OHLC_DTYPE
+from core.model.models import OHLC
+from core.utils import map_frame_to_ohlc
+
+_COLUMNS = ('date', 'open', 'high', 'low', 'close', 'volume')
+
+
+def _import_pyarrow():
+    """
+    pyarrow is only needed by this persistor, so it is imported when it is used instead of being a
+    requirement of the whole project
+    """
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError('The parquet persistor needs pyarrow. Install it with: pip install pyarrow') from e
+
+    return pyarrow
+
+
+class ParquetPersistor(BasePersistor):
+    """
+    Stores the hourly ohlc in parquet files partitioned by exchange, market and month:
+    {path}/{exchange}/{market}/{yyyy-mm}.parquet. The columns are typed (date as int64 seconds since the
+    epoch, prices and volume as float64) and each file is sorted by date, so reading a date range opens only
+    the files of its months and skips the row groups whose date statistics are out of the range.
+    The dates are stored as they come, without timezone, like the ohlc table does. Only the ohlc is stored,
+    the trades are resampled into frames before persisting them
+    """
+
+    def __init__(self, exchange: str, path: str = BaseConfig.Parquet.path,
+                 row_group_size: int = BaseConfig.Parquet.row_group_size):
+        super().__init__()
+        self.pa = _import_pyarrow()
+        self.exchange: str = exchange
+        self.path: str = path
+        self.row_group_size: int = row_group_size
+        self.schema = self.pa.schema([('date', self.pa.int64())] +
+                                     [(column, self.pa.float64()) for column in _COLUMNS[1:]])
+
+    def persist_ohlc(self, tick_list: Frames, nemo: Mnemonic) -> None:
+        to_update, new = self.merge_ohlc_with_last(tick_list, nemo)
+        batch = _to_batch(new)
+
+        if to_update is not None:
+            # the last stored frame, with the first new one merged into it, is rewritten along with the rest
+            batch = OhlcBatch(np.concatenate((_to_batch([to_update]).data, batch.data)))
+
+        try:
+            self._write(batch, nemo)
+        except Exception as e:
+            self.invalidate_newest_ohlc(nemo)
+            raise e
+
+        self._set_newest_ohlc(nemo, to_update, new)
+
+    def persist_entry(self, entry_list: Entries, nemo: Mnemonic) -> None:
+        self.persist_ohlc(self.trades_to_ohlc(entry_list), nemo)
+
+    def upsert_ohlc(self, tick_list: Frames, nemo: Mnemonic) -> None:
+        try:
+            self._write(_to_batch(tick_list), nemo)
+        finally:
+            # the upserted frames may be newer than the cached one, or overwrite it
+            self.invalidate_newest_ohlc(nemo)
+
+    def get_newest_trade(self, nemo: Mnemonic) -> Optional[TradesEntry]:
+        return None
+
+    def read_ohlc(self, nemo: Mnemonic, start: Optional[datetime] = None,
+                  end: Optional[datetime] = None) -> OhlcBatch:
+        """
+        Reads the stored frames with date in [start, end). Only the files of the months in the range are
+        opened, and inside them only the row groups that can contain dates of the range are read
+        :param nemo: market to read
+        :param start: first date to read. None to read from the beginning
+        :param end: date where the reading stops (excluded). None to read until the end
+        :return: the frames, sorted by date
+        """
+        first = _to_month(start) if start is not None else None
+        last = _to_month(end) if end is not None else None
+        files = [path for month, path in self._get_partitions(nemo)
+                 if (first is None or month >= first) and (last is None or month <= last)]
+
+        if len(files) == 0:
+            return OhlcBatch()
+
+        date = self.pa.dataset.field('date')
+        condition = None
+        if start is not None:
+            condition = date >= _to_epoch(start)
+        if end is not None:
+            condition = date < _to_epoch(end) if condition is None else condition & (date < _to_epoch(end))
+
+        dataset = self.pa.dataset.dataset(files, schema=self.schema, format='parquet')
+        return _table_to_batch(dataset.to_table(filter=condition))
+
+    def _get_newest_ohlc_dto(self, nemo: Mnemonic) -> Optional[OHLC]:
+        return self._get_edge_ohlc(nemo, -1)
+
+    def _get_oldest_ohlc_dto(self, nemo: Mnemonic) -> Optional[OHLC]:
+        return self._get_edge_ohlc(nemo, 0)
+
+    def _get_edge_ohlc(self, nemo: Mnemonic, index: int) -> Optional[OHLC]:
+        partitions = self._get_partitions(nemo)
+        if len(partitions) == 0:
+            return None
+
+        batch = self._read_partition(partitions[index][1])
+        return map_frame_to_ohlc(batch[index]) if len(batch) > 0 else None
+
+    def _write(self, batch: OhlcBatch, nemo: Mnemonic) -> None:
+        """
+        Writes the frames in the files of their months, overwriting the stored frames with the same date.
+        Each file is replaced atomically, so a failure never leaves a partition half written
+        """
+        if len(batch) == 0:
+            return
+
+        folder = self._get_market_path(nemo)
+        os.makedirs(folder, exist_ok=True)
+
+        months = batch.dates.astype(np.int64).astype('M8[s]').astype('M8[M]')
+        for month in np.unique(months):
+            path = os.path.join(folder, '{}.parquet'.format(month))
+            data = batch.data[months == month]
+
+            if os.path.isfile(path):
+                data = np.concatenate((self._read_partition(path).data, data))
+
+            data = _sort_and_deduplicate(data)
+            tmp_path = path + '.tmp'
+            self.pa.parquet.write_table(self._to_table(data), tmp_path, row_group_size=self.row_group_size)
+            os.replace(tmp_path, path)
+
+    def _read_partition(self, path: str) -> OhlcBatch:
+        return _table_to_batch(self.pa.parquet.read_table(path))
+
+    def _get_partitions(self, nemo: Mnemonic) -> List[tuple]:
+        """
+        :return: (yyyy-mm, path) of the files of the market, sorted by month
+        """
+        folder = self._get_market_path(nemo)
+        if not os.path.isdir(folder):
+            return []
+
+        names = sorted(name for name in os.listdir(folder) if name.endswith('.parquet'))
+        return [(name[:-len('.parquet')], os.path.join(folder, name)) for name in names]
+
+    def _get_market_path(self, nemo: Mnemonic) -> str:
+        return os.path.join(self.path, self.exchange, nemo.value)
+
+    def _to_table(self, data: np.ndarray):
+        arrays = [self.pa.array(data['date'].astype(np.int64))]
+        arrays += [self.pa.array(data[column]) for column in _COLUMNS[1:]]
+        return self.pa.Table.from_arrays(arrays, schema=self.schema)
+
+
+def convert_csv(csv_path: str, persistor: ParquetPersistor, nemo: Mnemonic) -> int:
+    """
+    Stores the ohlc of a csv created by the csv persistors in parquet. Understands the columns of the
+    three of them: time/volumefrom (crypto compare), date/volume (buda) and timestamp/volume (kraken).
+    A .ohlc file, the binary store where kraken keeps its ohlc, is read as well
+    :param csv_path: path of the csv or .ohlc file
+    :param persistor: where the frames are stored
+    :param nemo: market of the file
+    :return: the number of frames converted
+    """
+    if csv_path.endswith('.ohlc'):
+        return _convert_binary_store(csv_path, persistor, nemo)
+
+    import pandas as pd
+
+    stored = pd.read_csv(csv_path)
+    volume = 'volumefrom' if 'volumefrom' in stored.columns else 'volume'
+
+    if 'time' in stored.columns:
+        dates = stored['time'].to_numpy(dtype=np.int64)
+    elif 'timestamp' in stored.columns:
+        dates = stored['timestamp'].to_numpy(dtype=np.int64)
+    elif 'date' in stored.columns:
+        dates = pd.to_datetime(stored['date']).to_numpy().astype('M8[s]').astype(np.int64)
+    else:
+        raise ValueError('{} has no date column. Expected one of: time, timestamp, date'.format(csv_path))
+
+    data = np.empty(len(stored), dtype=OHLC_DTYPE)
+    data['date'] = dates
+    for column in _COLUMNS[1:-1]:
+        data[column] = stored[column].to_numpy(dtype=np.float64)
+    data['volume'] = stored[volume].to_numpy(dtype=np.float64)
+
+    persistor.upsert_ohlc(OhlcBatch(data), nemo)
+    return len(data)
+
+
+def _convert_binary_store(path: str, persistor: ParquetPersistor, nemo: Mnemonic) -> int:
+    from core.OhlcBinaryStore import OhlcBinaryStore
+
+    store = OhlcBinaryStore(path)
+    records = store.view()
+
+    data = np.empty(len(records), dtype=OHLC_DTYPE)
+    data['date'] = records['timestamp']
+    for column in _COLUMNS[1:]:
+        data[column] = records[column]
+
+    store.close()
+    persistor.upsert_ohlc(OhlcBatch(data), nemo)
+    return len(data)
+
+
+def _to_batch(tick_list: Frames) -> OhlcBatch:
+    return tick_list if isinstance(tick_list, OhlcBatch) else OhlcBatch.from_frames(list(tick_list))
+
+
+def _table_to_batch(table) -> OhlcBatch:
+    data = np.empty(table.num_rows, dtype=OHLC_DTYPE)
+    for column in _COLUMNS:
+        data[column] = table.column(column).to_numpy()
+
+    return OhlcBatch(data)
+
+
+def _sort_and_deduplicate(data: np.ndarray) -> np.ndarray:
+    """
+    Sorts the frames by date, keeping only the last one of the frames with the same date
+    """
+    data = data[np.argsort(data['date'], kind='stable')]
+    is_last = np.append(data['date'][1:] != data['date'][:-1], True)
+    return data[is_last]
+
+
+def _to_naive_utc(date: datetime) -> datetime:
+    # the dates with timezone are stored as seconds since the epoch in utc, the naive ones as they come
+    if date.tzinfo is None:
+        return date
+
+    return date.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _to_month(date: datetime) -> str:
+    return _to_naive_utc(date).strftime('%Y-%m')
+
+
+def _to_epoch(date: datetime) -> int:
+    return int(OhlcBatch().to_epoch(_to_naive_utc(date)))
@@ -0,0 +1,219 @@
+import asyncio
+import random
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Tuple
+
+from config import BaseConfig
+
+
+class TokenBucket:
+    """
+    Token bucket that limits the requests sent to an exchange. The bucket refills at rate tokens per second up
+    to capacity tokens, and each request takes one. When the bucket is empty the token is borrowed from the
+    future and the caller waits until it refills, so the time spent on the request itself is discounted from
+    the wait instead of sleeping a fixed time after it.
+
+    When state_path is set, the bucket lives in a sqlite file, so every process using the same name and
+    path shares the same budget. Otherwise it is shared only by the threads and coroutines of this process.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: float, state_path: Optional[str] = None):
+        if rate <= 0 or capacity < 1:
+            raise ValueError('rate should be greater than 0 and capacity at least 1')
+
+        self.name: str = name
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.state_path: Optional[str] = state_path
+        self._tokens: float = capacity
+        self._updated: float = time.time()
+        self._lock = threading.Lock()
+
+        if state_path is not None:
+            connection = sqlite3.connect(state_path, timeout=30)
+            try:
+                with connection:
+                    connection.execute('CREATE TABLE IF NOT EXISTS buckets '
+                                       '(name TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            finally:
+                connection.close()
+
+    def reserve(self) -> float:
+        """
+        Takes a token from the bucket without waiting
+        :return: seconds the caller should wait before sending the request
+        """
+        with self._lock:
+            if self.state_path is None:
+                self._tokens, self._updated, wait = self._take(self._tokens, self._updated)
+                return wait
+
+            return self._reserve_shared()
+
+    def acquire(self) -> float:
+        """
+        Blocks until a token is available
+        :return: seconds waited
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+    async def acquire_async(self) -> float:
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        return wait
+
+    def _take(self, tokens: float, updated: float) -> Tuple[float, float, float]:
+        # wall clock instead of a monotonic one, since the state may be shared with other processes
+        now = time.time()
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate) - 1
+        wait = -tokens / self.rate if tokens < 0 else 0.0
+        return tokens, now, wait
+
+    def _reserve_shared(self) -> float:
+        connection = sqlite3.connect(self.state_path, timeout=30, isolation_level=None)
+        try:
+            # takes the write lock before reading, so two processes cannot take the same token
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (self.name,)).fetchone()
+            tokens, updated = row if row is not None else (self.capacity, time.time())
+
+            tokens, updated, wait = self._take(tokens, updated)
+            connection.execute('INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)',
+                               (self.name, tokens, updated))
+            connection.execute('COMMIT')
+            return wait
+        finally:
+            connection.close()
+
+
+class RetryableResponseError(ConnectionError):
+    """
+    A response that may succeed if the request is sent again later (408, 429 or 5xx). Like the ConnectionError
+    raised before for any response that was not a 200, the status code is the first argument
+    """
+
+    def __init__(self, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(status_code)
+        self.status_code: int = status_code
+        self.retry_after: Optional[float] = retry_after  # seconds asked by the Retry-After header, if any
+
+
+class ResponseError(Exception):
+    """
+    A response that will fail the same way each time the request is sent, e.g. a 401 or 403 of a wrong api key
+    or a 404 of a wrong url. It is not a ConnectionError, so the loops that retry the requests let it go up
+    """
+
+    def __init__(self, status_code: int):
+        super().__init__(status_code)
+        self.status_code: int = status_code
+
+
+def _is_retryable(status_code: int) -> bool:
+    return status_code in (408, 429) or 500 <= status_code < 600
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    :param value: the Retry-After header, either seconds or an http date
+    :return: seconds to wait, None if there is no header or it cannot be parsed
+    """
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def check_response(response) -> None:
+    """
+    Raises RetryableResponseError or ResponseError if the status of the response is not 200
+    """
+    if response.status_code == 200:
+        return
+
+    if _is_retryable(response.status_code):
+        headers = getattr(response, 'headers', None) or {}
+        raise RetryableResponseError(response.status_code, _parse_retry_after(headers.get('Retry-After')))
+
+    raise ResponseError(response.status_code)
+
+
+class ExponentialBackoff:
+    """
+    Wait times for the retries after a failed request (429, 5xx or network errors). Each consecutive failure
+    doubles the wait up to max_sec, with a random jitter so many clients do not retry at the same time. When
+    the server says how long to wait (the Retry-After header, see check_response), it waits at least that.
+    """
+
+    def __init__(self, base_sec: float = BaseConfig.RateLimit.backoff_base_sec,
+                 max_sec: float = BaseConfig.RateLimit.backoff_max_sec):
+        self.base_sec: float = base_sec
+        self.max_sec: float = max_sec
+        self.attempts: int = 0
+
+    def next_delay(self, error: Optional[Exception] = None) -> float:
+        """
+        :param error: the error of the failed request. Its retry_after, if it has one, is the minimum delay
+        """
+        delay = min(self.max_sec, self.base_sec * 2 ** self.attempts)
+        self.attempts += 1
+        delay = delay / 2 + random.uniform(0, delay / 2)
+
+        retry_after = getattr(error, 'retry_after', None)
+        return delay if retry_after is None else max(delay, retry_after)
+
+    def wait(self, error: Optional[Exception] = None) -> float:
+        delay = self.next_delay(error)
+        time.sleep(delay)
+        return delay
+
+    def reset(self) -> None:
+        self.attempts = 0
+
+
+_buckets: Dict[str, TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def get_rate_limiter(exchange: str, min_interval_sec: Optional[float] = None) -> TokenBucket:
+    """
+    Returns the token bucket of the exchange, shared by all the integrations of this process (and of the other
+    processes too when BaseConfig.RateLimit.state_path is set)
+    :param exchange: name of the exchange config in BaseConfig.Exchanges, e.g. 'Kraken'
+    :param min_interval_sec: seconds between requests, usually the sleep_time_sec of the json config of the
+    integration. When given, it replaces requests_per_sec and burst of BaseConfig: a request each
+    min_interval_sec at most, with no burst
+    """
+    if min_interval_sec is not None and min_interval_sec > 0:
+        rate, capacity = 1 / min_interval_sec, 1
+    else:
+        exchange_config = getattr(BaseConfig.Exchanges, exchange)
+        rate, capacity = exchange_config.requests_per_sec, exchange_config.burst
+
+    with _buckets_lock:
+        bucket = _buckets.get(exchange)
+        if bucket is None:
+            bucket = TokenBucket(exchange, rate, capacity, BaseConfig.RateLimit.state_path)
+            _buckets[exchange] = bucket
+        elif min_interval_sec is not None:
+            # the config changed since the bucket was created
+            bucket.rate, bucket.capacity = rate, capacity
+
+        return bucket
@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Optional, Any, Hashable, Deque, Dict, List
+
+logger = logging.getLogger('FortacrypLogger')
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+_POLICIES = (BLOCK, DROP_OLDEST, COALESCE)
+
+
+@dataclass
+class QueueMetrics:
+    depth: int = 0  # items waiting right now
+    max_depth: int = 0
+    processed: int = 0
+    dropped: int = 0  # discarded by drop_oldest, or not enqueued because put timed out
+    coalesced: int = 0  # merged into an item that was already waiting
+    errors: int = 0  # items whose consumer raised an exception
+    lag: float = 0.0  # seconds between the put and the end of the processing of the last item
+    max_lag: float = 0.0
+
+
+class WriteBehindQueue:
+    """
+    Bounded queue with a dedicated writer thread that passes every item to the consumer, so the producer (e.g. the
+    thread that reads a socket) never waits for the disk or the database. When the queue is full, the policy
+    decides what happens with a new item:
+
+    - block: the producer waits until the writer makes room (or until the timeout of put).
+    - drop_oldest: the oldest waiting item is discarded.
+    - coalesce: an item with the same key than a waiting one is merged into it with the coalesce function (into
+      the last waiting one of the key). Blocks as the first policy when there is no waiting item to merge it into.
+      While the queue has room every item is enqueued as it is, so the items are only merged when the writer
+      cannot keep up. coalesce_key may return None for an item that must never be merged.
+
+    queue = WriteBehindQueue(persist, maxsize=1000, policy='drop_oldest')
+    queue.start()
+    queue.put(item)
+    queue.stop()  # processes the waiting items before returning
+    """
+
+    def __init__(self, consumer: Callable[[Any], None], maxsize: int = 1000, policy: str = BLOCK,
+                 coalesce_key: Optional[Callable[[Any], Hashable]] = None,
+                 coalesce: Optional[Callable[[Any, Any], Any]] = None, name: str = 'write-behind'):
+        if policy not in _POLICIES:
+            raise ValueError('Unknown policy {}. Policies: {}'.format(policy, _POLICIES))
+
+        if policy == COALESCE and (coalesce_key is None or coalesce is None):
+            raise ValueError('The coalesce policy needs the coalesce_key and coalesce functions')
+
+        if maxsize <= 0:
+            raise ValueError('maxsize should be greater than 0')
+
+        self.consumer = consumer
+        self.maxsize: int = maxsize
+        self.policy: str = policy
+        self.coalesce_key = coalesce_key
+        self.coalesce = coalesce
+        self.name: str = name
+        self.metrics: QueueMetrics = QueueMetrics()
+        self.logger = logger
+        self._items: Deque[List] = deque()  # [key, item, time of the put]
+        self._waiting: Dict[Hashable, List] = {}  # waiting entry of each key, with the coalesce policy
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping: bool = False
+        self._is_full_logged: bool = False
+
+    def start(self) -> None:
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def put(self, item: Any, timeout: Optional[float] = None, barrier: bool = False) -> bool:
+        """
+        Enqueues the item for the writer thread
+        :param item: passed to the consumer as it is
+        :param timeout: seconds to wait for room in the queue when the policy blocks. None waits forever
+        :param barrier: the item is never coalesced, and the items put after it are not merged into the ones
+        waiting before it, so the consumer receives them after this item
+        :return: False if the queue was still full after the timeout and the item was discarded
+        """
+        with self._condition:
+            if self._stopping:
+                raise RuntimeError('Queue {} is stopped'.format(self.name))
+
+            key = self.coalesce_key(item) if self.policy == COALESCE and not barrier else None
+            coalesces = key is not None
+
+            if len(self._items) >= self.maxsize:
+                self._on_full()
+                entry = self._waiting.get(key) if coalesces else None
+
+                if entry is not None:
+                    entry[1] = self.coalesce(entry[1], item)
+                    self.metrics.coalesced += 1
+                    return True
+
+                if self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.metrics.dropped += 1
+
+                elif not self._condition.wait_for(lambda: len(self._items) < self.maxsize or self._stopping, timeout):
+                    self.metrics.dropped += 1
+                    return False
+
+                elif self._stopping:
+                    raise RuntimeError('Queue {} was stopped while waiting for room'.format(self.name))
+
+            entry = [key, item, time.monotonic()]
+            self._items.append(entry)
+            if coalesces:
+                self._waiting[key] = entry
+            elif barrier:
+                self._waiting.clear()
+
+            self.metrics.depth = len(self._items)
+            self.metrics.max_depth = max(self.metrics.max_depth, self.metrics.depth)
+            self._condition.notify_all()
+
+        return True
+
+    def stop(self, drain: bool = True, timeout: Optional[float] = None) -> None:
+        """
+        Stops the writer thread
+        :param drain: processes the waiting items before stopping. Otherwise they are discarded
+        :param timeout: seconds to wait for the writer thread
+        """
+        with self._condition:
+            self._stopping = True
+            if not drain:
+                self.metrics.dropped += len(self._items)
+                self._items.clear()
+                self._waiting.clear()
+
+            self._condition.notify_all()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._items) > 0 or self._stopping)
+                if len(self._items) == 0:
+                    return
+
+                key, item, put_at = entry = self._items.popleft()
+                if self._waiting.get(key) is entry:
+                    del self._waiting[key]
+
+                self.metrics.depth = len(self._items)
+                if self.metrics.depth == 0:
+                    self._is_full_logged = False
+
+                # there is room for the producers waiting on a full queue
+                self._condition.notify_all()
+
+            try:
+                self.consumer(item)
+            except Exception as e:
+                self.metrics.errors += 1
+                self.logger.error('{}: error processing an item: {}'.format(self.name, repr(e)))
+
+            self.metrics.processed += 1
+            self.metrics.lag = time.monotonic() - put_at
+            self.metrics.max_lag = max(self.metrics.max_lag, self.metrics.lag)
+
+    def _on_full(self) -> None:
+        # logged once per episode instead of once per item. The episode ends when the writer empties the queue
+        if not self._is_full_logged:
+            self._is_full_logged = True
+            self.logger.warning('{}: queue full ({} items), applying policy {}. Metrics: {}'
+                                .format(self.name, self.maxsize, self.policy, self.metrics))
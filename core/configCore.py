@@ -24,6 +24,7 @@ _config = {
             'first_stored_timestamp': None,
             'current_request_timestamp': None,
             'recovered_all': False,
+            'backfilled_shards': [],
             'market_id': 'btc'
         },
         'ltc': {
@@ -32,6 +33,7 @@ _config = {
             'first_stored_timestamp': None,
             'current_request_timestamp': None,
             'recovered_all': False,
+            'backfilled_shards': [],
             'market_id': 'ltc'
         },
         'eth': {
@@ -40,6 +42,7 @@ _config = {
             'first_stored_timestamp': None,
             'current_request_timestamp': None,
             'recovered_all': False,
+            'backfilled_shards': [],
             'market_id': 'eth'
         },
         'bch': {
@@ -48,6 +51,7 @@ _config = {
             'first_stored_timestamp': None,
             'current_request_timestamp': None,
             'recovered_all': False,
+            'backfilled_shards': [],
             'market_id': 'bch'
         }
     },
@@ -63,6 +67,7 @@ _config = {
             'first_stored_timestamp': None,
             'current_request_timestamp': None,
             'recovered_all': False,
+            'backfilled_shards': [],
             'market_id': 'btc'
         },
         'bch': {
@@ -71,6 +76,7 @@ _config = {
             'first_stored_timestamp': None,
             'current_request_timestamp': None,
             'recovered_all': False,
+            'backfilled_shards': [],
             'market_id': 'bch'
         },
         'eth': {
@@ -79,6 +85,7 @@ _config = {
             'first_stored_timestamp': None,
             'current_request_timestamp': None,
             'recovered_all': False,
+            'backfilled_shards': [],
             'market_id': 'eth'
         },
         'ltc': {
@@ -87,6 +94,7 @@ _config = {
             'first_stored_timestamp': None,
             'current_request_timestamp': None,
             'recovered_all': False,
+            'backfilled_shards': [],
             'market_id': 'ltc'
         }
     }
@@ -102,7 +110,8 @@ class MarketConfig:
 
     def __init__(self, market_id: str, most_recent_timestamp: int = None,
                  current_request_timestamp: int = None, first_stored_timestamp: int = None,
-                 recovered_all: bool = False, last_stored_timestamp: int = None):
+                 recovered_all: bool = False, last_stored_timestamp: int = None,
+                 backfilled_shards: list = None):
         """
         init the config
         :param market_id: the cryptocurrency name in short format e.g. 'btc'
@@ -115,6 +124,8 @@ class MarketConfig:
         :param recovered_all: boolean indicating if we have recovered all data previously
         :param last_stored_timestamp: most recent timestamp that has been stored from a successfully
         ended process
+        :param backfilled_shards: starting timestamp of the time windows already persisted by a backfill,
+        so an aborted backfill can be resumed without requesting them again
         """
         self.last_stored_timestamp: int = last_stored_timestamp
         self.most_recent_timestamp: int = most_recent_timestamp
@@ -122,6 +133,7 @@ class MarketConfig:
         self.current_request_timestamp: int = current_request_timestamp
         self.market_id: str = market_id
         self.recovered_all: bool = recovered_all
+        self.backfilled_shards: list = list(backfilled_shards) if backfilled_shards is not None else []
 
     def to_dict(self):
         return self.__dict__
@@ -1,6 +1,16 @@
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timedelta, tzinfo
+from typing import Optional, List, Iterator, Union, Any, Dict
+
+import numpy as np
+
+# compact hourly ohlc, one row per candle. date is the close of the frame as seconds since the epoch
+OHLC_DTYPE = np.dtype([('date', 'f8'), ('open', 'f8'), ('high', 'f8'), ('low', 'f8'), ('close', 'f8'),
+                       ('volume', 'f8')])
+# same width than the direction column of the trades table
+TRADE_DTYPE = np.dtype([('date', 'f8'), ('price', 'f8'), ('volume', 'f8'), ('direction', 'U10')])
+
+_EPOCH = datetime(1970, 1, 1)
 
 
 @dataclass
@@ -37,3 +47,140 @@ class TradesEntry:
             'direction': self.direction,
             'date': self.date
         }
+
+
+class _ArrayBatch:
+    """
+    List like container backed by a structured numpy array, one row per element. Slicing (or filtering with
+    a boolean mask) returns a batch that shares the memory of this one, and the rows are only turned into
+    objects when iterating or indexing a single element. The dates are stored as seconds since the epoch,
+    taken in the timezone of the batch, so that it can be restored when mapping the rows back to datetimes
+    """
+    dtype: np.dtype = None
+
+    def __init__(self, data: np.ndarray = None, tz: Optional[tzinfo] = None):
+        self.data: np.ndarray = data if data is not None else np.empty(0, dtype=self.dtype)
+        self.tz: Optional[tzinfo] = tz
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, item: Union[int, slice, np.ndarray]):
+        if isinstance(item, (int, np.integer)):
+            return self._row_to_item(self.data[item].tolist())
+
+        return type(self)(self.data[item], self.tz)
+
+    def __iter__(self) -> Iterator:
+        # converts the rows in blocks, so iterating doesnt duplicate the whole batch as python objects
+        for start in range(0, len(self.data), 4096):
+            for row in self.data[start:start + 4096].tolist():
+                yield self._row_to_item(row)
+
+    @property
+    def dates(self) -> np.ndarray:
+        return self.data['date']
+
+    def to_epoch(self, date: datetime) -> float:
+        return (date - self._epoch_start()).total_seconds()
+
+    def to_datetime(self, epoch: float) -> datetime:
+        return self._epoch_start() + timedelta(seconds=epoch)
+
+    def since(self, date: datetime):
+        """
+        :return: a batch with the elements with date greater or equal than the given one
+        """
+        return self[self.dates >= self.to_epoch(date)]
+
+    def _epoch_start(self) -> datetime:
+        return _EPOCH.replace(tzinfo=self.tz)
+
+    def _datetimes(self) -> List[datetime]:
+        epoch_start = self._epoch_start()
+        return [epoch_start + timedelta(seconds=epoch) for epoch in self.dates.tolist()]
+
+    def _row_to_item(self, row: tuple):
+        raise NotImplementedError()
+
+
+class OhlcBatch(_ArrayBatch):
+    """
+    Array backed list of OhlcFrame. Uses 48 bytes per frame, against the hundreds that takes a dataclass
+    with its dict, floats and datetime
+    """
+    dtype = OHLC_DTYPE
+
+    @classmethod
+    def from_frames(cls, frames: List[OhlcFrame]) -> 'OhlcBatch':
+        if len(frames) == 0:
+            return cls()
+
+        batch = cls(np.empty(len(frames), dtype=OHLC_DTYPE), frames[0].date.tzinfo)
+        epoch_start = batch._epoch_start()
+        batch.data['date'] = [(frame.date - epoch_start).total_seconds() for frame in frames]
+        batch.data['open'] = [frame.open for frame in frames]
+        batch.data['high'] = [frame.high for frame in frames]
+        batch.data['low'] = [frame.low for frame in frames]
+        batch.data['close'] = [frame.close for frame in frames]
+        batch.data['volume'] = [frame.volume for frame in frames]
+        return batch
+
+    def to_frames(self) -> List[OhlcFrame]:
+        return list(self)
+
+    def to_rows(self, exchange_id: int, currency_id: int) -> List[Dict[str, Any]]:
+        """
+        Maps the frames into dicts with the columns of the ohlc table, converting each column at once
+        """
+        columns = zip(self.data['open'].tolist(), self.data['high'].tolist(), self.data['low'].tolist(),
+                      self.data['close'].tolist(), self.data['volume'].tolist(), self._datetimes())
+
+        return [{'open': open_price, 'high': high, 'low': low, 'close': close, 'volume': volume, 'date': date,
+                 'exchange_id': exchange_id, 'currency_id': currency_id}
+                for open_price, high, low, close, volume, date in columns]
+
+    def _row_to_item(self, row: tuple) -> OhlcFrame:
+        date, open_price, high, low, close, volume = row
+        return OhlcFrame(open=open_price, high=high, low=low, close=close, volume=volume,
+                         date=self.to_datetime(date))
+
+
+class TradeBatch(_ArrayBatch):
+    """
+    Array backed list of TradesEntry, sorted by date
+    """
+    dtype = TRADE_DTYPE
+
+    @classmethod
+    def from_entries(cls, entries: List[TradesEntry]) -> 'TradeBatch':
+        if len(entries) == 0:
+            return cls()
+
+        batch = cls(np.empty(len(entries), dtype=TRADE_DTYPE), entries[0].date.tzinfo)
+        epoch_start = batch._epoch_start()
+        count = len(entries)
+        batch.data['date'] = np.fromiter(((entry.date - epoch_start).total_seconds() for entry in entries),
+                                         np.float64, count)
+        batch.data['price'] = np.fromiter((entry.price for entry in entries), np.float64, count)
+        batch.data['volume'] = np.fromiter((entry.volume for entry in entries), np.float64, count)
+        batch.data['direction'] = [entry.direction for entry in entries]
+        return batch
+
+    def to_entries(self) -> List[TradesEntry]:
+        return list(self)
+
+    def to_rows(self, exchange_id: int, currency_id: int) -> List[Dict[str, Any]]:
+        """
+        Maps the trades into dicts with the columns of the trades table, converting each column at once
+        """
+        columns = zip(self.data['price'].tolist(), self.data['volume'].tolist(), self.data['direction'].tolist(),
+                      self._datetimes())
+
+        return [{'price': price, 'volume': volume, 'direction': direction, 'date': date,
+                 'exchange_id': exchange_id, 'currency_id': currency_id}
+                for price, volume, direction, date in columns]
+
+    def _row_to_item(self, row: tuple) -> TradesEntry:
+        date, price, volume, direction = row
+        return TradesEntry(price=price, volume=volume, direction=direction, date=self.to_datetime(date))
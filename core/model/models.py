@@ -1,13 +1,19 @@
 from datetime import datetime
 from typing import Optional
 
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Float, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Float, DateTime, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.dynamic import AppenderQuery
 
 from config import BaseConfig
 from core.orm.orm import Base
 
+# columns that identify a row, used by the unique indexes and by the upserts on conflict.
+# Both start with (exchange_id, currency_id, date), so the same index serves the newest/oldest lookups
+OHLC_UNIQUE_COLUMNS = ('exchange_id', 'currency_id', 'date')
+# many trades can share the same timestamp, so the whole trade is used to recognize a duplicated one
+TRADES_UNIQUE_COLUMNS = ('exchange_id', 'currency_id', 'date', 'price', 'volume', 'direction')
+
 
 class Exchange(Base):
     __tablename__ = BaseConfig.DBNames.exchange
@@ -41,6 +47,7 @@ class CryptoCurrency(Base):
 
 class OHLC(Base):
     __tablename__ = BaseConfig.DBNames.ohlc
+    __table_args__ = (Index('ix_ohlc_exchange_currency_date', *OHLC_UNIQUE_COLUMNS, unique=True),)
 
     id_frame: int = Column(Integer, primary_key=True)
     open: float = Column(Float)
@@ -74,6 +81,7 @@ class OHLC(Base):
 
 class Trades(Base):
     __tablename__ = BaseConfig.DBNames.trades
+    __table_args__ = (Index('ix_trades_exchange_currency_date', *TRADES_UNIQUE_COLUMNS, unique=True),)
 
     id_trade: int = Column(Integer, primary_key=True)
     price: float = Column(Float)
@@ -0,0 +1,101 @@
+import csv
+import io
+from typing import List, Dict, Any, Sequence, Optional, Tuple
+
+from sqlalchemy import Table
+from sqlalchemy.engine.interfaces import Dialect
+from sqlalchemy.orm import Session
+
+from .upsert import build_upsert
+
+# temporary table where the rows are copied before being inserted ignoring the conflicts
+STAGING_TABLE = 'bulk_staging'
+
+
+def bulk_insert(session: Session, table: Table, rows: List[Dict[str, Any]],
+                conflict_columns: Optional[Sequence[str]] = None) -> None:
+    """
+    Inserts the rows in the fastest way the database allows: COPY FROM STDIN with postgres (psycopg2), and a
+    single executemany with the rest of them. Doesnt commit, so the caller decides the size of the transactions
+    :param session: session where the rows are inserted
+    :param table: the table where rows are inserted
+    :param rows: dicts with the same keys, the columns to insert
+    :param conflict_columns: columns of a unique constraint of the table. If given, the rows that collide with
+    a stored one (or with a previous row of the list) are ignored instead of failing the whole insert.
+    With postgres the rows are copied into a temporary table, and inserted from it with ON CONFLICT DO NOTHING
+    """
+    if len(rows) == 0:
+        return
+
+    dialect = session.bind.dialect
+    if dialect.name == 'postgresql' and dialect.driver == 'psycopg2':
+        _copy_rows(session, table, rows, conflict_columns)
+    elif conflict_columns is not None:
+        session.execute(build_upsert(table, conflict_columns, (), dialect.name), rows)
+    else:
+        session.execute(table.insert(), rows)
+
+
+def _copy_rows(session: Session, table: Table, rows: List[Dict[str, Any]],
+               conflict_columns: Optional[Sequence[str]]) -> None:
+    columns = list(rows[0].keys())
+    dialect = session.bind.dialect
+
+    # runs on the connection of the session, so the rows are part of its transaction
+    cursor = session.connection().connection.cursor()
+    try:
+        if conflict_columns is None:
+            cursor.copy_expert(copy_statement(dialect, _format_table(dialect, table), columns),
+                               rows_to_csv(rows, columns))
+        else:
+            create, copy, insert, drop = staging_statements(dialect, table, columns, conflict_columns)
+            cursor.execute(create)
+            cursor.copy_expert(copy, rows_to_csv(rows, columns))
+            cursor.execute(insert)
+            cursor.execute(drop)
+    finally:
+        cursor.close()
+
+
+def copy_statement(dialect: Dialect, table_name: str, columns: Sequence[str]) -> str:
+    """
+    :return: the COPY FROM STDIN statement that reads the csv written by rows_to_csv into the columns
+    """
+    preparer = dialect.identifier_preparer
+    return 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        table_name, ', '.join(preparer.quote(column) for column in columns))
+
+
+def staging_statements(dialect: Dialect, table: Table, columns: Sequence[str],
+                       conflict_columns: Sequence[str]) -> Tuple[str, str, str, str]:
+    """
+    :return: the statements that create a temporary table with only the given columns (so the sequence of
+    the primary key is not consumed), copy the rows into it, insert them into the table ignoring the conflicts
+    and drop the temporary table
+    """
+    preparer = dialect.identifier_preparer
+    target = _format_table(dialect, table)
+    staging = preparer.quote(STAGING_TABLE)
+    names = ', '.join(preparer.quote(column) for column in columns)
+    conflict = ', '.join(preparer.quote(column) for column in conflict_columns)
+
+    create = 'CREATE TEMPORARY TABLE {} AS SELECT {} FROM {} WITH NO DATA'.format(staging, names, target)
+    insert = 'INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT ({}) DO NOTHING'.format(
+        target, names, names, staging, conflict)
+    return create, copy_statement(dialect, staging, columns), insert, 'DROP TABLE {}'.format(staging)
+
+
+def _format_table(dialect: Dialect, table: Table) -> str:
+    return dialect.identifier_preparer.format_table(table)
+
+
+def rows_to_csv(rows: List[Dict[str, Any]], columns: Sequence[str]) -> io.StringIO:
+    """
+    Writes the rows in the csv format of postgres COPY: None is written as an empty unquoted value (NULL) and
+    the datetimes in iso format
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerows([row[column] for column in columns] for row in rows)
+    buffer.seek(0)
+    return buffer
@@ -1,5 +1,10 @@
-from core.model.models import CryptoCurrency
-from .orm import session as session_maker, Base, engine
+from typing import List, Tuple
+
+from sqlalchemy import inspect, Index, Table, select, func
+from sqlalchemy.exc import IntegrityError
+
+from core.model.models import CryptoCurrency, OHLC, Trades
+from .orm import session as session_maker, Base, get_engine
 from ..model.models import Exchange
 from config import BaseConfig
 import logging
@@ -8,7 +13,9 @@ _logger = logging.getLogger('FortacrypLogger')
 
 
 def create_tables(log=True):
-    Base.metadata.create_all(engine)
+    Base.metadata.create_all(get_engine())
+    # create_all skips the indexes of tables that already exist
+    create_indexes(log)
     session = session_maker()
 
     exchanges = BaseConfig.Exchanges
@@ -41,5 +48,81 @@ def create_tables(log=True):
         session.close()
 
 
+def create_indexes(log=True, dedupe=False) -> Tuple[List[str], List[str]]:
+    """
+    Adds the indexes declared in the models that are missing in the database. Useful to migrate databases
+    created before the indexes were added to the models.
+    A unique index cannot be created while the table has duplicated rows. Unless dedupe is set, a non unique
+    index on its (exchange_id, currency_id, date) prefix is created instead, so the newest/oldest lookups
+    are still fast, and the unique index is reported as failed
+    :param log: whether to log the indexes created
+    :param dedupe: removes the duplicated rows (keeping the first inserted one) before creating a unique index
+    :return: the names of the indexes created and the names of the indexes that could not be created
+    """
+    engine = get_engine()
+    inspector = inspect(engine)
+    created: List[str] = []
+    failed: List[str] = []
+
+    for table in (OHLC.__table__, Trades.__table__):
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+
+            if index.unique and dedupe:
+                removed = remove_duplicates(table, [column.name for column in index.columns])
+                if log and removed > 0:
+                    _logger.info('{} duplicated rows removed from table {}'.format(removed, table.name))
+
+            try:
+                index.create(engine)
+                created.append(index.name)
+                if log:
+                    _logger.info('Index {} created on table {}'.format(index.name, table.name))
+
+            except IntegrityError as e:
+                failed.append(index.name)
+                if log:
+                    _logger.error('Could not create index {}. Remove the duplicated rows of table {} '
+                                  '(migrate --dedupe) and try again. {}'.format(index.name, table.name, e))
+
+                lookup = _lookup_index(table, index)
+                if lookup.name not in existing:
+                    lookup.create(engine)
+                    created.append(lookup.name)
+                    if log:
+                        _logger.info('Non unique index {} created on table {}'.format(lookup.name, table.name))
+
+    return created, failed
+
+
+def remove_duplicates(table: Table, columns: List[str]) -> int:
+    """
+    Deletes the rows of the table that repeat the values of the given columns, keeping the one with the
+    lowest primary key
+    :param table: table to clean
+    :param columns: columns that identify a row
+    :return: the number of rows deleted
+    """
+    primary_key = list(table.primary_key.columns)[0]
+    # the ids are selected from a derived table, mysql does not allow a subquery on the table being deleted
+    keep = select([func.min(primary_key).label('id')]).group_by(*[table.c[name] for name in columns]).alias('keep')
+    statement = table.delete().where(primary_key.notin_(select([keep.c.id])))
+
+    with get_engine().begin() as connection:
+        return connection.execute(statement).rowcount
+
+
+def _lookup_index(table: Table, index: Index) -> Index:
+    # the first three columns of the unique indexes are (exchange_id, currency_id, date)
+    columns = [table.c[column.name] for column in list(index.columns)[:3]]
+    lookup = Index(index.name + '_lookup', *columns)
+    # an index built from the columns attaches itself to the table, and create_all would create it
+    # on the new databases too
+    table.indexes.discard(lookup)
+    return lookup
+
 if __name__ == '__main__':
     create_tables()
@@ -1,7 +1,12 @@
+import threading
+from typing import Optional
+
 import sqlalchemy
-from sqlalchemy.engine import Connection
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from config import BaseConfig
 
@@ -18,11 +23,103 @@ url = url.replace('%pass', BaseConfig.DBConnection.password or '')
 url = url.replace('%url', BaseConfig.DBConnection.location or '')
 url = url.replace('%dbname', BaseConfig.DBConnection.db_name or '')
 
-engine = sqlalchemy.create_engine(url)
-connection: Connection = engine.connect()
-session = sessionmaker(bind=engine)
 Base: DeclarativeMeta = declarative_base()
 
+# the engine is created on first use, so importing the models doesnt create (or connect to) the database
+_engine: Optional[Engine] = None
+_connection: Optional[Connection] = None
+_lock = threading.Lock()
+
+
+def build_engine(engine_url: str = url) -> Engine:
+    """
+    Creates an engine with the pool configured in BaseConfig.DBConnection. With sqlite, sqlalchemy would open a
+    new connection for each session (NullPool), so a queue pool is used instead, and every connection is set
+    to use the write ahead log if sqlite_wal is enabled
+    """
+    config = BaseConfig.DBConnection
+    options = {
+        'pool_size': config.pool_size,
+        'max_overflow': config.max_overflow,
+        'pool_pre_ping': config.pool_pre_ping,
+        'pool_recycle': config.pool_recycle
+    }
+
+    is_sqlite = engine_url.startswith('sqlite')
+    if is_sqlite:
+        # the connections of the pool are shared by the threads of the concurrent recoveries
+        options.update(poolclass=QueuePool, connect_args={'check_same_thread': False})
+
+    engine_ = sqlalchemy.create_engine(engine_url, **options)
+
+    if is_sqlite and config.sqlite_wal:
+        event.listen(engine_, 'connect', _set_sqlite_pragmas)
+
+    return engine_
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    # the journal mode is stored in the database file, synchronous must be set on each connection
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def get_engine() -> Engine:
+    global _engine
+
+    with _lock:
+        if _engine is None:
+            _engine = build_engine()
+
+    return _engine
+
+
+def get_connection() -> Connection:
+    global _connection
+
+    engine_ = get_engine()
+    with _lock:
+        if _connection is None:
+            _connection = engine_.connect()
+
+    return _connection
+
+
+class _LazySessionMaker:
+    """
+    Behaves as a sessionmaker bound to the engine, but the engine is created when the first session is
+    """
+
+    def __init__(self):
+        self._session_maker: Optional[sessionmaker] = None
+
+    def __call__(self, **kwargs):
+        return self._get_session_maker()(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._get_session_maker(), name)
+
+    def _get_session_maker(self) -> sessionmaker:
+        if self._session_maker is None:
+            self._session_maker = sessionmaker(bind=get_engine())
+
+        return self._session_maker
+
+
+session = _LazySessionMaker()
+
+
+def __getattr__(name):
+    # keeps 'from core.orm.orm import engine, connection' working, creating them when imported
+    if name == 'engine':
+        return get_engine()
+    if name == 'connection':
+        return get_connection()
+
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
 
 # didnt manage to make this work :'(
 # @contextmanager
@@ -0,0 +1,46 @@
+from typing import Optional
+
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import Session
+
+from core.model.models import OHLC, Trades
+
+# the lookups done by the persistors on every batch. Baking them caches the construction and the compiled sql
+# of each query, so a call only binds the parameters
+bakery = baked.bakery()
+
+
+def _ohlc_of_market(query):
+    return query.filter(OHLC.exchange_id == bindparam('exchange_id'), OHLC.currency_id == bindparam('currency_id'))
+
+
+def _trades_of_market(query):
+    return query.filter(Trades.exchange_id == bindparam('exchange_id'),
+                        Trades.currency_id == bindparam('currency_id'))
+
+
+# each query is built with its own lambdas, since the cache key of a baked query is the code of its steps
+_newest_ohlc = bakery(lambda session: session.query(OHLC))
+_newest_ohlc += _ohlc_of_market
+_newest_ohlc += lambda query: query.order_by(OHLC.date.desc())
+
+_oldest_ohlc = bakery(lambda session: session.query(OHLC))
+_oldest_ohlc += _ohlc_of_market
+_oldest_ohlc += lambda query: query.order_by(OHLC.date.asc())
+
+_newest_trade = bakery(lambda session: session.query(Trades))
+_newest_trade += _trades_of_market
+_newest_trade += lambda query: query.order_by(Trades.date.desc())
+
+
+def get_newest_ohlc(session: Session, exchange_id: int, currency_id: int) -> Optional[OHLC]:
+    return _newest_ohlc(session).params(exchange_id=exchange_id, currency_id=currency_id).first()
+
+
+def get_oldest_ohlc(session: Session, exchange_id: int, currency_id: int) -> Optional[OHLC]:
+    return _oldest_ohlc(session).params(exchange_id=exchange_id, currency_id=currency_id).first()
+
+
+def get_newest_trade(session: Session, exchange_id: int, currency_id: int) -> Optional[Trades]:
+    return _newest_trade(session).params(exchange_id=exchange_id, currency_id=currency_id).first()
@@ -0,0 +1,58 @@
+from typing import List, Sequence
+
+from sqlalchemy import Table, text, bindparam
+from sqlalchemy.dialects import postgresql, mysql
+from sqlalchemy.sql import ClauseElement
+
+
+def build_upsert(table: Table, conflict_columns: Sequence[str], update_columns: Sequence[str],
+                 dialect_name: str) -> ClauseElement:
+    """
+    Builds an insert statement that doesnt fail when a row collides with the unique constraint formed
+    by conflict_columns. The colliding rows are updated with the new values of update_columns, or ignored
+    if update_columns is empty. The statement is meant to be executed with a list of dicts (executemany),
+    each dict should have a value for every column of the table but the primary key.
+    :param table: the table where rows are inserted
+    :param conflict_columns: columns of the unique constraint that detects the collision
+    :param update_columns: columns overwritten on collision
+    :param dialect_name: name of the dialect of the engine, e.g. session.bind.dialect.name
+    :return: a statement that can be passed to session.execute
+    """
+    if dialect_name == 'postgresql':
+        stmt = postgresql.insert(table)
+        if len(update_columns) == 0:
+            return stmt.on_conflict_do_nothing(index_elements=list(conflict_columns))
+
+        return stmt.on_conflict_do_update(index_elements=list(conflict_columns),
+                                          set_={col: stmt.excluded[col] for col in update_columns})
+
+    elif dialect_name == 'mysql':
+        stmt = mysql.insert(table)
+        if len(update_columns) == 0:
+            # assigning a column to itself is a no-op, that way only the colliding row is ignored
+            # instead of every error as INSERT IGNORE does
+            return stmt.on_duplicate_key_update({col: table.c[col] for col in conflict_columns[:1]})
+
+        return stmt.on_duplicate_key_update({col: stmt.inserted[col] for col in update_columns})
+
+    elif dialect_name == 'sqlite':
+        return _build_sqlite_upsert(table, conflict_columns, update_columns)
+
+    raise NotImplementedError(f'Upsert is not supported for dialect {dialect_name}')
+
+
+def _build_sqlite_upsert(table: Table, conflict_columns: Sequence[str], update_columns: Sequence[str]):
+    # the sqlite dialect of SQLAlchemy 1.3 has no ON CONFLICT construct, so the statement is written by hand.
+    # The bind params are typed so the values are stored in the same format than the ORM does (e.g. datetimes)
+    columns: List = [col for col in table.columns if not col.primary_key]
+    names = ', '.join(col.name for col in columns)
+    values = ', '.join(':' + col.name for col in columns)
+    conflict = ', '.join(conflict_columns)
+
+    if len(update_columns) == 0:
+        on_conflict = 'DO NOTHING'
+    else:
+        on_conflict = 'DO UPDATE SET ' + ', '.join(f'{col} = excluded.{col}' for col in update_columns)
+
+    sql = f'INSERT INTO {table.name} ({names}) VALUES ({values}) ON CONFLICT ({conflict}) {on_conflict}'
+    return text(sql).bindparams(*[bindparam(col.name, type_=col.type) for col in columns])
@@ -1,7 +1,31 @@
-from unittest import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from importlib.util import find_spec
+from types import SimpleNamespace
+from unittest import TestCase, mock, skipUnless
+
+import numpy as np
 
 from Buda.BudaIntegrationConfig import BudaMarketConfig
+from core.CandleAggregator import CandleAggregator, MINUTE, HOUR
+from core.CsvFile import OHLC_CSV_HEADER, append_lines
+from core.BaseIntegration import ForwardRecoverIntegration, IntegrationMarkets, recover_concurrently
+from core.OhlcBinaryStore import OhlcBinaryStore, OHLC_RECORD_DTYPE
+from core.WriteBehindQueue import WriteBehindQueue
+from core.JsonDecoder import get_decoder, response_json
+from core.HttpSession import PooledSession, get_shared_session
+from core.RateLimiter import TokenBucket, ExponentialBackoff, RetryableResponseError, ResponseError, \
+    check_response, get_rate_limiter
+from core.Enums import Mnemonic
 from core.configCore import _config
+from core.model.CoreModels import TradesEntry, OhlcFrame, OhlcBatch, TradeBatch
+from core.utils import trades_to_ohlc_array, trade_entries_to_ohlc_frames
 from core.config import root_config_from_dict
 
 
@@ -74,3 +98,661 @@ class TestConfig(TestCase):
     def test_reference_to_root_config_from_child(self):
         config = root_config_from_dict(self.base_config)
         self.assertEqual(id(config), id(config.buda.root_config))
+
+
+class TradesToOhlcTests(TestCase):
+    def test_trades_to_ohlc_array(self):
+        # 2 trades closing at 3600 (one of them right at the close), 1 at 7200 and 2 at 14400
+        epoch = [1800, 3600, 3601, 10900, 14000]
+        price = [10, 12, 11, 9, 13]
+        volume = [1, 2, 3, 4, 5]
+
+        ohlc = trades_to_ohlc_array(epoch, price, volume)
+
+        self.assertEqual([3600, 7200, 14400], ohlc['date'].tolist())
+        self.assertEqual([10, 11, 9], ohlc['open'].tolist())
+        self.assertEqual([12, 11, 13], ohlc['high'].tolist())
+        self.assertEqual([10, 11, 9], ohlc['low'].tolist())
+        self.assertEqual([12, 11, 13], ohlc['close'].tolist())
+        self.assertEqual([3, 3, 9], ohlc['volume'].tolist())
+
+    def test_empty_trades(self):
+        self.assertEqual(0, len(trades_to_ohlc_array([], [], [])))
+        self.assertEqual([], trade_entries_to_ohlc_frames([]))
+
+    def test_entries_keep_timezone(self):
+        trades = [TradesEntry(10, 1, 'buy', datetime(2019, 1, 2, 11, 40, tzinfo=timezone.utc)),
+                  TradesEntry(12, 1, 'sell', datetime(2019, 1, 2, 12, 0, tzinfo=timezone.utc))]
+
+        frames = trade_entries_to_ohlc_frames(trades)
+
+        self.assertEqual(1, len(frames))
+        self.assertEqual(datetime(2019, 1, 2, 12, tzinfo=timezone.utc), frames[0].date)
+        self.assertEqual(2, frames[0].volume)
+
+
+class CandleAggregatorTests(TestCase):
+    def test_intervals_at_the_same_time(self):
+        aggregator = CandleAggregator((MINUTE, HOUR))
+        for timestamp, price in ((0, 10), (30, 12), (60, 11), (3599, 9), (3600, 13)):
+            aggregator.add(timestamp, price, 1)
+
+        minutes = aggregator.pop_closed(MINUTE)
+        self.assertEqual([0, 60, 3540], minutes['date'].tolist())
+        self.assertEqual([10, 11, 9], minutes['open'].tolist())
+        self.assertEqual([12, 11, 9], minutes['close'].tolist())
+        self.assertEqual([2, 1, 1], minutes['volume'].tolist())
+
+        hours = aggregator.pop_closed(HOUR)
+        self.assertEqual([(0, 10, 12, 9, 9, 4)], hours.tolist())
+        self.assertEqual(0, len(aggregator.pop_closed(HOUR)))
+        self.assertEqual((3600, 13, 13, 13, 13, 1), aggregator.current(HOUR))
+
+        aggregator.flush()
+        self.assertEqual([3600], aggregator.pop_closed(MINUTE)['date'].tolist())
+        self.assertIsNone(aggregator.current(HOUR))
+
+    def test_late_trades_within_the_grace(self):
+        aggregator = CandleAggregator((HOUR,), grace_sec=10)
+        for timestamp, price in ((100, 10), (3605, 20), (50, 8), (3599, 5), (3615, 40), (10, 1)):
+            aggregator.add(timestamp, price, 1)
+
+        # 50 is the new open and 3599 the new close of the first hour. 3615 closed it, so 10 is discarded
+        self.assertEqual([(0, 8, 10, 5, 5, 3)], aggregator.pop_closed().tolist())
+        self.assertEqual(1, aggregator.late_trades[HOUR])
+
+    def test_batch_same_than_one_by_one(self):
+        rng = np.random.RandomState(0)
+        # out of order, but less than the grace
+        epoch = np.cumsum(rng.exponential(30, 5000)) + rng.uniform(-10, 10, 5000)
+        price = rng.uniform(1, 2, 5000)
+
+        one_by_one = CandleAggregator((MINUTE, 5 * MINUTE, HOUR), grace_sec=30, closed='right')
+        for timestamp, trade_price in zip(epoch.tolist(), price.tolist()):
+            one_by_one.add(timestamp, trade_price, 1)
+
+        batches = CandleAggregator((MINUTE, 5 * MINUTE, HOUR), grace_sec=30, closed='right')
+        for start in range(0, 5000, 1000):
+            batches.add_batch(epoch[start:start + 1000], price[start:start + 1000], np.ones(1000))
+
+        one_by_one.flush()
+        batches.flush()
+        for interval in (MINUTE, 5 * MINUTE, HOUR):
+            self.assertEqual(one_by_one.pop_closed(interval).tolist(), batches.pop_closed(interval).tolist())
+            self.assertEqual(0, batches.late_trades[interval])
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        self.frames = [OhlcFrame(10 + i, 12 + i, 9 + i, 11 + i, datetime(2019, 1, 2, i), 5)
+                       for i in range(10)]
+        self.batch = OhlcBatch.from_frames(self.frames)
+
+    def test_round_trip(self):
+        self.assertEqual(self.frames, self.batch.to_frames())
+        self.assertEqual(self.frames[3], self.batch[3])
+
+        trades = [TradesEntry(10, 1, 'buy', datetime(2019, 1, 2, 11, 40)),
+                  TradesEntry(12, 2, 'sell', datetime(2019, 1, 2, 12, 5))]
+        self.assertEqual(trades, TradeBatch.from_entries(trades).to_entries())
+
+    def test_slices_share_memory(self):
+        sliced = self.batch[2:8]
+        since = sliced.since(datetime(2019, 1, 2, 4))
+
+        self.assertIsInstance(sliced, OhlcBatch)
+        self.assertTrue(np.shares_memory(sliced.data, self.batch.data))
+        self.assertEqual(self.frames[4:8], list(since))
+
+    def test_compact_rows(self):
+        self.assertEqual(48, self.batch.data.itemsize)
+
+    def test_to_rows(self):
+        rows = self.batch[:1].to_rows(exchange_id=1, currency_id=2)
+        expected = dict(self.frames[0].to_dict(), exchange_id=1, currency_id=2)
+        self.assertEqual([expected], rows)
+
+
+class CsvFileTests(TestCase):
+    def test_append_lines(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'ohlc.csv')
+            append_lines([OHLC_CSV_HEADER, '1,1,1,1,1,1'], path)
+            append_lines(['2,2,2,2,2,2'], path, fsync=True)
+
+            # a file that ends with a new line gets no empty line in between
+            with open(path, 'a') as file:
+                file.write('\n')
+            append_lines(['3,3,3,3,3,3'], path)
+
+            with open(path) as file:
+                self.assertEqual([OHLC_CSV_HEADER, '1,1,1,1,1,1', '2,2,2,2,2,2', '3,3,3,3,3,3'],
+                                 file.read().split('\n'))
+
+
+@skipUnless(find_spec('pyarrow') is not None, 'pyarrow is not installed')
+class ParquetPersistorTests(TestCase):
+    def setUp(self):
+        from core.ParquetPersistor import ParquetPersistor
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.persistor = ParquetPersistor('Kraken', self.tmp_dir.name, row_group_size=24)
+        start = datetime(2019, 1, 31)
+        # 3 days around the change of month
+        self.frames = [OhlcFrame(i, i + 2, i - 1, i + 1, start + timedelta(hours=i), 1.0) for i in range(72)]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_partitions_by_month_and_reads_a_range(self):
+        self.persistor.persist_ohlc(self.frames, Mnemonic.BTC)
+        folder = os.path.join(self.tmp_dir.name, 'Kraken', 'btc')
+        self.assertEqual(['2019-01.parquet', '2019-02.parquet'], sorted(os.listdir(folder)))
+
+        batch = self.persistor.read_ohlc(Mnemonic.BTC, datetime(2019, 1, 31, 20), datetime(2019, 2, 1, 4))
+        self.assertEqual([frame.date for frame in self.frames[20:28]], [frame.date for frame in batch])
+        self.assertEqual(self.frames[0].date, self.persistor.get_oldest_ohlc(Mnemonic.BTC).date)
+        self.assertEqual(self.frames[-1], self.persistor.get_newest_ohlc(Mnemonic.BTC))
+
+    def test_read_range_with_timezone(self):
+        self.persistor.persist_ohlc(self.frames, Mnemonic.BTC)
+
+        # 2019-01-31 20:00 and 2019-02-01 04:00 in utc
+        santiago = timezone(timedelta(hours=-3))
+        batch = self.persistor.read_ohlc(Mnemonic.BTC, datetime(2019, 1, 31, 17, tzinfo=santiago),
+                                         datetime(2019, 2, 1, 1, tzinfo=santiago))
+        self.assertEqual([frame.date for frame in self.frames[20:28]], [frame.date for frame in batch])
+
+    def test_persist_merges_the_newest_frame(self):
+        self.persistor.persist_ohlc(self.frames[:10], Mnemonic.BTC)
+        self.persistor.persist_ohlc([OhlcFrame(5, 100, 0, 7, self.frames[9].date, 3.0)], Mnemonic.BTC)
+
+        newest = self.persistor.get_newest_ohlc(Mnemonic.BTC)
+        self.assertEqual(OhlcFrame(9, 100, 0, 7, self.frames[9].date, 4.0), newest)
+        self.assertEqual(10, len(self.persistor.read_ohlc(Mnemonic.BTC)))
+
+    def test_persist_after_upsert_merges_the_upserted_frame(self):
+        self.persistor.persist_ohlc(self.frames[10:11], Mnemonic.BTC)
+        self.persistor.upsert_ohlc(self.frames[10:12], Mnemonic.BTC)
+        self.persistor.persist_ohlc([OhlcFrame(5, 100, 0, 7, self.frames[11].date, 3.0), self.frames[12]],
+                                    Mnemonic.BTC)
+
+        batch = self.persistor.read_ohlc(Mnemonic.BTC)
+        self.assertEqual([frame.date for frame in self.frames[10:13]], [frame.date for frame in batch])
+        # 11:00 is merged with the upserted frame, not overwritten by the new one
+        self.assertEqual(OhlcFrame(11, 100, 0, 7, self.frames[11].date, 4.0), batch[1])
+
+    def test_convert_csv(self):
+        from core.ParquetPersistor import convert_csv
+
+        path = os.path.join(self.tmp_dir.name, 'cryptoCompare_btc.csv')
+        with open(path, 'w') as file:
+            file.write('time,open,high,low,close,volumefrom\n1546300800,1,2,0.5,1.5,10\n1546304400,2,3,1,2.5,20')
+
+        self.assertEqual(2, convert_csv(path, self.persistor, Mnemonic.BTC))
+        self.assertEqual(OhlcFrame(2, 3, 1, 2.5, datetime(2019, 1, 1, 1), 20),
+                         self.persistor.get_newest_ohlc(Mnemonic.BTC))
+
+    def test_convert_binary_store(self):
+        from core.ParquetPersistor import convert_csv
+
+        path = os.path.join(self.tmp_dir.name, 'kraken_btc_.ohlc')
+        records = np.zeros(2, dtype=OHLC_RECORD_DTYPE)
+        records['timestamp'] = [1546300800, 1546304400]
+        records['open'] = [1, 2]
+        records['high'] = [2, 3]
+        records['low'] = [0.5, 1]
+        records['close'] = [1.5, 2.5]
+        records['volume'] = [10, 20]
+        OhlcBinaryStore(path).append(records)
+
+        self.assertEqual(2, convert_csv(path, self.persistor, Mnemonic.BTC))
+        self.assertEqual(OhlcFrame(1, 2, 0.5, 1.5, datetime(2019, 1, 1), 10),
+                         self.persistor.get_oldest_ohlc(Mnemonic.BTC))
+        self.assertEqual(OhlcFrame(2, 3, 1, 2.5, datetime(2019, 1, 1, 1), 20),
+                         self.persistor.get_newest_ohlc(Mnemonic.BTC))
+
+
+class OhlcBinaryStoreTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'btc.ohlc')
+        self.records = np.zeros(10, dtype=OHLC_RECORD_DTYPE)
+        self.records['timestamp'] = np.arange(10) * 3600
+        self.records['close'] = np.arange(10)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_append_only_newer_records(self):
+        store = OhlcBinaryStore(self.path)
+        self.assertIsNone(store.last_timestamp())
+        self.assertEqual(6, store.append(self.records[:6]))
+        self.assertEqual(4, store.append(self.records[3:]))
+
+        store = OhlcBinaryStore(self.path)
+        self.assertEqual(10, len(store))
+        self.assertEqual(9 * 3600, store.last_timestamp())
+        self.assertTrue(np.array_equal(self.records, store.view()))
+
+    def test_search_and_range(self):
+        store = OhlcBinaryStore(self.path)
+        store.append(self.records)
+
+        self.assertEqual(2, store.search(2 * 3600))
+        self.assertEqual(3, store.search(2 * 3600, side='right'))
+        selected = store.range(2 * 3600, 5 * 3600)
+        self.assertEqual([2, 3, 4], selected['close'].tolist())
+        # a view of the mapped file, not a copy
+        self.assertIsInstance(selected, np.memmap)
+        self.assertFalse(selected.flags.writeable)
+
+    def test_discards_incomplete_record(self):
+        store = OhlcBinaryStore(self.path)
+        store.append(self.records)
+        with open(self.path, 'ab') as file:
+            file.write(b'\x00' * 10)
+
+        store = OhlcBinaryStore(self.path)
+        self.assertEqual(10, len(store))
+        self.assertEqual(9, store.last()['close'])
+
+
+class WriteBehindQueueTests(TestCase):
+    def setUp(self):
+        self.processed = []
+        self.release = threading.Event()
+
+    def slow_consumer(self, item):
+        self.release.wait(5)
+        self.processed.append(item)
+
+    def fill(self, queue: WriteBehindQueue, items):
+        queue.start()
+        queue.put('first')
+        # waits until the writer is blocked processing the first item, so the rest stay in the queue
+        while queue.metrics.depth > 0:
+            time.sleep(0.001)
+
+        return [queue.put(item, timeout=0.01) for item in items]
+
+    def test_block_policy_times_out_when_full(self):
+        queue = WriteBehindQueue(self.slow_consumer, maxsize=2, policy='block')
+        self.assertEqual([True, True, False], self.fill(queue, ['a', 'b', 'c']))
+
+        self.release.set()
+        queue.stop()
+        self.assertEqual(['first', 'a', 'b'], self.processed)
+        self.assertEqual(1, queue.metrics.dropped)
+        self.assertEqual(2, queue.metrics.max_depth)
+        self.assertEqual(3, queue.metrics.processed)
+
+    def test_drop_oldest_policy(self):
+        queue = WriteBehindQueue(self.slow_consumer, maxsize=2, policy='drop_oldest')
+        self.assertTrue(all(self.fill(queue, ['a', 'b', 'c'])))
+
+        self.release.set()
+        queue.stop()
+        self.assertEqual(['first', 'b', 'c'], self.processed)
+        self.assertEqual(1, queue.metrics.dropped)
+        self.assertGreater(queue.metrics.max_lag, 0)
+
+    def test_coalesce_policy(self):
+        queue = WriteBehindQueue(self.slow_consumer, maxsize=2, policy='coalesce', coalesce_key=lambda item: item[0],
+                                 coalesce=lambda waiting, new: waiting + new[1:])
+        self.assertTrue(all(self.fill(queue, ['a1', 'b1', 'a2', 'a3'])))
+
+        self.release.set()
+        queue.stop()
+        self.assertEqual(['first', 'a123', 'b1'], self.processed)
+        self.assertEqual(2, queue.metrics.coalesced)
+        self.assertRaises(RuntimeError, queue.put, 'a4')
+
+    def test_coalesce_policy_with_barrier(self):
+        queue = WriteBehindQueue(self.slow_consumer, maxsize=3, policy='coalesce', coalesce_key=lambda item: item[0],
+                                 coalesce=lambda waiting, new: waiting + new[1:])
+        self.assertTrue(all(self.fill(queue, ['a1', 'b1'])))
+        queue.put('a-barrier', barrier=True)
+        # the queue is full, and a2 cannot be merged into the item waiting before the barrier
+        self.assertFalse(queue.put('a2', timeout=0.01))
+        self.assertEqual(0, queue.metrics.coalesced)
+
+        self.release.set()
+        queue.stop()
+        self.assertEqual(['first', 'a1', 'b1', 'a-barrier'], self.processed)
+
+    def test_coalesce_policy_only_merges_when_full(self):
+        queue = WriteBehindQueue(self.slow_consumer, maxsize=3, policy='coalesce',
+                                 coalesce_key=lambda item: item[0] if item[0] != 'x' else None,
+                                 coalesce=lambda waiting, new: waiting + new[1:])
+        self.assertTrue(all(self.fill(queue, ['a1', 'a2', 'x1', 'a3'])))
+        # None as key is never merged
+        self.assertFalse(queue.put('x2', timeout=0.01))
+
+        self.release.set()
+        queue.stop()
+        # a3 is merged into the last waiting item of its key
+        self.assertEqual(['first', 'a1', 'a23', 'x1'], self.processed)
+        self.assertEqual(1, queue.metrics.coalesced)
+
+    def test_consumer_errors_dont_stop_the_writer(self):
+        queue = WriteBehindQueue(lambda item: 1 / item, maxsize=10)
+        queue.logger = mock.Mock()
+        queue.start()
+        for item in (1, 0, 2):
+            queue.put(item)
+        queue.stop()
+
+        self.assertEqual(3, queue.metrics.processed)
+        self.assertEqual(1, queue.metrics.errors)
+
+
+class JsonDecoderTests(TestCase):
+    def test_get_decoder(self):
+        self.assertIs(json.loads, get_decoder('json'))
+        self.assertEqual([1, {'a': '2.5'}], get_decoder('auto')('[1, {"a": "2.5"}]'))
+        self.assertRaises(ValueError, get_decoder, 'yaml')
+
+    @skipUnless(find_spec('orjson') is not None, 'orjson is not installed')
+    def test_auto_prefers_orjson(self):
+        import orjson
+        self.assertIs(orjson.loads, get_decoder('auto'))
+
+    @skipUnless(find_spec('ujson') is not None, 'ujson is not installed')
+    def test_ujson_decodes_socket_messages(self):
+        message = b'[0, [["5541.2", "0.15", "1534614057.32", "s", "l", ""]], "trade", "XBT/USD"]'
+        self.assertEqual([0, [['5541.2', '0.15', '1534614057.32', 's', 'l', '']], 'trade', 'XBT/USD'],
+                         get_decoder('ujson')(message))
+
+    def test_response_json_decodes_the_bytes(self):
+        response = SimpleNamespace(content=b'{"result": [1, 2]}', text=None)
+        self.assertEqual({'result': [1, 2]}, response_json(response))
+        self.assertEqual({'result': []}, response_json(SimpleNamespace(text='{"result": []}')))
+
+
+class DummyResponse:
+    def __init__(self, json_data, status_code=200):
+        self.text = json.dumps(json_data)
+        self.status_code = status_code
+
+
+class DummyRequests:
+    """
+    Answers 3 pages of 2 entries each for every market, taking some time to respond
+    """
+
+    def __init__(self, latency_sec: float):
+        self.latency_sec = latency_sec
+        self.request_times = []
+        self._lock = threading.Lock()
+
+    def get(self, url, *args, **kwargs):
+        with self._lock:
+            self.request_times.append(time.monotonic())
+
+        time.sleep(self.latency_sec)
+        since = int(url.split('since=')[1])
+        return DummyResponse([{'timestamp': since + 1}, {'timestamp': since + 2}])
+
+
+class DummyPersistor:
+    def __init__(self):
+        self.entries = []
+
+    def persist(self, entries):
+        self.entries.extend(entries)
+
+
+class DummyForwardIntegration(ForwardRecoverIntegration):
+    def __init__(self, requests):
+        config = SimpleNamespace(**{market.value: SimpleNamespace(key=market.value) for market in IntegrationMarkets})
+        super().__init__(config, DummyPersistor())
+        self.requests = requests
+
+    def generate_url(self, market_config) -> str:
+        since = self.persistor.entries[-1]['timestamp'] if len(self.persistor.entries) > 0 else 0
+        return f'https://dummy.exchange/{market_config.key}?since={since}'
+
+    def is_ending_condition_achieved(self, last_data) -> bool:
+        return last_data is not None and last_data >= 6
+
+    def get_most_recent_entry_ts(self, data_list) -> int:
+        return data_list[-1]['timestamp']
+
+    def get_older_entry_ts(self, data_list) -> int:
+        return data_list[0]['timestamp']
+
+    def parse_response_to_list(self, response, market_config=None) -> list:
+        return response
+
+    def do_logging(self, action: str, market_config, msg=None) -> None:
+        pass
+
+
+class UnitOfWorkPersistor(DummyPersistor):
+    def __init__(self):
+        super().__init__()
+        self.is_open = False
+        self.opened = 0
+
+    def persist(self, entries):
+        assert self.is_open, 'persist called outside the unit of work'
+        super().persist(entries)
+
+    @contextmanager
+    def unit_of_work(self):
+        self.is_open = True
+        self.opened += 1
+        try:
+            yield
+        finally:
+            self.is_open = False
+
+
+class UnitOfWorkTests(TestCase):
+    def test_main_loop_runs_in_a_single_unit_of_work(self):
+        integration = DummyForwardIntegration(DummyRequests(latency_sec=0))
+        integration.persistor = UnitOfWorkPersistor()
+        integration.recover(IntegrationMarkets.BTC)
+
+        self.assertEqual([1, 2, 3, 4, 5, 6], [entry['timestamp'] for entry in integration.persistor.entries])
+        self.assertEqual(1, integration.persistor.opened)
+        self.assertFalse(integration.persistor.is_open)
+
+
+class AsyncRecoverTests(TestCase):
+    def test_recover_all_markets_concurrently(self):
+        requests = DummyRequests(latency_sec=0.05)
+        integrations = {}
+
+        def factory(market):
+            integrations[market] = DummyForwardIntegration(requests)
+            return integrations[market]
+
+        start = time.monotonic()
+        recover_concurrently(factory)
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(len(IntegrationMarkets), len(integrations))
+        for integration in integrations.values():
+            self.assertEqual([1, 2, 3, 4, 5, 6], [entry['timestamp'] for entry in integration.persistor.entries])
+
+        # 12 requests of 50 ms each. Sequentially would take at least 600 ms
+        self.assertEqual(12, len(requests.request_times))
+        self.assertLess(elapsed, 0.45)
+
+
+class RateLimiterTests(TestCase):
+    def test_bucket_waits_when_empty(self):
+        bucket = TokenBucket('test', rate=10, capacity=2)
+        self.assertEqual(0, bucket.reserve())
+        self.assertEqual(0, bucket.reserve())
+        # the third token is borrowed from the future, 1 / rate seconds later
+        self.assertAlmostEqual(0.1, bucket.reserve(), delta=0.01)
+        self.assertAlmostEqual(0.2, bucket.reserve(), delta=0.01)
+
+    def test_time_spent_is_discounted(self):
+        bucket = TokenBucket('test', rate=20, capacity=1)
+        bucket.reserve()
+        time.sleep(0.05)  # as if the request took 50 ms
+        self.assertEqual(0, bucket.reserve())
+
+    def test_bucket_shared_between_instances(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'buckets.db')
+            # as if they were in different processes
+            bucket_1 = TokenBucket('exchange', rate=10, capacity=1, state_path=path)
+            bucket_2 = TokenBucket('exchange', rate=10, capacity=1, state_path=path)
+            other_exchange = TokenBucket('other', rate=10, capacity=1, state_path=path)
+
+            self.assertEqual(0, bucket_1.reserve())
+            self.assertAlmostEqual(0.1, bucket_2.reserve(), delta=0.01)
+            self.assertEqual(0, other_exchange.reserve())
+
+    def test_acquire_async(self):
+        bucket = TokenBucket('test', rate=50, capacity=1)
+
+        async def acquire_all():
+            await asyncio.gather(*[bucket.acquire_async() for _ in range(4)])
+
+        start = time.monotonic()
+        asyncio.run(acquire_all())
+        self.assertGreaterEqual(time.monotonic() - start, 0.055)
+
+    def test_exponential_backoff(self):
+        backoff = ExponentialBackoff(base_sec=1, max_sec=8)
+        delays = [backoff.next_delay() for _ in range(6)]
+
+        for delay, expected in zip(delays, [1, 2, 4, 8, 8, 8]):
+            self.assertTrue(expected / 2 <= delay <= expected)
+
+        backoff.reset()
+        self.assertLessEqual(backoff.next_delay(), 1)
+
+    def test_backoff_honors_retry_after(self):
+        backoff = ExponentialBackoff(base_sec=1, max_sec=8)
+        self.assertEqual(30, backoff.next_delay(RetryableResponseError(429, retry_after=30)))
+        self.assertLessEqual(backoff.next_delay(RetryableResponseError(503)), 2)
+
+    def test_check_response(self):
+        check_response(SimpleNamespace(status_code=200))
+
+        with self.assertRaises(RetryableResponseError) as context:
+            check_response(SimpleNamespace(status_code=429, headers={'Retry-After': '12'}))
+        self.assertEqual(12, context.exception.retry_after)
+        self.assertEqual(429, context.exception.args[0])
+
+        with self.assertRaises(RetryableResponseError) as context:
+            check_response(SimpleNamespace(status_code=503, headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}))
+        self.assertEqual(0, context.exception.retry_after)  # a date in the past
+
+        # no retry for the errors of the client, e.g. a wrong api key
+        for status_code in (400, 401, 403, 404):
+            with self.assertRaises(ResponseError):
+                check_response(SimpleNamespace(status_code=status_code))
+
+    def test_rate_limiter_from_sleep_time(self):
+        with mock.patch('core.RateLimiter._buckets', {}), \
+                mock.patch('config.BaseConfig.RateLimit.state_path', None):
+            bucket = get_rate_limiter('Buda', min_interval_sec=10)
+            self.assertEqual((0.1, 1), (bucket.rate, bucket.capacity))
+
+            # a new interval in the config updates the bucket shared by the integrations
+            self.assertIs(bucket, get_rate_limiter('Buda', min_interval_sec=20))
+            self.assertEqual(0.05, bucket.rate)
+
+    def test_loop_does_not_retry_client_errors(self):
+        requests = mock.Mock()
+        requests.get.return_value = DummyResponse({}, 403)
+        integration = DummyForwardIntegration(requests)
+
+        with self.assertRaises(ResponseError):
+            integration.recover(IntegrationMarkets.BTC)
+
+        self.assertEqual(1, requests.get.call_count)
+
+
+class PooledSessionTests(TestCase):
+    def test_shared_session_is_reused(self):
+        self.assertIs(get_shared_session(), get_shared_session())
+        self.assertIsInstance(get_shared_session(), PooledSession)
+
+    def test_pool_size_and_default_timeout(self):
+        session = PooledSession(pool_connections=2, pool_maxsize=3, timeout=(1, 2))
+        adapter = session.get_adapter('https://api.kraken.com')
+        self.assertEqual(3, adapter._pool_maxsize)
+
+        with mock.patch('requests.Session.send', return_value=DummyResponse([])) as send:
+            session.get('https://api.kraken.com/0/public/OHLC')
+            self.assertEqual((1, 2), send.call_args[1]['timeout'])
+
+            session.get('https://api.kraken.com/0/public/OHLC', timeout=10)
+            self.assertEqual(10, send.call_args[1]['timeout'])
+
+
+class BulkInsertTests(TestCase):
+    def setUp(self):
+        from sqlalchemy.dialects.postgresql import psycopg2
+
+        self.dialect = psycopg2.dialect()
+        self.rows = [
+            {'price': 100.5, 'volume': 3, 'direction': 'buy', 'date': datetime(2019, 1, 2, 11, 40),
+             'exchange_id': 1, 'currency_id': None},
+            {'price': 99, 'volume': 0.25, 'direction': 'sell, "quoted"', 'date': datetime(2019, 1, 2, 11, 45, 30),
+             'exchange_id': 1, 'currency_id': 2}
+        ]
+
+    def test_rows_to_csv(self):
+        from core.orm.bulk import rows_to_csv
+
+        buffer = rows_to_csv(self.rows, ['date', 'price', 'direction', 'currency_id'])
+        # None is an empty unquoted value, NULL for COPY, and the text with commas or quotes is quoted
+        self.assertEqual('2019-01-02 11:40:00,100.5,buy,\n'
+                         '2019-01-02 11:45:30,99,"sell, ""quoted""",2\n', buffer.read())
+
+    def test_copy_statement(self):
+        from core.orm.bulk import copy_statement
+
+        self.assertEqual('COPY trades (price, "user") FROM STDIN WITH (FORMAT csv)',
+                         copy_statement(self.dialect, 'trades', ['price', 'user']))
+
+    def test_copy_ignoring_conflicts_goes_through_a_staging_table(self):
+        from core.model.models import Trades, TRADES_UNIQUE_COLUMNS
+        from core.orm.bulk import bulk_insert
+
+        cursor = mock.MagicMock()
+        session = mock.MagicMock()
+        session.bind.dialect = self.dialect
+        session.connection.return_value.connection.cursor.return_value = cursor
+
+        bulk_insert(session, Trades.__table__, self.rows, TRADES_UNIQUE_COLUMNS)
+
+        columns = 'price, volume, direction, date, exchange_id, currency_id'
+        self.assertEqual([
+            mock.call('CREATE TEMPORARY TABLE bulk_staging AS SELECT {} FROM {} WITH NO DATA'
+                      .format(columns, Trades.__tablename__)),
+            mock.call('INSERT INTO {} ({}) SELECT {} FROM bulk_staging ON CONFLICT '
+                      '(exchange_id, currency_id, date, price, volume, direction) DO NOTHING'
+                      .format(Trades.__tablename__, columns, columns)),
+            mock.call('DROP TABLE bulk_staging')
+        ], cursor.execute.call_args_list)
+
+        stmt, buffer = cursor.copy_expert.call_args[0]
+        self.assertEqual('COPY bulk_staging ({}) FROM STDIN WITH (FORMAT csv)'.format(columns), stmt)
+        self.assertEqual(2, len(buffer.read().splitlines()))
+        cursor.close.assert_called_once()
+        session.execute.assert_not_called()
+
+    def test_copy_without_conflict_columns(self):
+        from core.model.models import Trades
+        from core.orm.bulk import bulk_insert
+
+        cursor = mock.MagicMock()
+        session = mock.MagicMock()
+        session.bind.dialect = self.dialect
+        session.connection.return_value.connection.cursor.return_value = cursor
+
+        bulk_insert(session, Trades.__table__, self.rows)
+
+        cursor.execute.assert_not_called()
+        self.assertTrue(cursor.copy_expert.call_args[0][0].startswith('COPY {} ('.format(Trades.__tablename__)))
@@ -1,8 +1,14 @@
 from datetime import datetime, timedelta
-from typing import List
+from typing import List, Iterator, Sequence, Dict, Any, Union, TYPE_CHECKING
 
-from core.model.CoreModels import OhlcFrame, TradesEntry
-from core.model.models import OHLC
+import numpy as np
+
+from core.CandleAggregator import CandleAggregator
+from core.model.CoreModels import OhlcFrame, TradesEntry, OhlcBatch, TradeBatch
+
+if TYPE_CHECKING:
+    # the orm models are imported when they are used, so the csv integrations dont load SQLAlchemy
+    from core.model.models import OHLC
 
 
 def is_valid_market_json(market_dict: dict) -> bool:
@@ -43,46 +49,46 @@ def reset_ohlc(curr_price) -> (float, float, float, float):
     return curr_price, curr_price, curr_price, curr_price
 
 
-def trade_entries_to_ohlc_frames(trade_list: List[TradesEntry]) -> List[OhlcFrame]:
+def trades_to_ohlc_array(epoch: np.ndarray, price: np.ndarray, volume: np.ndarray,
+                        frame_sec: int = 3600) -> np.ndarray:
+    """
+    Maps trades, given as columns, into ohlc frames. Each trade belongs to the frame that closes at the
+    next multiple of frame_sec, or the same one if the trade happens right at the close
+    :param epoch: seconds since the epoch of each trade
+    :param price: price of each trade
+    :param volume: volume of each trade
+    :param frame_sec: duration of each frame in seconds
+    :return: an array of OHLC_DTYPE, one row per frame with at least one trade
+    """
+    aggregator = CandleAggregator((frame_sec,), closed='right')
+    aggregator.add_batch(epoch, price, volume)
+    aggregator.flush()
+    return aggregator.pop_closed()
+
+
+def trade_entries_to_ohlc_frames(trade_list: Union[List[TradesEntry], TradeBatch]) \
+        -> Union[List[OhlcFrame], OhlcBatch]:
     """
     Maps a list of trades into an hourly ohlc list
-    :param trade_list: list of trades
-    :return: A list of ohlc frames that can be used to insert into a database via a Persistor instance
+    :param trade_list: list of trades, or a batch of them
+    :return: A list of ohlc frames that can be used to insert into a database via a Persistor instance.
+    An OhlcBatch if trade_list is a TradeBatch
     """
 
     # i could use pandas dataframe.resample('1H').ohlc() but i want to remove that dependency
+    if isinstance(trade_list, TradeBatch):
+        ohlc = trades_to_ohlc_array(trade_list.data['date'], trade_list.data['price'], trade_list.data['volume'])
+        return OhlcBatch(ohlc, trade_list.tz)
+
     if trade_list is None or len(trade_list) == 0:
         return []
 
-    ohlc_list: List[OhlcFrame] = []
-    close_datetime = get_close_datetime(trade_list[0].date)
-    open_price, high_price, low_price, close_price = reset_ohlc(trade_list[0].price)
-    volume = 0
-
-    for trade in trade_list:
-        if trade.date > close_datetime:
-            ohlc_frame = OhlcFrame(open=open_price, high=high_price, low=low_price,
-                                   close=close_price, date=close_datetime, volume=volume)
+    return trade_entries_to_ohlc_frames(TradeBatch.from_entries(trade_list)).to_frames()
 
-            ohlc_list.append(ohlc_frame)
-            close_datetime = get_close_datetime(trade.date)
-            open_price, high_price, low_price, close_price = reset_ohlc(trade.price)
-            volume = trade.volume
 
-        else:
-            close_price = trade.price
-            low_price, high_price = get_minmax(low_price, high_price, trade.price)
-            volume += trade.volume
+def map_frame_to_ohlc(ohlc_frame: OhlcFrame) -> 'OHLC':
+    from core.model.models import OHLC
 
-    ohlc_frame = OhlcFrame(open=open_price, high=high_price, low=low_price,
-                           close=close_price, date=close_datetime, volume=volume)
-
-    ohlc_list.append(ohlc_frame)
-
-    return ohlc_list
-
-
-def map_frame_to_ohlc(ohlc_frame: OhlcFrame) -> OHLC:
     return OHLC(open_price=ohlc_frame.open,
                 high=ohlc_frame.high,
                 low=ohlc_frame.low,
@@ -91,7 +97,62 @@ def map_frame_to_ohlc(ohlc_frame: OhlcFrame) -> OHLC:
                 date=ohlc_frame.date)
 
 
-def map_ohlc_to_frame(ohlc: OHLC) -> OhlcFrame:
+def map_frame_to_ohlc_row(ohlc_frame: OhlcFrame, exchange_id: int, currency_id: int) -> Dict[str, Any]:
+    """
+    Maps an ohlc frame into a dict with the columns of the ohlc table. Useful for bulk inserts, since
+    there is no need to instantiate an ORM object per row
+    """
+    return {
+        'open': ohlc_frame.open,
+        'high': ohlc_frame.high,
+        'low': ohlc_frame.low,
+        'close': ohlc_frame.close,
+        'volume': ohlc_frame.volume,
+        'date': ohlc_frame.date,
+        'exchange_id': exchange_id,
+        'currency_id': currency_id
+    }
+
+
+def map_frames_to_ohlc_rows(frames: Union[List[OhlcFrame], OhlcBatch], exchange_id: int,
+                            currency_id: int) -> List[Dict[str, Any]]:
+    if isinstance(frames, OhlcBatch):
+        return frames.to_rows(exchange_id, currency_id)
+
+    return [map_frame_to_ohlc_row(frame, exchange_id, currency_id) for frame in frames]
+
+
+def map_entries_to_trade_rows(entries: Union[List[TradesEntry], TradeBatch], exchange_id: int,
+                              currency_id: int) -> List[Dict[str, Any]]:
+    if isinstance(entries, TradeBatch):
+        return entries.to_rows(exchange_id, currency_id)
+
+    return [map_entry_to_trade_row(entry, exchange_id, currency_id) for entry in entries]
+
+
+def map_entry_to_trade_row(entry: TradesEntry, exchange_id: int, currency_id: int) -> Dict[str, Any]:
+    return {
+        'price': entry.price,
+        'volume': entry.volume,
+        'direction': entry.direction,
+        'date': entry.date,
+        'exchange_id': exchange_id,
+        'currency_id': currency_id
+    }
+
+
+def chunks(sequence: Sequence, chunk_size: int) -> Iterator[Sequence]:
+    """
+    Splits a sequence in consecutive slices of chunk_size elements. The last one may be shorter
+    """
+    if chunk_size <= 0:
+        raise ValueError('chunk_size should be greater than 0')
+
+    for i in range(0, len(sequence), chunk_size):
+        yield sequence[i:i + chunk_size]
+
+
+def map_ohlc_to_frame(ohlc: 'OHLC') -> OhlcFrame:
     return OhlcFrame(
         open=ohlc.open,
         high=ohlc.high,
@@ -1,33 +1,153 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 
+import requests
 from dateutil import tz
 from datetime import datetime
 
 from core.BaseIntegration import BaseCryptoIntegration
 from core.configCore import MarketConfig
+from core.JsonDecoder import response_json
+from core.RateLimiter import get_rate_limiter, ExponentialBackoff, check_response
 from cryptoCompare import CryptoCompareIntegrationConfig
 from cryptoCompare.CryptoComparePersistence import CsvPersistor
+from config import BaseConfig
 import core.Constants as Constants
 
 logger = logging.getLogger('FortacrypLogger')
 
+HOUR_SEC = 3600
+PAGE_HOURS = 2000  # max limit of histohour
+BACKFILL_FILE_NAME = 'cryptoCompare_{}.csv.backfill'
+
 
 class CryptoCompareIntegration(BaseCryptoIntegration):
     def __init__(self, config: CryptoCompareIntegrationConfig):
         super().__init__(config, CsvPersistor('./'))
+        self.rate_limiter = get_rate_limiter('CryptoCompare', getattr(config, 'sleep_time_sec', None))
         self.to_currency: str = 'USD'
         self.should_log: bool = True
 
+    def backfill(self, market_id: str, workers: int = BaseConfig.Exchanges.CryptoCompare.backfill_workers) -> None:
+        """
+        Recovers all the hourly history of a market from retrieve_from_onward to now. Unlike the regular
+        recovery, that has to wait for each response to know the toTs of the next request, the pages of
+        histohour are fixed time windows of PAGE_HOURS hours, so they are known beforehand and requested
+        by a pool of workers (all of them sharing the rate limiter of the exchange). The pages are persisted
+        in chronological order to a staging csv (BACKFILL_FILE_NAME), and each one is marked as done in the
+        market config, so an aborted backfill resumes from the pages that were not persisted. Once all of them
+        are, the staging csv is merged with the csv of the market, whatever it had stored before.
+        A page that keeps failing with 429, 5xx or network errors, or that fails with any other status
+        (e.g. 401 of a wrong api key), aborts the backfill with that error.
+        :param market_id: name of the cryptocurrency in short format, e.g. 'btc'
+        :param workers: number of pages requested at the same time
+        """
+        if not hasattr(self.config, market_id):
+            setattr(self.config, market_id, MarketConfig(market_id))
+
+        market_config: MarketConfig = getattr(self.config, market_id)
+        self.persistor.set_market(market_id)
+        self._validate_persistor()
+
+        now = int(time.time()) // HOUR_SEC * HOUR_SEC
+        shards = self._get_backfill_shards(now)
+        if len(shards) == 0:
+            return
+
+        done = set(market_config.backfilled_shards)
+        pending = [shard for shard in shards if shard[0] not in done]
+
+        # the csv of the market only takes ticks older or newer than the ones it has, so the shards go to
+        # a file of their own
+        staging = CsvPersistor(self.persistor.save_path, BACKFILL_FILE_NAME)
+        staging.set_market(market_id)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map yields the results in the order of the shards, no matter which worker finishes first
+            pages = executor.map(lambda shard: self._fetch_shard(market_id, shard), pending)
+
+            for (from_ts, to_ts), data in zip(pending, pages):
+                staging.persist(data)
+
+                # the last window is incomplete until PAGE_HOURS have passed, it is requested again next time
+                if to_ts - from_ts == (PAGE_HOURS - 1) * HOUR_SEC:
+                    market_config.backfilled_shards.append(from_ts)
+
+                market_config.current_request_timestamp = to_ts
+                self.config.persist()
+                self._do_loging(Constants.REQUESTED, market_config)
+
+        self.persistor.merge(staging)
+        market_config.first_stored_timestamp = shards[0][0]
+        market_config.last_stored_timestamp = now
+        market_config.most_recent_timestamp = now
+        market_config.current_request_timestamp = None
+        market_config.recovered_all = True
+        self.config.persist()
+        self._do_loging(Constants.RECOVERED, market_config)
+
+    def _get_backfill_shards(self, now: int) -> List[Tuple[int, int]]:
+        """
+        Splits the time from retrieve_from_onward to now into windows of PAGE_HOURS hours. The windows are
+        aligned to retrieve_from_onward, so they are the same each time the backfill is executed
+        :param now: the timestamp of the current hour
+        :return: list of (from, to) timestamps, both inclusive
+        """
+        start = self.config.retrieve_from_onward // HOUR_SEC * HOUR_SEC
+        page_sec = PAGE_HOURS * HOUR_SEC
+
+        return [(from_ts, min(from_ts + page_sec - HOUR_SEC, now)) for from_ts in range(start, now + 1, page_sec)]
+
+    def _fetch_shard(self, market_id: str, shard: Tuple[int, int],
+                     max_attempts: int = BaseConfig.Exchanges.CryptoCompare.backfill_max_attempts) -> List[dict]:
+        """
+        Requests the window of the shard, retrying with backoff the 429, 5xx and network errors. Executed by
+        the workers of the backfill, so it should not modify the state of the integration
+        :param market_id: name of the cryptocurrency in short format, e.g. 'btc'
+        :param shard: (from, to) timestamps of the window
+        :param max_attempts: the error of the last attempt is raised after this many
+        :return: the ticks of the window
+        """
+        from_ts, to_ts = shard
+        url = self._get_histohour_url(market_id, to_ts)
+        backoff = ExponentialBackoff(max_sec=getattr(self.config, 'sleep_time_after_block',
+                                                     BaseConfig.RateLimit.backoff_max_sec))
+
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            try:
+                r = self.requests.get(url)
+                # any other status than 429 or 5xx raises ResponseError, that is not retried
+                check_response(r)
+
+                data = response_json(r)['Data']
+                # the response includes the hour before the window, that belongs to the previous shard
+                return [tick for tick in data if from_ts <= tick['time'] <= to_ts]
+
+            except (requests.RequestException, ConnectionError) as e:
+                if backoff.attempts + 1 >= max_attempts:
+                    raise
+
+                if self.should_log:
+                    logger.warning('CryptoCompare-{}: page to {} failed, retrying. {}'.format(market_id, to_ts, e))
+
+                backoff.wait(e)
+
+    def _get_histohour_url(self, market_id: str, to_ts: int = None) -> str:
+        timestamp_url = '&toTs={}'.format(to_ts) if to_ts is not None else ''
+
+        return '{}?limit={}&fsym={}&tsym={}{}'.format(self.config.base_url,
+                                                      PAGE_HOURS,
+                                                      market_id.upper(),
+                                                      self.to_currency,
+                                                      timestamp_url)
+
     def _generate_url(self, market_config: MarketConfig) -> str:
-        if market_config.current_request_timestamp is not None:
-            timestamp_url = '&toTs={}'.format(market_config.current_request_timestamp)
-        else:
-            timestamp_url = ''
-
-        return '{}?limit=2000&fsym={}&tsym={}{}'.format(self.config.base_url,
-                                                        market_config.market_id.upper(),
-                                                        self.to_currency,
-                                                        timestamp_url)
+        return self._get_histohour_url(market_config.market_id, market_config.current_request_timestamp)
 
     def _do_loging(self, action, market_config: MarketConfig, **kwargs) -> None:
         if not self.should_log:
@@ -1,5 +1,9 @@
+import heapq
 import os
-from typing import List, Union, Dict, Optional
+import shutil
+from typing import List, Union, Dict, Optional, Iterator, Tuple
+
+from core.CsvFile import OHLC_CSV_HEADER, append_lines
 
 
 def _tick_to_line(ticks: List[Dict[str, Union[float, int]]]) -> List[str]:
@@ -92,34 +96,243 @@ def _save_list(l: list, path: str):
             file.write(line)
 
 
+def _read_last_line(path: str, block_size: int = 1024) -> str:
+    """
+    Reads the last non empty line of a file, reading it backwards by blocks, so the cost doesnt depend
+    on the size of the file.
+    :param path: path of the file
+    :param block_size: bytes read each time from the ending of the file
+    :return: the last line, or an empty string if the file is empty
+    """
+    with open(path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        position = file.tell()
+        buffer = b''
+
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            file.seek(position)
+            buffer = file.read(read_size) + buffer
+            stripped = buffer.rstrip()
+
+            if b'\n' in stripped or position == 0:
+                return stripped.rsplit(b'\n', 1)[-1].decode('utf-8').strip()
+
+    return ''
+
+
+def _read_first_line(path: str) -> str:
+    """
+    Reads the first line of the file that contains data, skipping the header if it has one
+    :param path: path of the file
+    :return: the first line with data, or an empty string if there is no data
+    """
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line != '' and line != OHLC_CSV_HEADER:
+                return line
+
+    return ''
+
+
+def _line_to_timestamp(line: str) -> Optional[int]:
+    if line == '' or line == OHLC_CSV_HEADER:
+        return None
+
+    return int(line.split(',')[0])
+
+
+def _iterate_lines(path: str, priority: int) -> Iterator[Tuple[int, int, str]]:
+    """
+    :return: (time, priority, line) of each line with data of the file, in the order of the file
+    """
+    if not os.path.isfile(path):
+        return
+
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line != '' and line != OHLC_CSV_HEADER:
+                yield int(line.split(',')[0]), priority, line
+
+
+def _merge_files(stored_path: str, new_path: str, out_path: str) -> None:
+    """
+    Merges two csv files sorted by time into out_path, line by line. When both have the same time, the line
+    of new_path is the one kept
+    """
+    with open(out_path, 'w') as out:
+        out.write(OHLC_CSV_HEADER)
+        last_time = None
+
+        for timestamp, _, line in heapq.merge(_iterate_lines(new_path, 0), _iterate_lines(stored_path, 1)):
+            if timestamp != last_time:
+                out.write('\n' + line)
+                last_time = timestamp
+
+
 class CsvPersistor:
     """
     A persistor for crypto compare integration. It should store new data in correct order in some way.
     In this case csvPersistor stores in a csv file, either prepending or appending new data from current
     file. You can add other persistor, its only requisite is to have a persistor method wich receives a list.
     ... And maybe change its constructor, but you can do better
+
+    The csv file is never rewritten on each request. Newer data is appended at the end of the file, and
+    older data (the one that should be prepended) is staged in segment files next to the csv, one per
+    request. The segments are stitched into the csv only once, when flush is called, usually after
+    all historical data has been recovered. The timestamps of the edges of the file are kept in memory, so
+    only the head and the tail of the file are read to know them.
     """
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, file_name: str = 'cryptoCompare_{}.csv'):
+        """
+        :param path: folder of the csv files
+        :param file_name: name of the csv file, formatted with the market
+        """
         self.save_path: str = path
         self.market: Optional[str] = None
+        self.file_name: str = file_name
+        self.segment_name: str = file_name + '.segment{}'
+        self._first_timestamp: Optional[int] = None
+        self._last_timestamp: Optional[int] = None
+        self._segments: List[str] = []  # ordered from the newest segment to the oldest one
+        self._is_loaded: bool = False
 
     def set_market(self, market: str):
         self.market = market
+        self._first_timestamp = None
+        self._last_timestamp = None
+        self._segments = []
+        self._is_loaded = False
 
     def persist(self, entry_list: List[Dict[str, Union[float, int]]]):
         if self.market is None:
             raise AttributeError('market attribute of the instance should not be None')
 
-        save_path = os.path.join(os.path.realpath(self.save_path), 'cryptoCompare_' + self.market + '.csv')
+        if not self._is_loaded:
+            self._load_state()
+
+        if entry_list is None or len(entry_list) == 0:
+            return
+
+        save_path = self._get_save_path()
+
+        if self._last_timestamp is None:
+            _save_list([OHLC_CSV_HEADER] + _tick_to_line(entry_list), save_path)
+            self._first_timestamp = int(entry_list[0]['time'])
+            self._last_timestamp = int(entry_list[-1]['time'])
+            return
+
+        older = [tick for tick in entry_list if tick['time'] < self._first_timestamp]
+        newer = [tick for tick in entry_list if tick['time'] > self._last_timestamp]
+
+        if len(older) > 0:
+            self._stage_segment(older)
+
+        if len(newer) > 0:
+            append_lines(_tick_to_line(newer), save_path)
+            self._last_timestamp = int(newer[-1]['time'])
+
+    def flush(self) -> None:
+        """
+        Stitches the staged segments at the beginning of the csv file. The file is rewritten once,
+        copying the stored data in chunks instead of loading it in memory
+        """
+        if self.market is None:
+            return
+
+        # the segments left by an execution that was interrupted are stitched too
+        if not self._is_loaded:
+            self._load_state()
+
+        if len(self._segments) == 0:
+            return
+
+        save_path = self._get_save_path()
+        tmp_path = save_path + '.tmp'
+
+        with open(tmp_path, 'w') as out:
+            out.write(OHLC_CSV_HEADER)
+
+            for segment in reversed(self._segments):
+                with open(segment) as file:
+                    out.write('\n' + file.read().strip('\n'))
+
+            if os.path.isfile(save_path):
+                with open(save_path) as file:
+                    first_line = file.readline()
+                    if first_line.strip() != OHLC_CSV_HEADER:
+                        out.write('\n' + first_line)
+                    else:
+                        out.write('\n')
+
+                    shutil.copyfileobj(file, out)
+
+        os.replace(tmp_path, save_path)
+
+        for segment in self._segments:
+            os.remove(segment)
+
+        self._segments = []
+
+    def merge(self, other: 'CsvPersistor') -> None:
+        """
+        Moves the data of other, a persistor of the same market and folder that writes another file, into
+        the csv of this one. Unlike persist, the data of other may overlap the stored one in any way (e.g.
+        the whole history recovered by a backfill, over the hours already stored), since the files are merged
+        by time. Other's ticks replace the stored ones of the same time. The file of other is removed
+        """
+        if self.market is None:
+            raise AttributeError('market attribute of the instance should not be None')
+
+        self.flush()
+        other.flush()
+
+        save_path = self._get_save_path()
+        other_path = other._get_save_path()
+        if not os.path.isfile(other_path):
+            return
+
+        tmp_path = save_path + '.tmp'
+        _merge_files(save_path, other_path, tmp_path)
+        os.replace(tmp_path, save_path)
+        os.remove(other_path)
+
+        # the edges of the file are read again on the next persist
+        self.set_market(self.market)
+        other.set_market(other.market)
+
+    def _stage_segment(self, ticks: List[Dict[str, Union[float, int]]]) -> None:
+        path = self._get_segment_path(len(self._segments))
+        _save_list(_tick_to_line(ticks), path)
+        self._segments.append(path)
+        self._first_timestamp = int(ticks[0]['time'])
+
+    def _load_state(self) -> None:
+        """
+        Recovers the timestamps of the edges of the stored data, taking in count the segments
+        left by a previous execution that didnt flush them
+        """
+        save_path = self._get_save_path()
+        self._segments = []
 
         if os.path.isfile(save_path):
-            with open(save_path) as file:
-                # readlines function doesnt split with each line!!.
-                line_list = file.read().split('\n')
-                line_list = _merge_stored_with_recovered_lists(entry_list, line_list)
+            self._first_timestamp = _line_to_timestamp(_read_first_line(save_path))
+            self._last_timestamp = _line_to_timestamp(_read_last_line(save_path))
+
+        segment = self._get_segment_path(0)
+        while os.path.isfile(segment):
+            self._segments.append(segment)
+            self._first_timestamp = _line_to_timestamp(_read_first_line(segment))
+            segment = self._get_segment_path(len(self._segments))
+
+        self._is_loaded = True
 
-        else:
-            line_list = _tick_to_line(entry_list)
+    def _get_segment_path(self, index: int) -> str:
+        return os.path.join(os.path.realpath(self.save_path), self.segment_name.format(self.market, index))
 
-        _save_list(line_list, save_path)
+    def _get_save_path(self) -> str:
+        return os.path.join(os.path.realpath(self.save_path), self.file_name.format(self.market))
@@ -1,11 +1,15 @@
 import json
+import os
+import tempfile
+import time
 from unittest import TestCase, mock
 
 from core.configCore import MarketConfig
-from cryptoCompare.CryptoCompareIntegration import CryptoCompareIntegration
+from core.RateLimiter import ResponseError, RetryableResponseError
+from cryptoCompare.CryptoCompareIntegration import CryptoCompareIntegration, HOUR_SEC, PAGE_HOURS
 from cryptoCompare.CryptoCompareIntegrationConfig import CryptoCompareConfig
 from cryptoCompare.CryptoComparePersistence import _merge_prepend, _merge_append, _tick_to_line, \
-    _merge_stored_with_recovered_lists
+    _merge_stored_with_recovered_lists, _read_last_line, CsvPersistor
 
 _stored = [
     'time,open,high,low,close,volumefrom',
@@ -117,22 +121,118 @@ class PersistenseTests(TestCase):
         self.assertEqual(copy_stored, result)
 
 
+def _read_csv_times(path: str) -> list:
+    with open(path) as file:
+        lines = file.read().split('\n')
+
+    return [int(line.split(',')[0]) for line in lines[1:]]
+
+
+class CsvPersistorTests(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.persistor = CsvPersistor(self.tmp_dir.name)
+        self.persistor.set_market('btc')
+        self.path = os.path.join(self.tmp_dir.name, 'cryptoCompare_btc.csv')
+
+        # reuses the fixtures of the merge tests
+        fixtures = PersistenseTests()
+        fixtures.setUp()
+        self.tickets_prepend = fixtures.tickets_prepend
+        self.tickets_append = fixtures.tickets_append
+        self.stored = fixtures.stored
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_new_file_has_header(self):
+        self.persistor.persist(self.tickets_append)
+
+        with open(self.path) as file:
+            lines = file.read().split('\n')
+
+        self.assertEqual('time,open,high,low,close,volumefrom', lines[0])
+        self.assertEqual(_tick_to_line(self.tickets_append), lines[1:])
+
+    def test_append_only_newer(self):
+        with open(self.path, 'w') as file:
+            file.write('\n'.join(self.stored))
+
+        self.persistor.persist(self.tickets_append)
+        times = _read_csv_times(self.path)
+
+        self.assertEqual(9, len(times))
+        self.assertEqual(sorted(set(times)), times)
+
+    def test_prepend_is_staged_until_flush(self):
+        with open(self.path, 'w') as file:
+            file.write('\n'.join(self.stored))
+
+        self.persistor.persist(self.tickets_prepend)
+        # the csv remains untouched until flush is called
+        self.assertEqual(6, len(_read_csv_times(self.path)))
+
+        self.persistor.flush()
+        times = _read_csv_times(self.path)
+        self.assertEqual(10, len(times))
+        self.assertEqual(sorted(set(times)), times)
+        self.assertEqual(['cryptoCompare_btc.csv'], os.listdir(self.tmp_dir.name))
+
+    def test_resume_staged_segments(self):
+        with open(self.path, 'w') as file:
+            file.write('\n'.join(self.stored))
+
+        self.persistor.persist(self.tickets_prepend[2:])
+
+        # a new instance should recognize the segments left by an aborted execution
+        persistor = CsvPersistor(self.tmp_dir.name)
+        persistor.set_market('btc')
+        persistor.persist(self.tickets_prepend[:3])
+        persistor.flush()
+
+        times = _read_csv_times(self.path)
+        self.assertEqual(10, len(times))
+        self.assertEqual(sorted(set(times)), times)
+
+    def test_flush_stitches_segments_of_previous_execution(self):
+        with open(self.path, 'w') as file:
+            file.write('\n'.join(self.stored))
+
+        self.persistor.persist(self.tickets_prepend)
+
+        # flush of a new instance, before anything is persisted with it
+        persistor = CsvPersistor(self.tmp_dir.name)
+        persistor.set_market('btc')
+        persistor.flush()
+
+        times = _read_csv_times(self.path)
+        self.assertEqual(10, len(times))
+        self.assertEqual(sorted(set(times)), times)
+        self.assertEqual(['cryptoCompare_btc.csv'], os.listdir(self.tmp_dir.name))
+
+    def test_read_last_line(self):
+        with open(self.path, 'w') as file:
+            file.write('\n'.join(self.stored) + '\n\n')
+
+        self.assertEqual(self.stored[-1], _read_last_line(self.path, block_size=8))
+
+
 class MockResponse:
     def __init__(self, json_data: dict, status_code):
         self.text = json.dumps(json_data)
         self.status_code = status_code
-
-
-m = mock.mock_open(read_data="\n".join(_stored))
+        self.headers = {}
 
 
 @mock.patch('time.sleep', return_value=True)
-@mock.patch('builtins.open', m)
 class CryptoCompareIntegrationTest(TestCase):
     def setUp(self) -> None:
         config = CryptoCompareConfig()
         config.retrieve_from_onward = 1364774400
+        self.tmp_dir = tempfile.TemporaryDirectory()
         self.integration = CryptoCompareIntegration(config)
+        self.integration.persistor = CsvPersistor(self.tmp_dir.name)
+        self.integration.rate_limiter = None  # so the tests dont take tokens from the real bucket
         self.integration.should_log = False  # using dateutils gettz makes travis ci fails for some reason
         # this doesn't ocurr when testing on wind 10 or ubuntu 18.04 (where i tested)
         self.call_count = 0
@@ -324,6 +424,9 @@ class CryptoCompareIntegrationTest(TestCase):
             "HasWarning": False
         }
 
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
     def test_generate_url_no_timestamp(self, *args):
         url = self.integration._generate_url(self.market_config)
         expected = 'https://min-api.cryptocompare.com/data/histohour?limit=2000&fsym=BTC&tsym=USD'
@@ -353,7 +456,7 @@ class CryptoCompareIntegrationTest(TestCase):
         self.market_config.last_stored_timestamp = 1554807600
         self.integration.config.btc = self.market_config
 
-        with mock.patch('core.BaseIntegration.requests.get', side_effect=self.mock_request_get):
+        with mock.patch.object(self.integration.requests, 'get', side_effect=self.mock_request_get):
             self.integration.recover_btc()
 
         self.assertEqual(1, self.call_count)
@@ -364,11 +467,15 @@ class CryptoCompareIntegrationTest(TestCase):
         persisted. Since the requests are mocked, it should only execute 3 calls, but the integration
         has to recognize the end condition.
         """
-        with mock.patch('core.BaseIntegration.requests.get', side_effect=self.mock_request_get):
+        with mock.patch.object(self.integration.requests, 'get', side_effect=self.mock_request_get):
             self.integration.recover_btc()
 
         self.assertEqual(3, self.call_count)
 
+        times = _read_csv_times(os.path.join(self.tmp_dir.name, 'cryptoCompare_btc.csv'))
+        self.assertEqual(sorted(set(times)), times)
+        self.assertEqual(14, len(times))
+
     def mock_request_get(self, *args):
         # if call_count is 0 or timestamp is none
         response = self.response_1
@@ -380,3 +487,84 @@ class CryptoCompareIntegrationTest(TestCase):
         if self.call_count > 2:
             response = self.response_3
         return MockResponse(response, 200)
+
+
+class BackfillTests(TestCase):
+    def setUp(self) -> None:
+        self.now = int(time.time()) // HOUR_SEC * HOUR_SEC
+        config = CryptoCompareConfig()
+        # 3 windows, the last one incomplete
+        config.retrieve_from_onward = self.now - 5000 * HOUR_SEC
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.integration = CryptoCompareIntegration(config)
+        self.integration.persistor = CsvPersistor(self.tmp_dir.name)
+        self.integration.rate_limiter = None
+        self.integration.should_log = False
+        self.requested = []
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def mock_request_get(self, url, *args, **kwargs):
+        to_ts = int(url.split('toTs=')[1])
+        self.requested.append(to_ts)
+        # like the real api, responds limit + 1 hours
+        data = [{'time': ts, 'open': 1, 'high': 1, 'low': 1, 'close': 1, 'volumefrom': 1}
+                for ts in range(to_ts - PAGE_HOURS * HOUR_SEC, to_ts + 1, HOUR_SEC)]
+        return MockResponse({'Data': data}, 200)
+
+    def test_backfill_persist_in_order(self):
+        with mock.patch.object(self.integration.requests, 'get', side_effect=self.mock_request_get):
+            self.integration.backfill('btc', workers=3)
+
+        times = _read_csv_times(os.path.join(self.tmp_dir.name, 'cryptoCompare_btc.csv'))
+        expected = list(range(self.now - 5000 * HOUR_SEC, self.now + 1, HOUR_SEC))
+        self.assertEqual(expected, times)
+
+        market_config = self.integration.config.btc
+        self.assertTrue(market_config.recovered_all)
+        self.assertEqual(self.now, market_config.last_stored_timestamp)
+        # the incomplete window is not marked as done
+        self.assertEqual(2, len(market_config.backfilled_shards))
+
+    def test_backfill_resumes_pending_shards(self):
+        first_shard = self.now - 5000 * HOUR_SEC
+        self.integration.config.btc = MarketConfig('btc', backfilled_shards=[first_shard])
+
+        with mock.patch.object(self.integration.requests, 'get', side_effect=self.mock_request_get):
+            self.integration.backfill('btc')
+
+        self.assertEqual(2, len(self.requested))
+        self.assertNotIn(first_shard + (PAGE_HOURS - 1) * HOUR_SEC, self.requested)
+
+    def test_backfill_over_existing_csv(self):
+        # the last 100 hours were stored by a regular recovery
+        path = os.path.join(self.tmp_dir.name, 'cryptoCompare_btc.csv')
+        with open(path, 'w') as file:
+            file.write('\n'.join(['time,open,high,low,close,volumefrom'] +
+                                 ['{},2,2,2,2,2'.format(ts) for ts in range(self.now - 99 * HOUR_SEC,
+                                                                            self.now + 1, HOUR_SEC)]))
+
+        with mock.patch.object(self.integration.requests, 'get', side_effect=self.mock_request_get):
+            self.integration.backfill('btc', workers=3)
+
+        expected = list(range(self.now - 5000 * HOUR_SEC, self.now + 1, HOUR_SEC))
+        self.assertEqual(expected, _read_csv_times(path))
+        self.assertEqual(['cryptoCompare_btc.csv'], os.listdir(self.tmp_dir.name))
+
+    def test_fetch_shard_does_not_retry_client_errors(self):
+        with mock.patch.object(self.integration.requests, 'get', return_value=MockResponse({}, 401)) as get:
+            with self.assertRaises(ResponseError):
+                self.integration.backfill('btc')
+
+        # at most one request per shard, none of them retried
+        self.assertLessEqual(get.call_count, 3)
+        self.assertEqual([], self.integration.config.btc.backfilled_shards)
+
+    @mock.patch('time.sleep', return_value=True)
+    def test_fetch_shard_retries_are_limited(self, *args):
+        with mock.patch.object(self.integration.requests, 'get', return_value=MockResponse({}, 503)) as get:
+            with self.assertRaises(RetryableResponseError):
+                self.integration._fetch_shard('btc', (self.now - HOUR_SEC, self.now), max_attempts=3)
+
+        self.assertEqual(3, get.call_count)
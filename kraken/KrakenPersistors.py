@@ -1,79 +1,167 @@
-from typing import List, Dict, Optional
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Iterator
 
 from sqlalchemy.orm import Session
 
 from config import BaseConfig
-from core.BasePersistor import BasePersistor
+from core.BasePersistor import BasePersistor, Frames, Entries
 from core.Enums import Mnemonic
-from core.model.CoreModels import TradesEntry, OhlcFrame
-from core.model.models import Trades, OHLC, CryptoCurrency, Exchange
+from core.model.CoreModels import TradesEntry
+from core.model.models import Trades, OHLC, CryptoCurrency, Exchange, OHLC_UNIQUE_COLUMNS, TRADES_UNIQUE_COLUMNS
+from core.orm import queries
+from core.orm.bulk import bulk_insert
 from core.orm.orm import session as session_maker
-from core.utils import map_frame_to_ohlc, map_ohlc_to_frame
+from core.orm.upsert import build_upsert
+from core.utils import map_frames_to_ohlc_rows, map_entries_to_trade_rows, chunks
 
 
 class KrakenPersistor(BasePersistor):
-    def __init__(self):
+    """
+    Each call opens its own session, unless it is made inside unit_of_work, which keeps a single session for
+    all of them. An instance (and so its unit of work) should be used by a single thread
+    """
+
+    def __init__(self, chunk_size: int = BaseConfig.DBConnection.insert_chunk_size):
+        super().__init__()
         self.recover_from = BaseConfig.Exchanges.Kraken.recover_from
+        self.chunk_size = chunk_size  # frames inserted per statement. Each chunk is commited on its own
         self.session_maker = session_maker
+        self._session: Optional[Session] = None  # the session of the current unit of work
         self.market_config = None
         self.nemo_index: Dict[str, int] = {}
         self._load_mnemonic()
         self.kraken_id = self._load_kraken_id()
 
-    def persist_ohlc(self, tick_list: List[OhlcFrame], nemo: Mnemonic) -> None:
+    @contextmanager
+    def unit_of_work(self) -> Iterator[Session]:
+        """
+        Keeps a single session for every call made inside the block (usually a whole ingestion loop, as
+        CoreIntegration.do_main_loop does) instead of opening and closing one per call. The writes are still
+        commited by each call
+        """
+        if self._session is not None:
+            # nested, the outer block owns the session
+            yield self._session
+            return
+
+        self._session = self.session_maker()
+        try:
+            yield self._session
+        finally:
+            self._session.close()
+            self._session = None
+
+    def persist_ohlc(self, tick_list: Frames, nemo: Mnemonic) -> None:
         to_update, new = self.merge_ohlc_with_last(tick_list, nemo)
-        session: Session = self.session_maker()
+        session: Session = self._open_session()
+
+        currency_id = self.nemo_index[nemo.value]
 
         try:
             if to_update is not None:
-                session.add(to_update)
+                session.query(OHLC) \
+                    .filter(OHLC.exchange_id == self.kraken_id, OHLC.currency_id == currency_id,
+                            OHLC.date == to_update.date) \
+                    .update({'open': to_update.open, 'high': to_update.high, 'low': to_update.low,
+                             'close': to_update.close, 'volume': to_update.volume}, synchronize_session=False)
+                session.commit()
+
+            # uses a core insert instead of the ORM so every chunk is sent as a single statement
+            for chunk in chunks(new, self.chunk_size):
+                bulk_insert(session, OHLC.__table__, map_frames_to_ohlc_rows(chunk, self.kraken_id, currency_id))
+                session.commit()
+
+            self._set_newest_ohlc(nemo, to_update, new)
 
-            for entry in new:
-                ohlc = map_frame_to_ohlc(entry)
-                ohlc.currency_id = self.nemo_index[nemo.value]
-                ohlc.exchange_id = self.kraken_id
+        except Exception as e:
+            session.rollback()
+            # some chunks may have been commited, so the newest stored frame is unknown
+            self.invalidate_newest_ohlc(nemo)
+            raise e
+        finally:
+            self._close_session(session)
+
+    def persist_entry(self, entry_list: Entries, nemo: Mnemonic) -> None:
+        """
+        Inserts the trades in chunks of chunk_size, each one in a single statement (COPY with postgres) and
+        commited on its own. The trades already stored, or repeated in the list, are ignored
+        """
+        currency_id = self.nemo_index[nemo.value]
+        session: Session = self._open_session()
 
-                session.add(ohlc)
+        try:
+            for chunk in chunks(entry_list, self.chunk_size):
+                bulk_insert(session, Trades.__table__, map_entries_to_trade_rows(chunk, self.kraken_id, currency_id),
+                            TRADES_UNIQUE_COLUMNS)
                 session.commit()
 
         except Exception as e:
             session.rollback()
             raise e
         finally:
-            session.close()
+            self._close_session(session)
+
+    def upsert_ohlc(self, tick_list: Frames, nemo: Mnemonic) -> None:
+        currency_id = self.nemo_index[nemo.value]
+        rows = map_frames_to_ohlc_rows(tick_list, self.kraken_id, currency_id)
+        try:
+            self._execute_upsert(OHLC.__table__, OHLC_UNIQUE_COLUMNS, ('open', 'high', 'low', 'close', 'volume'),
+                                 rows)
+        finally:
+            # the upserted frames may be newer than the cached one, or overwrite it
+            self.invalidate_newest_ohlc(nemo)
 
-    def persist_entry(self, entry_list: List[TradesEntry], nemo: Mnemonic) -> None:
-        pass
+    def upsert_entry(self, entry_list: Entries, nemo: Mnemonic) -> None:
+        currency_id = self.nemo_index[nemo.value]
+        rows = map_entries_to_trade_rows(entry_list, self.kraken_id, currency_id)
+        self._execute_upsert(Trades.__table__, TRADES_UNIQUE_COLUMNS, (), rows)
+
+    def _execute_upsert(self, table, conflict_columns, update_columns, rows: List[dict]) -> None:
+        session: Session = self._open_session()
+
+        try:
+            stmt = build_upsert(table, conflict_columns, update_columns, session.bind.dialect.name)
+            for chunk in chunks(rows, self.chunk_size):
+                session.execute(stmt, chunk)
+                session.commit()
+
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            self._close_session(session)
 
     def _get_newest_ohlc_dto(self, nemo: Mnemonic) -> OHLC:
-        return self._do_recovery(nemo, OHLC.date.desc())
+        return self._do_recovery(nemo, queries.get_newest_ohlc)
 
     def _get_oldest_ohlc_dto(self, nemo: Mnemonic) -> OHLC:
-        return self._do_recovery(nemo, OHLC.date.asc())
+        return self._do_recovery(nemo, queries.get_oldest_ohlc)
 
     def get_newest_trade(self, nemo: Mnemonic) -> TradesEntry:
-        id_currency = self.nemo_index[nemo.value]
-
-        session: Session = self.session_maker()
-        res: Trades = session.query(Trades) \
-            .filter(Trades.currency_id == id_currency) \
-            .order_by(Trades.date.desc()).first()
-
-        session.close()
+        res: Optional[Trades] = self._do_recovery(nemo, queries.get_newest_trade)
 
         if res is not None:
             return TradesEntry(price=res.price, volume=res.volume, direction=res.direction, date=res.date)
 
-    def _do_recovery(self, nemo: Mnemonic, order) -> Optional[OHLC]:
+    def _do_recovery(self, nemo: Mnemonic, lookup):
+        """
+        :param lookup: one of the lookups of core.orm.queries, that receives the session, exchange and currency
+        """
         id_currency = self.nemo_index[nemo.value]
 
-        session: Session = self.session_maker()
-        res: Optional[OHLC] = session.query(OHLC)\
-            .filter(OHLC.currency_id == id_currency and OHLC.exchange_id == self.kraken_id)\
-            .order_by(order).first()
+        session: Session = self._open_session()
+        try:
+            return lookup(session, self.kraken_id, id_currency)
+        finally:
+            self._close_session(session)
 
-        session.close()
-        return res
+    def _open_session(self) -> Session:
+        return self._session if self._session is not None else self.session_maker()
+
+    def _close_session(self, session: Session) -> None:
+        # the session of the unit of work is closed when the block ends
+        if session is not self._session:
+            session.close()
 
     def _load_mnemonic(self):
         session: Session = self.session_maker()
@@ -2,13 +2,15 @@ from datetime import datetime
 from typing import List
 
 import pytest
+from sqlalchemy import inspect
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
 from sqlalchemy_utils.functions import drop_database
 
 from core.Enums import Mnemonic
-from core.model.CoreModels import OhlcFrame, TradesEntry
-from core.model.models import OHLC, Trades
-from core.orm.createTables import create_tables
+from core.model.CoreModels import OhlcFrame, TradesEntry, OhlcBatch, TradeBatch
+from core.model.models import OHLC, Trades, Exchange
+from core.orm.createTables import create_tables, create_indexes
 from core.orm.orm import Base, engine, connection, session as session_maker
 from kraken.KrakenPersistors import KrakenPersistor
 
@@ -203,3 +205,226 @@ def test_insert_ohlc_with_no_empty_db(instantiate_persistor: KrakenPersistor, oh
     assert oldest_ohlc.close == first.close and oldest_ohlc.volume == first.volume
 
     session.close()
+
+
+def test_insert_ohlc_frames_in_chunks(instantiate_persistor: KrakenPersistor, ohlc_data: List[OhlcFrame]):
+    # 3 frames with a chunk size of 2 should be inserted in 2 statements
+    instantiate_persistor.chunk_size = 2
+    instantiate_persistor.persist_ohlc(ohlc_data, Mnemonic.BTC)
+
+    session: Session = session_maker()
+    all_ohlc: List[OHLC] = session.query(OHLC).order_by(OHLC.date.asc()).all()
+    session.close()
+
+    assert len(all_ohlc) == 3
+    assert [ohlc.date for ohlc in all_ohlc] == [frame.date for frame in ohlc_data]
+    assert all(ohlc.exchange_id == instantiate_persistor.kraken_id for ohlc in all_ohlc)
+    assert all(ohlc.currency_id == instantiate_persistor.nemo_index[Mnemonic.BTC.value] for ohlc in all_ohlc)
+
+
+def test_persist_batches(instantiate_persistor: KrakenPersistor, trades_data: List[TradesEntry],
+                         ohlc_data: List[OhlcFrame]):
+    ohlc_batch = instantiate_persistor.trades_to_ohlc(TradeBatch.from_entries(trades_data))
+    assert isinstance(ohlc_batch, OhlcBatch)
+    assert are_list_equals_helper(list(ohlc_batch), ohlc_data)
+
+    instantiate_persistor.chunk_size = 2
+    instantiate_persistor.persist_ohlc(ohlc_batch[:2], Mnemonic.BTC)
+    # the second frame collides with the stored one, so it is merged instead of inserted
+    instantiate_persistor.persist_ohlc(ohlc_batch[1:], Mnemonic.BTC)
+    instantiate_persistor.upsert_entry(TradeBatch.from_entries(trades_data), Mnemonic.BTC)
+
+    session: Session = session_maker()
+    all_ohlc: List[OHLC] = session.query(OHLC).order_by(OHLC.date.asc()).all()
+    trades_count = session.query(Trades).count()
+    session.close()
+
+    assert [ohlc.date for ohlc in all_ohlc] == [frame.date for frame in ohlc_data]
+    assert all_ohlc[1].volume == ohlc_data[1].volume * 2
+    assert trades_count == len(trades_data)
+
+
+def test_upsert_ohlc_is_idempotent(instantiate_persistor: KrakenPersistor, ohlc_data: List[OhlcFrame]):
+    instantiate_persistor.upsert_ohlc(ohlc_data, Mnemonic.BTC)
+    instantiate_persistor.upsert_ohlc(ohlc_data, Mnemonic.BTC)
+
+    session: Session = session_maker()
+    assert session.query(OHLC).count() == 3
+
+    # an overlapping window overwrites the stored frames with the same date
+    overlapping = [OhlcFrame(1, 2, 0.5, 1.5, ohlc_data[-1].date, 7),
+                   OhlcFrame(1, 2, 0.5, 1.5, ohlc_data[-1].date.replace(hour=15), 7)]
+    instantiate_persistor.upsert_ohlc(overlapping, Mnemonic.BTC)
+
+    all_ohlc: List[OHLC] = session.query(OHLC).order_by(OHLC.date.asc()).all()
+    session.close()
+
+    assert len(all_ohlc) == 4
+    assert all_ohlc[0].open == ohlc_data[0].open and all_ohlc[0].volume == ohlc_data[0].volume
+    assert all_ohlc[2].open == 1 and all_ohlc[2].close == 1.5 and all_ohlc[2].volume == 7
+
+
+def test_upsert_entry_ignores_duplicates(instantiate_persistor: KrakenPersistor, trades_data: List[TradesEntry]):
+    instantiate_persistor.upsert_entry(trades_data, Mnemonic.BTC)
+    instantiate_persistor.upsert_entry(trades_data[:5], Mnemonic.BTC)
+
+    session: Session = session_maker()
+    count = session.query(Trades).count()
+    session.close()
+
+    assert count == len(trades_data)
+
+
+def test_create_missing_indexes():
+    for index in OHLC.__table__.indexes:
+        index.drop(engine)
+
+    created, failed = create_indexes(log=False)
+    names = {index['name'] for index in inspect(engine).get_indexes(OHLC.__table__.name)}
+
+    assert created == ['ix_ohlc_exchange_currency_date'] and failed == []
+    assert 'ix_ohlc_exchange_currency_date' in names
+    assert create_indexes(log=False) == ([], [])
+
+
+def test_create_unique_index_with_duplicated_rows(instantiate_persistor: KrakenPersistor):
+    for index in OHLC.__table__.indexes:
+        index.drop(engine)
+
+    session: Session = session_maker()
+    date = datetime(2019, 1, 2, 12)
+    session.add(OHLC(1, 2, 0.5, 1.5, 10, date, 1, 1))
+    session.add(OHLC(2, 3, 1.5, 2.5, 20, date, 1, 1))
+    session.commit()
+    session.close()
+
+    created, failed = create_indexes(log=False)
+    names = {index['name'] for index in inspect(engine).get_indexes(OHLC.__table__.name)}
+
+    # the unique index is reported, and a non unique one keeps the lookups fast meanwhile
+    assert failed == ['ix_ohlc_exchange_currency_date']
+    assert created == ['ix_ohlc_exchange_currency_date_lookup']
+    assert 'ix_ohlc_exchange_currency_date_lookup' in names
+    assert [index.name for index in OHLC.__table__.indexes] == ['ix_ohlc_exchange_currency_date']
+
+    created, failed = create_indexes(log=False, dedupe=True)
+
+    session = session_maker()
+    rows = session.query(OHLC).all()
+    session.close()
+
+    assert created == ['ix_ohlc_exchange_currency_date'] and failed == []
+    assert len(rows) == 1 and rows[0].open == 1
+
+
+def test_newest_ohlc_is_cached_between_batches(instantiate_persistor: KrakenPersistor, ohlc_data: List[OhlcFrame],
+                                               monkeypatch):
+    instantiate_persistor.persist_ohlc(ohlc_data[:2], Mnemonic.BTC)
+
+    def fail(*args):
+        raise AssertionError('the newest frame should be taken from the cache')
+
+    monkeypatch.setattr(instantiate_persistor, '_get_newest_ohlc_dto', fail)
+    # the first frame collides with the last stored one, the cache must have been updated by the previous write
+    instantiate_persistor.persist_ohlc(ohlc_data[1:], Mnemonic.BTC)
+    monkeypatch.undo()
+
+    assert instantiate_persistor.get_cached_newest_ohlc(Mnemonic.BTC) == ohlc_data[-1]
+    assert instantiate_persistor.get_newest_ohlc(Mnemonic.BTC) == ohlc_data[-1]
+
+    session: Session = session_maker()
+    all_ohlc: List[OHLC] = session.query(OHLC).order_by(OHLC.date.asc()).all()
+    session.close()
+    assert len(all_ohlc) == 3
+    assert all_ohlc[1].volume == ohlc_data[1].volume * 2
+
+
+def test_persist_after_upsert_merges_the_upserted_frame(instantiate_persistor: KrakenPersistor,
+                                                        ohlc_data: List[OhlcFrame]):
+    instantiate_persistor.persist_ohlc(ohlc_data[:1], Mnemonic.BTC)
+    instantiate_persistor.upsert_ohlc(ohlc_data[:2], Mnemonic.BTC)
+    # the first frame collides with the upserted one, it must be merged instead of inserted again
+    instantiate_persistor.persist_ohlc([OhlcFrame(1, 200, 1, 1.5, ohlc_data[1].date, 7), ohlc_data[2]],
+                                       Mnemonic.BTC)
+
+    session: Session = session_maker()
+    all_ohlc: List[OHLC] = session.query(OHLC).order_by(OHLC.date).all()
+    session.close()
+
+    assert [ohlc.date for ohlc in all_ohlc] == [frame.date for frame in ohlc_data]
+    assert all_ohlc[1].open == ohlc_data[1].open and all_ohlc[1].high == 200 and all_ohlc[1].low == 1
+    assert all_ohlc[1].close == 1.5 and all_ohlc[1].volume == ohlc_data[1].volume + 7
+
+
+def test_other_exchange_rows_dont_leak_into_merge(instantiate_persistor: KrakenPersistor,
+                                                   ohlc_data: List[OhlcFrame]):
+    session: Session = session_maker()
+    buda_id = session.query(Exchange.id_exchange).filter(Exchange.name == 'Buda').first().id_exchange
+    btc_id = instantiate_persistor.nemo_index[Mnemonic.BTC.value]
+    # a newer buda frame, that collides with the last kraken frame to persist
+    session.add(OHLC(1, 2, 0.5, 1.5, 100, ohlc_data[-1].date, buda_id, btc_id))
+    trade = Trades(1, 2, ohlc_data[-1].date, 'buy')
+    trade.exchange_id, trade.currency_id = buda_id, btc_id
+    session.add(trade)
+    session.commit()
+    session.close()
+
+    assert instantiate_persistor.get_newest_ohlc(Mnemonic.BTC) is None
+    assert instantiate_persistor.get_oldest_ohlc(Mnemonic.BTC) is None
+    assert instantiate_persistor.get_newest_trade(Mnemonic.BTC) is None
+
+    to_update, new = instantiate_persistor.merge_ohlc_with_last(ohlc_data, Mnemonic.BTC)
+    assert to_update is None
+    assert are_list_equals_helper(new, ohlc_data)
+
+
+def test_sqlite_engine_uses_pool_and_wal():
+    assert isinstance(engine.pool, QueuePool)
+    assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+
+
+def test_unit_of_work_keeps_a_single_session(instantiate_persistor: KrakenPersistor, ohlc_data: List[OhlcFrame],
+                                             monkeypatch):
+    opened = []
+
+    def count_sessions(**kwargs):
+        opened.append(session_maker(**kwargs))
+        return opened[-1]
+
+    monkeypatch.setattr(instantiate_persistor, 'session_maker', count_sessions)
+    with instantiate_persistor.unit_of_work():
+        for frame in ohlc_data:
+            instantiate_persistor.persist_ohlc([frame], Mnemonic.BTC)
+        instantiate_persistor.get_newest_trade(Mnemonic.BTC)
+
+    assert len(opened) == 1
+    assert instantiate_persistor.get_newest_ohlc(Mnemonic.BTC) == ohlc_data[-1]
+    assert len(opened) == 2
+
+
+def test_persist_entry(instantiate_persistor: KrakenPersistor, trades_data: List[TradesEntry]):
+    instantiate_persistor.chunk_size = 5
+    instantiate_persistor.persist_entry(trades_data[:6], Mnemonic.BTC)
+    instantiate_persistor.persist_entry(TradeBatch.from_entries(trades_data[6:]), Mnemonic.BTC)
+
+    session: Session = session_maker()
+    stored: List[Trades] = session.query(Trades).order_by(Trades.date.asc()).all()
+    session.close()
+
+    assert [(trade.price, trade.volume, trade.direction, trade.date) for trade in stored] == \
+           [(entry.price, entry.volume, entry.direction, entry.date) for entry in trades_data]
+    assert instantiate_persistor.get_newest_trade(Mnemonic.BTC) == trades_data[-1]
+
+
+def test_persist_entry_ignores_duplicated_trades(instantiate_persistor: KrakenPersistor,
+                                                 trades_data: List[TradesEntry]):
+    # repeated in the same list, and already stored
+    instantiate_persistor.persist_entry([trades_data[0], trades_data[0], trades_data[1]], Mnemonic.BTC)
+    instantiate_persistor.persist_entry(trades_data[1:3], Mnemonic.BTC)
+
+    session: Session = session_maker()
+    stored: List[Trades] = session.query(Trades).order_by(Trades.date.asc()).all()
+    session.close()
+
+    assert [(trade.price, trade.volume, trade.direction, trade.date) for trade in stored] == \
+           [(entry.price, entry.volume, entry.direction, entry.date) for entry in trades_data[:3]]
@@ -1,9 +1,10 @@
 import os
 from abc import ABC, abstractmethod
 
-import requests
 import logging
 
+from core.HttpSession import get_shared_session
+
 logger = logging.getLogger('FortacrypLogger')
 
 
@@ -28,7 +29,7 @@ class KrakenTelegramAlerts(KrakenBaseAlerts):
         self.chat_id = os.getenv('FORTACRYP_CHAT_ID', None)
         self.should_send = self.bot_id is not None and self.chat_id is not None
         self.url = 'https://api.telegram.org/{}/sendMessage'.format(self.bot_id)
-        self.requests = requests
+        self.requests = get_shared_session()
 
     def send_error_alert(self, message: str) -> None:
         if not self.should_send:
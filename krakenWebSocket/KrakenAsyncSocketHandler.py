@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+from typing import Callable, Awaitable, Dict, List, Tuple, Optional, Any
+
+from config import BaseConfig
+from core.JsonDecoder import loads
+from core.RateLimiter import ExponentialBackoff
+from core.utils import chunks
+from krakenWebSocket.KrakenAlerts import KrakenTelegramAlerts, KrakenBaseAlerts
+
+logger = logging.getLogger('FortacrypLogger')
+
+Consumer = Callable[[list], Awaitable[None]]
+
+
+async def _connect(url: str):
+    try:
+        import websockets
+    except ImportError as e:
+        raise ImportError('The asyncio socket handler needs websockets. Install it with: pip install websockets') from e
+
+    # the pings are the ones of kraken's api (see _recv), so the protocol pings are disabled
+    return await websockets.connect(url, ping_interval=None)
+
+
+class KrakenAsyncSocketHandler:
+    """
+    asyncio version of KrakenSocketHandler. Many channels and pairs can be subscribed, and they are spread in
+    connections of pairs_per_connection subscriptions each. Every data message is dispatched to the consumers
+    (coroutine functions) subscribed to its channel and pair, in the order they arrive to each connection.
+
+    handler = KrakenAsyncSocketHandler()
+    handler.subscribe(['XBT/USD', 'ETH/USD'], on_trade)
+    handler.subscribe(['XBT/USD'], on_book, channel='book')
+    await handler.run()  # until handler.stop() is called, or the reconnections of a connection are exhausted
+
+    stop cancels the connections right away, there is no need to wait for a new message. A connection that
+    receives nothing in ping_interval seconds sends a ping, and it is reconnected if there is no answer in
+    pong_timeout seconds.
+    """
+
+    def __init__(self, url: str = 'wss://ws.kraken.com',
+                 pairs_per_connection: int = BaseConfig.Exchanges.Kraken.pairs_per_connection,
+                 ping_interval: float = BaseConfig.Exchanges.Kraken.ping_interval_sec,
+                 pong_timeout: float = BaseConfig.Exchanges.Kraken.pong_timeout_sec,
+                 connect: Callable[[str], Awaitable[Any]] = _connect):
+        self.socket_url: str = url
+        self.pairs_per_connection: int = pairs_per_connection
+        self.ping_interval: float = ping_interval
+        self.pong_timeout: float = pong_timeout
+        self.connect = connect
+        self.reconnect_attempts_limit: int = 3
+        self.backoff_base_sec: float = BaseConfig.RateLimit.backoff_base_sec
+        self.alert_handler: KrakenBaseAlerts = KrakenTelegramAlerts()
+        # coroutine function called with the pairs of a connection after subscribing again to them, so the
+        # trades missed while disconnected can be recovered
+        self.on_reconnect: Optional[Callable[[List[str]], Awaitable[None]]] = None
+        self.logger = logger
+        self._subscriptions: List[Tuple[str, str]] = []  # (channel, pair)
+        self._consumers: Dict[Tuple[str, str], List[Consumer]] = {}
+        self._tasks: List[asyncio.Future] = []
+        self._stopping: bool = False
+
+    def subscribe(self, pairs: List[str], consumer: Consumer, channel: str = 'trade') -> None:
+        """
+        Should be called before run
+        :param pairs: pairs in the format of the websocket api, e.g. XBT/USD
+        :param consumer: coroutine function that receives each data message of the channel and pairs
+        :param channel: name of the channel, e.g. trade, ticker, book, ohlc, spread
+        """
+        for pair in pairs:
+            key = (channel, pair)
+            if key not in self._consumers:
+                self._subscriptions.append(key)
+                self._consumers[key] = []
+
+            self._consumers[key].append(consumer)
+
+    async def run(self) -> None:
+        self._stopping = False
+        self._tasks = [asyncio.ensure_future(self._manage_connection(group))
+                       for group in chunks(self._subscriptions, self.pairs_per_connection)]
+        try:
+            await asyncio.gather(*self._tasks)
+        except asyncio.CancelledError:
+            if not self._stopping:
+                raise
+        finally:
+            for task in self._tasks:
+                task.cancel()
+
+            self._tasks = []
+
+    def stop(self) -> None:
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+
+    async def _manage_connection(self, subscriptions: List[Tuple[str, str]]) -> None:
+        backoff = ExponentialBackoff(self.backoff_base_sec)
+        has_connected = False
+
+        while True:
+            ws = None
+            try:
+                ws = await self.connect(self.socket_url)
+                await self._subscribe(ws, subscriptions)
+
+                if has_connected and self.on_reconnect is not None:
+                    await self.on_reconnect(sorted({pair for _, pair in subscriptions}))
+
+                has_connected = True
+
+                message = await self._recv(ws)
+                backoff.reset()
+
+                while True:
+                    await self._dispatch(message)
+                    message = await self._recv(ws)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.warning('Kraken socket disconnected: {}'.format(repr(e)))
+                if backoff.attempts + 1 >= self.reconnect_attempts_limit:
+                    self.alert_handler.send_error_alert('Max Attempts to connect to socket exceeded. '
+                                                        'Last error: {}'.format(repr(e)))
+                    raise
+
+                await asyncio.sleep(backoff.next_delay())
+            finally:
+                if ws is not None:
+                    await ws.close()
+
+    async def _subscribe(self, ws, subscriptions: List[Tuple[str, str]]) -> None:
+        pairs_by_channel: Dict[str, List[str]] = {}
+        for channel, pair in subscriptions:
+            pairs_by_channel.setdefault(channel, []).append(pair)
+
+        for channel, pairs in pairs_by_channel.items():
+            self.logger.info('Subscribing to {} of pairs {}'.format(channel, pairs))
+            await ws.send(json.dumps({'event': 'subscribe', 'pair': pairs, 'subscription': {'name': channel}}))
+
+    async def _recv(self, ws) -> str:
+        try:
+            return await asyncio.wait_for(ws.recv(), self.ping_interval)
+        except asyncio.TimeoutError:
+            await ws.send(json.dumps({'event': 'ping'}))
+
+        try:
+            # any message (the pong, a heartbeat or data) proves the connection is alive
+            return await asyncio.wait_for(ws.recv(), self.pong_timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError('No answer to ping in {} seconds'.format(self.pong_timeout))
+
+    async def _dispatch(self, raw: str) -> None:
+        message = loads(raw)
+        if isinstance(message, dict):
+            self._on_event(message)
+            return
+
+        # data messages are [channel id, payload..., channel name, pair], the name may have a suffix (book-10)
+        if not isinstance(message, list) or len(message) < 4:
+            return
+
+        key = (message[-2].split('-')[0], message[-1])
+        for consumer in self._consumers.get(key, ()):
+            try:
+                await consumer(message)
+            except Exception as e:
+                self.logger.error('Error consuming message of {}: {}'.format(key, repr(e)))
+
+    def _on_event(self, event: Dict[str, Any]) -> None:
+        name: Optional[str] = event.get('event')
+        if name == 'subscriptionStatus' and event.get('status') == 'error':
+            self.logger.error('Subscription error: {}'.format(event.get('errorMessage')))
+        elif name == 'systemStatus':
+            self.logger.info('Kraken system status: {}'.format(event.get('status')))
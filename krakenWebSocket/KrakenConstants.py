@@ -3,6 +3,7 @@ VOLUME_INDEX = 1
 TIME_INDEX = 2
 SIDE_INDEX = 3
 MARKET_INDEX = -1
+CHANNEL_INDEX = -2
 TRADE_LIST = 1
 
 REST_TIMESTAMP_INDEX = 0
@@ -1,18 +1,24 @@
+import asyncio
 import datetime
 import json
 import logging
 import threading
 from dataclasses import dataclass
-from typing import Optional, Any, Dict, Union, Tuple
+from typing import Optional, Any, Dict, Union, Tuple, List, Set
 
-import requests
 from websocket import create_connection
 
 import krakenWebSocket.KrakenConstants as Constants
 from core.BaseIntegration import ForwardRecoverIntegration
 from core.Constants import *
+from core.HttpSession import get_shared_session
+from core.JsonDecoder import loads, response_json
+from core.RateLimiter import get_rate_limiter
+from core.WriteBehindQueue import WriteBehindQueue
+from config import BaseConfig
 from cryptoCompare.CryptoCompareIntegrationConfig import CryptoCompareConfig
 from krakenWebSocket.KrakenAlerts import KrakenTelegramAlerts, KrakenBaseAlerts
+from krakenWebSocket.KrakenAsyncSocketHandler import KrakenAsyncSocketHandler
 from krakenWebSocket.KrakenPersistors import KrakenPersistor
 from krakenWebSocket.KrakenTicketHandler import BaseKrakenTicketHandler
 
@@ -81,6 +87,9 @@ class KrakenSocketHandler(threading.Thread):
         self.alertHandler = KrakenTelegramAlerts()
         self._kill_thread: bool = False
         self.on_new_price_callback: Optional[callable] = None
+        # called with the pairs after subscribing again to them, so the trades missed while disconnected
+        # can be recovered. Blocks the socket until it returns
+        self.on_reconnect_callback: Optional[callable] = None
 
     def run(self) -> None:
         if self.pair is None or not isinstance(self.pair, list):
@@ -114,12 +123,17 @@ class KrakenSocketHandler(threading.Thread):
     def _manage_thread(self) -> None:
         self.reconnect_attempts_limit = 1 if self.reconnect_attempts_limit <= 0 else self.reconnect_attempts_limit
         self.reconnect_attempts = 0
+        has_connected = self.ws is not None
 
         while self.reconnect_attempts < self.reconnect_attempts_limit:
             if self.ws is None:
                 self.reconnect_attempts += 1
                 if self._create_connection():
                     self.reconnect_attempts = 0
+                    if has_connected and self.on_reconnect_callback is not None:
+                        self.on_reconnect_callback(self.pair)
+
+                    has_connected = True
 
             if self.ws is not None:
                 exception, string = self._manage_connection()
@@ -141,7 +155,7 @@ class KrakenSocketHandler(threading.Thread):
 
                 result = self.ws.recv()
                 response = result
-                result = json.loads(result)
+                result = loads(result)
 
                 if isinstance(result, list):
                     self.on_new_price_callback(result)
@@ -171,27 +185,75 @@ class KrakenSocketHandler(threading.Thread):
             return False
 
 
-def _ticket_list_to_dict(socket_trade: list) -> Dict[str, Union[float, str]]:
-    mapper = {
-        'XBT/USD': 'btc',
-        'ETH/USD': 'eth',
-        'BCH/USD': 'bch',
-        'LTC/USD': 'ltc'
-    }
+_BACKFILL_CHANNEL = 'backfill'  # channel of the messages that ask the writer thread to recover missed trades
+_TRADES_PAGE_SIZE = 1000  # trades returned by each request to the Trades endpoint of the rest api
 
-    trade_list = socket_trade[Constants.TRADE_LIST]
-    trade = {
-        'market': mapper[socket_trade[Constants.MARKET_INDEX]],
-        'timestamp': float(trade_list[-1][Constants.TIME_INDEX]),
-        'price': float(trade_list[-1][Constants.PRICE_INDEX])
-    }
 
+class _TradeCursor:
+    """
+    The newest trades processed of a market. The trades of the socket have no id, so besides their timestamp it
+    keeps the price and volume of the ones with that timestamp, and a different trade of the same second is
+    not mistaken for one already processed
+    """
+
+    def __init__(self):
+        self.timestamp: Optional[float] = None
+        self._seen: Set[Tuple[float, float]] = set()  # (price, volume) of the trades at timestamp
+
+    def is_new(self, trade: list) -> bool:
+        timestamp = float(trade[Constants.TIME_INDEX])
+        if self.timestamp is None or timestamp > self.timestamp:
+            return True
+
+        return timestamp == self.timestamp and _price_and_volume(trade) not in self._seen
+
+    def advance(self, trade: list) -> None:
+        timestamp = float(trade[Constants.TIME_INDEX])
+        if self.timestamp is None or timestamp > self.timestamp:
+            self.timestamp = timestamp
+            self._seen = set()
+
+        if timestamp == self.timestamp:
+            self._seen.add(_price_and_volume(trade))
+
+
+def _price_and_volume(trade: list) -> Tuple[float, float]:
+    return float(trade[Constants.PRICE_INDEX]), float(trade[Constants.VOLUME_INDEX])
+
+
+def _ticket_coalesce_key(ticket: list) -> Optional[Tuple[str, int]]:
+    """
+    Only the messages of the same pair and hour are merged, _ticket_list_to_dict summarizes a message into a
+    single trade at the time of its last one. None (never merged) for a message with trades of two hours
+    """
+    trade_list = ticket[Constants.TRADE_LIST]
+    first_hour = int(float(trade_list[0][Constants.TIME_INDEX]) // 3600)
+    last_hour = int(float(trade_list[-1][Constants.TIME_INDEX]) // 3600)
+    return (ticket[Constants.MARKET_INDEX], first_hour) if first_hour == last_hour else None
+
+
+def _coalesce_tickets(waiting: list, new: list) -> list:
+    """
+    Merges two trade messages of the same pair and hour into one with the trades of both, as kraken does when
+    many trades happen at the same time
+    """
+    merged = list(waiting)
+    merged[Constants.TRADE_LIST] = waiting[Constants.TRADE_LIST] + new[Constants.TRADE_LIST]
+    return merged
+
+
+def _ticket_list_to_dict(socket_trade: list) -> Dict[str, Union[float, str]]:
+    trade_list = socket_trade[Constants.TRADE_LIST]
     volume = 0
     for entry in trade_list:
         volume += float(entry[Constants.VOLUME_INDEX])
 
-    trade['volume'] = volume
-    return trade
+    return {
+        'market': _pair_to_market[socket_trade[Constants.MARKET_INDEX]],
+        'timestamp': float(trade_list[-1][Constants.TIME_INDEX]),
+        'price': float(trade_list[-1][Constants.PRICE_INDEX]),
+        'volume': volume
+    }
 
 
 _kraken_mapper = markets = {
@@ -221,10 +283,12 @@ _kraken_mapper = markets = {
     },
 }
 
+_pair_to_market = {market['subscription_pair']: key for key, market in _kraken_mapper.items()}
+
 
 class KrakenIntegration:
     def __init__(self, config, market_list=('btc',)):
-        self.requests = requests  # just to make it easier to test by making easier to inject a mock
+        self.requests = get_shared_session()  # just to make it easier to test by making easier to inject a mock
         # stores the timestamp on which a new hourly candle will be generated
         self.curr_close_timestamp: datetime.datetime = datetime.datetime.now() + datetime.timedelta(hours=1)
         self.curr_close_timestamp: datetime.datetime = self.curr_close_timestamp.replace(minute=0, second=0,
@@ -233,7 +297,19 @@ class KrakenIntegration:
         self.alert_sender: KrakenBaseAlerts = KrakenTelegramAlerts()
         self.websocket_handler = KrakenSocketHandler()
         self.ticket_handler: BaseKrakenTicketHandler = BaseKrakenTicketHandler()
+        # the tickets are processed (and the candles persisted) by a writer thread, so the socket thread only
+        # reads and parses the messages
+        self.ticket_queue = WriteBehindQueue(self._on_ticket,
+                                             maxsize=BaseConfig.Exchanges.Kraken.write_behind_size,
+                                             policy=BaseConfig.Exchanges.Kraken.write_behind_policy,
+                                             coalesce_key=_ticket_coalesce_key,
+                                             coalesce=_coalesce_tickets,
+                                             name='kraken-tickets')
         self.logger = logger
+        # the last trades processed of each market, and the last ones recovered from the rest api after a
+        # reconnection. Only used by the writer thread of the ticket queue
+        self._last_trades: Dict[str, _TradeCursor] = {}
+        self._backfilled: Dict[str, _TradeCursor] = {}
 
         if not isinstance(config, CryptoCompareConfig):
             raise TypeError('Parameter config must be a CryptoCompareConfig instance')
@@ -257,33 +333,152 @@ class KrakenIntegration:
         for _, market in self.market_list.items():
             pair.append(market['subscription_pair'])
 
-        self.websocket_handler.connect_on_this_thread(pair, self._on_ticket)
-        self.websocket_handler.join()
+        self.websocket_handler.on_reconnect_callback = self._request_backfill
+        self.ticket_queue.start()
+        try:
+            self.websocket_handler.connect_on_this_thread(pair, self.ticket_queue.put)
+        finally:
+            self.ticket_queue.stop()
+            self.logger.info('Ticket queue stopped. Metrics: {}'.format(self.ticket_queue.metrics))
+
+    async def subscribe_async(self, handler: Optional[KrakenAsyncSocketHandler] = None) -> None:
+        """
+        Same as subscribe, but with the asyncio socket handler, so it can run in an event loop with other
+        coroutines and be stopped at any time with handler.stop() or cancelling the task
+        """
+        handler = handler or KrakenAsyncSocketHandler()
+        self._get_open_price()
+
+        loop = asyncio.get_event_loop()
+
+        async def on_ticket(ticket: list) -> None:
+            # put may block waiting for room in the queue, which can not happen in the thread of the event loop
+            await loop.run_in_executor(None, self.ticket_queue.put, ticket)
+
+        async def on_reconnect(pairs: List[str]) -> None:
+            await loop.run_in_executor(None, self._request_backfill, pairs)
+
+        handler.subscribe([market['subscription_pair'] for market in self.market_list.values()], on_ticket)
+        handler.on_reconnect = on_reconnect
+
+        self.ticket_queue.start()
+        try:
+            await handler.run()
+        finally:
+            self.ticket_queue.stop()
+            self.logger.info('Ticket queue stopped. Metrics: {}'.format(self.ticket_queue.metrics))
+
+    def _request_backfill(self, pairs: List[str]) -> None:
+        """
+        Called by the socket handler after a reconnection. The trades missed while disconnected are recovered by
+        the writer thread of the ticket queue, after processing the ones received before the disconnection
+        """
+        for pair in pairs:
+            # as a barrier, the trades received after the reconnection are not coalesced into the waiting ones,
+            # so they are processed after the recovered trades
+            self.ticket_queue.put([None, [], _BACKFILL_CHANNEL, pair], barrier=True)
 
     def _on_ticket(self, ticket: list) -> None:
-        last_trade = _ticket_list_to_dict(ticket)
+        market = _pair_to_market[ticket[Constants.MARKET_INDEX]]
+        if ticket[Constants.CHANNEL_INDEX] == _BACKFILL_CHANNEL:
+            self._backfill(market)
+            return
+
+        trade_list = ticket[Constants.TRADE_LIST]
+        backfilled = self._backfilled.get(market)
+        if backfilled is not None:
+            # the rest api may have returned trades received by the socket after the reconnection too
+            trade_list = [trade for trade in trade_list if backfilled.is_new(trade)]
+            if len(trade_list) == 0:
+                return
 
+            ticket = list(ticket)
+            ticket[Constants.TRADE_LIST] = trade_list
+
+        last_trades = self._last_trades.setdefault(market, _TradeCursor())
+        for trade in trade_list:
+            last_trades.advance(trade)
+
+        last_trade = _ticket_list_to_dict(ticket)
         self.ticket_handler.on_new_ticket(last_trade)
         self.logger.info(last_trade)
 
+    def _backfill(self, market: str) -> None:
+        """
+        Passes the trades that happened after the last one processed to the ticket handler one by one, as the
+        socket would have, so they are merged into the candle in progress (or close it) before the trades
+        received after the reconnection. If they cannot be recovered, the error alert is sent, since the candle
+        in progress will be incomplete
+        """
+        last_trades = self._last_trades.get(market)
+        if last_trades is None:
+            # nothing was received before the disconnection, the candle was initialized with the rest api
+            return
+
+        try:
+            recovered = self._get_trades_since(market, last_trades.timestamp)
+        except Exception as e:
+            message = '{}: the trades missed while disconnected could not be recovered, the candle in progress ' \
+                      'is incomplete. {}'.format(market, repr(e))
+            self.logger.error(message)
+            self.alert_sender.send_error_alert('Kraken ' + message)
+            return
+
+        # filtered before advancing the cursors, so two equal trades of the same page are both kept
+        trades = [trade for trade in recovered if last_trades.is_new(trade)]
+        self.logger.info('{}: recovered {} trades missed while disconnected'.format(market, len(trades)))
+
+        pair = self.market_list[market]['subscription_pair']
+        backfilled = self._backfilled.setdefault(market, _TradeCursor())
+        for trade in trades:
+            last_trades.advance(trade)
+            backfilled.advance(trade)
+            self.ticket_handler.on_new_ticket(_ticket_list_to_dict([None, [trade], 'trade', pair]))
+
+    def _get_trades_since(self, market: str, since: float) -> List[list]:
+        api_url = 'https://api.kraken.com/0/public/Trades'
+        market_config = self.market_list[market]
+        trades = []
+
+        for _ in range(BaseConfig.Exchanges.Kraken.backfill_max_pages):
+            get_rate_limiter('Kraken').acquire()
+            r = self.requests.get(api_url, {'pair': market_config['ohlc_pair'], 'since': since})
+            if r.status_code != 200:
+                raise ConnectionError('could not recover trades from kraken rest api for pair {}'
+                                      .format(market_config['ohlc_pair']))
+
+            json_response = response_json(r)
+            page = json_response['result'][market_config['response_key']]
+            trades += page
+            if len(page) < _TRADES_PAGE_SIZE:
+                return trades
+
+            # the cursor of the next page, in nanoseconds
+            since = json_response['result']['last']
+
+        self.logger.warning('{}: more than {} pages of trades missed while disconnected. Only the first ones '
+                            'were recovered'.format(market, BaseConfig.Exchanges.Kraken.backfill_max_pages))
+        return trades
+
     def _get_open_price(self) -> Dict[str, Any]:
         api_url = 'https://api.kraken.com/0/public/OHLC'
 
         for _, market in self.market_list.items():
+            get_rate_limiter('Kraken').acquire()
             r = self.requests.get(api_url, {'pair': market['ohlc_pair'], 'interval': 60})
             if r.status_code != 200:
                 raise ConnectionError('could not recover open price from kraken rest api for pair {}'
                                       .format(market['ohlc_pair']))
 
-            json_response = json.loads(r.text)
+            json_response = response_json(r)
             last_entry = json_response['result'][market['response_key']][-1]
             market['open'] = last_entry[Constants.REST_OPEN_INDEX]
             market['high'] = last_entry[Constants.REST_HIGH_INDEX]
             market['low'] = last_entry[Constants.REST_LOW_INDEX]
             market['volume'] = last_entry[Constants.REST_VOLUME_INDEX]
 
-            self.ticket_handler.init_open_data(market['key'], market['open'], market['high'],
-                                               market['low'], market['volume'])
+            self.ticket_handler.init_open_data(market['key'], last_entry[Constants.REST_TIMESTAMP_INDEX],
+                                               market['open'], market['high'], market['low'], market['volume'])
 
         return self.market_list
 
@@ -295,6 +490,7 @@ class KrakenHistoricalDataIntegration(ForwardRecoverIntegration):
             persistor = KrakenPersistor()
 
         self.persistor: KrakenPersistor = persistor
+        self.rate_limiter = get_rate_limiter('Kraken')
         self.config = KrakenConfig()
         self._curr_market = 'btc'
         self.logger = logger
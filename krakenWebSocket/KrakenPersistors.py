@@ -1,55 +1,76 @@
 import os
-from typing import Optional, Dict, List, Union
+from typing import Dict, List, Union
 
-import pandas as pd
 import numpy as np
 
+from core.OhlcBinaryStore import OhlcBinaryStore, OHLC_RECORD_DTYPE
+
 
 class KrakenPersistor:
+    """
+    Stores the hourly ohlc recovered from kraken in a binary store per market, so the most recent timestamp,
+    which is asked on every request, is read without loading the stored history. A csv stored by a previous
+    version is converted to the binary store the first time it is used
+    """
+
     def __init__(self, market: str = 'btc', base_path: str = './'):
         self.market: str = market
         self.base_path: str = base_path
-        self.buffer_df: Optional[pd.DataFrame] = None
-        self.name_convention: str = 'kraken_{}_.csv'
+        self.name_convention: str = 'kraken_{}_.ohlc'
+        self.csv_name_convention: str = 'kraken_{}_.csv'
         self.timestamp_key: str = 'timestamp'
         self.default_first_timestamp = 1356998400
+        self.store: OhlcBinaryStore = OhlcBinaryStore(self._get_store_path())
+        self._is_migrated: bool = False
 
     def persist(self, new_data: List[Dict[str, Union[float, int]]]):
-        self._read_buffer()
-        df = pd.DataFrame(new_data, columns=self._get_columns_names())
-
-        last_timestamp = self.get_most_recent_timestamp()
-        df = df[df[self.timestamp_key] > last_timestamp]  # stores only the entries newer than last_timestamp
+        self._migrate_csv()
+        records = np.empty(len(new_data), dtype=OHLC_RECORD_DTYPE)
+        for column in self._get_columns_names():
+            records[column] = [entry[column] for entry in new_data]
 
-        self.buffer_df = self.buffer_df.append(df)
-        self.buffer_df.to_csv(self._get_csv_path())
+        # stores only the entries newer than the last stored one
+        self.store.append(records)
 
     def get_most_recent_timestamp(self) -> int:
-        self._read_buffer()
-        if self.buffer_df.size <= 0:
-            return self.default_first_timestamp
+        self._migrate_csv()
+        last = self.store.last_timestamp()
+        return last if last is not None else self.default_first_timestamp
 
-        return int(self.buffer_df[self.timestamp_key].values[-1])
+    def get_range(self, start: int = None, end: int = None) -> np.ndarray:
+        """
+        :return: read only view of the stored frames with timestamp in [start, end), backed by the file
+        """
+        self._migrate_csv()
+        return self.store.range(start, end)
 
     def clear_buffer(self) -> None:
-        del self.buffer_df
-        self.buffer_df = None
-
-    def _read_buffer(self) -> pd.DataFrame:
-        path = self._get_csv_path()
-        if self.buffer_df is None and os.path.isfile(path):
-            self.buffer_df = pd.read_csv(path)
-        elif self.buffer_df is not None:
-            return self.buffer_df
-        else:
-            # if file doesnt exists, creates an empty dataframe
-            arr = np.array([[], [], [], [], [], []]).transpose()  # 6 columns, no rows
-            self.buffer_df = pd.DataFrame(arr, columns=self._get_columns_names())
-
-        return self.buffer_df
+        self.store.close()
+
+    def _migrate_csv(self) -> None:
+        if self._is_migrated:
+            return
+
+        csv_path = self._get_csv_path()
+        if len(self.store) == 0 and os.path.isfile(csv_path):
+            import pandas as pd
+
+            # the csv of the previous versions was written with the pandas index as first column, which is
+            # ignored, and its timestamps may have been stored as floats
+            stored = pd.read_csv(csv_path)
+            records = np.empty(len(stored), dtype=OHLC_RECORD_DTYPE)
+            for column in self._get_columns_names():
+                records[column] = stored[column].to_numpy()
+
+            self.store.append(np.sort(records, order=self.timestamp_key, kind='stable'), fsync=True)
+
+        self._is_migrated = True
 
     def _get_columns_names(self) -> tuple:
         return self.timestamp_key, 'open', 'high', 'low', 'close', 'volume'
 
-    def _get_csv_path(self) -> str:
+    def _get_store_path(self) -> str:
         return os.path.join(self.base_path, self.name_convention.format(self.market))
+
+    def _get_csv_path(self) -> str:
+        return os.path.join(self.base_path, self.csv_name_convention.format(self.market))
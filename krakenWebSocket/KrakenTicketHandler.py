@@ -1,15 +1,32 @@
 import datetime
+import io
 import logging
 import os
-from typing import Optional, Dict, Union
+from collections import deque
+from typing import Optional, Dict, Union, Deque, List
 
+import numpy as np
 import pandas as pd
 
+from config import BaseConfig
+from core.CandleAggregator import CandleAggregator, HOUR
+from core.CsvFile import OHLC_CSV_HEADER, append_lines
+
 logger = logging.getLogger('FortacrypLogger')
 
+_COLUMNS = ('time', 'open', 'high', 'low', 'close', 'volumefrom')
+
 
 class KrakenHistoricalDataBase:
-    def __init__(self, market: str):
+    """
+    Keeps the candles of a market up to date with the tickets of the websocket. Only the last window_size
+    candles are kept in memory, and each new candle is appended to the csv as a single line, so neither the
+    memory nor the cost of storing a candle grows with the history. The candle in progress is built by a
+    CandleAggregator, so tickets that arrive up to grace_sec late are still merged into their hour
+    """
+
+    def __init__(self, market: str, window_size: int = BaseConfig.Exchanges.Kraken.websocket_window,
+                 grace_sec: float = BaseConfig.Exchanges.Kraken.candle_grace_sec):
         available_markets = ('btc', 'ltc', 'bch', 'eth')
         if market not in available_markets:
             raise KeyError('Market {} is not a valid market. Market list: {}'.format(market, available_markets))
@@ -17,33 +34,59 @@ class KrakenHistoricalDataBase:
         self.market = market
         self.base_path: str = './'
         self.csv_name: str = 'cryptoCompare_{}.csv'
-        self.data: Optional[pd.DataFrame] = None
-        self.open = None
-        self.high = None
-        self.low = None
-        self.volume = 0
-        self.has_open = False
+        self.window_size: int = window_size
+        self._rows: Optional[Deque[tuple]] = None  # rows of the window, in the order of _COLUMNS
+        self._unsaved: List[tuple] = []  # rows appended to the window but not to the csv yet
+        self._data: Optional[pd.DataFrame] = None
+        self.aggregator = CandleAggregator((HOUR,), grace_sec=grace_sec)
         self.logger = logger
 
+    @property
+    def data(self) -> Optional[pd.DataFrame]:
+        """
+        The candles of the window as a dataframe. It is built when requested and reused until a new candle
+        is appended
+        """
+        if self._data is None and self._rows is not None:
+            self._data = pd.DataFrame(list(self._rows), columns=_COLUMNS)
+
+        return self._data
+
+    @data.setter
+    def data(self, dataframe: Optional[pd.DataFrame]) -> None:
+        if dataframe is None:
+            self._rows = None
+        else:
+            rows = dataframe[list(_COLUMNS)].itertuples(index=False, name=None)
+            self._rows = deque(rows, maxlen=self.window_size)
+
+        self._data = None
+
     def load_data(self) -> None:
         path = self._get_save_path(self.market)
         if not os.path.isfile(path):
             raise FileNotFoundError('Historical data file {} does not exist'.format(path))
 
-        self.data = pd.read_csv(path)
+        with open(path) as file:
+            header = file.readline()
+
+        if header.strip() != OHLC_CSV_HEADER:
+            self._rewrite_with_header(path, header)
+
+        with open(path) as file:
+            header = file.readline()
+            # goes through the file once, but only the last lines are kept
+            lines = deque((line for line in file if line.strip() != ''), maxlen=self.window_size)
+
+        self.data = pd.read_csv(io.StringIO(header + ''.join(lines)))
+
+    def get_last_timestamp(self) -> float:
+        return float(self._rows[-1][0])
 
     def append(self, dict_data: Dict[str, Union[float, int]]) -> pd.DataFrame:
-        if not isinstance(self.data, pd.DataFrame):
+        if self._rows is None:
             raise TypeError('Attribute Data of KrakenHistoricalDataBase is not DataFrame type.')
 
-        ohlc = {
-            'open': [dict_data['open'], ],
-            'high': [dict_data['high'], ],
-            'low': [dict_data['low'], ],
-            'close': [dict_data['close'], ],
-            'volumefrom': [dict_data['volume'], ]
-        }
-
         last_timestamp = dict_data['last_timestamp_socket']
         now = int(datetime.datetime.now().replace(minute=0, second=0, microsecond=0).timestamp())
         if abs(now - last_timestamp) > 3600:
@@ -52,64 +95,80 @@ class KrakenHistoricalDataBase:
 
         last_timestamp = datetime.datetime.fromtimestamp(last_timestamp).replace(minute=0, second=0, microsecond=0)
         last_timestamp = int(last_timestamp.timestamp())
-        ohlc['time'] = [last_timestamp, ]
-        new_row = pd.DataFrame(ohlc)
-
-        dataframe = self.data
-        dataframe = dataframe.append(new_row, sort=False)
-        # reorders the columns
-        # https://stackoverflow.com/a/23741480
-        # dataframe = dataframe[['time', 'open', 'high', 'low', 'close', 'volumefrom']]
-
-        self.data = dataframe
-        return dataframe
+        self._append_row((last_timestamp, dict_data['open'], dict_data['high'], dict_data['low'], dict_data['close'],
+                          dict_data['volume']))
+        return self.data
 
     def append_ticket(self, ticket: Dict[str, float]):
-        if not isinstance(self.data, pd.DataFrame):
+        if self._rows is None:
             raise TypeError('Attribute Data of KrakenHistoricalDataBase is not DataFrame type.')
 
-        if self._should_apped_new(ticket['timestamp']):
-            self._insert_new_ohlc(ticket)
-        else:
-            if not self.has_open:
-                self._reinit_state_on_opening_price(ticket)
-            else:
-                self._update_on_new_price(ticket)
+        late_trades = self.aggregator.late_trades[HOUR]
+        self.aggregator.add(ticket['timestamp'], ticket['price'], ticket['volume'])
+        if self.aggregator.late_trades[HOUR] > late_trades:
+            self.logger.warning('Discarding a ticket of an hour already stored: {}'.format(ticket))
+
+        for candle in self.aggregator.pop_closed(HOUR):
+            self._insert_new_ohlc(candle)
+
+    def init_candle(self, date: float, open_price: float, high: float, low: float, volume: float) -> None:
+        """
+        Starts the candle of an hour with the part of it that happened before subscribing to the socket
+        :param date: start of the hour of the candle, as returned by the rest api
+        """
+        self.aggregator.add_candle(HOUR, date, open_price, high, low, open_price, volume)
 
     def persist(self):
-        self.logger.info('Persisting dataframe to csv. With tail')
-        self.logger.info(self.data.tail())
-        self.data.to_csv(self._get_save_path(self.market))
-
-    def _should_apped_new(self, timestamp) -> bool:
-        last_stored = float(self.data['time'].values[-1])
-        return timestamp - last_stored > 3600
-
-    def _insert_new_ohlc(self, ticket: Dict[str, float]) -> None:
-        new_candle = {
-            'open': self.open,
-            'high': self.high,
-            'close': ticket['price'],
-            'low': self.low,
-            'volume': self.volume
-        }
-        self.logger.info('New OHLC: {}'.format(new_candle))
-        self.append(new_candle)
-        self.has_open = False
+        """
+        Appends the candles that are not stored yet at the end of the csv, waiting until they are on disk
+        """
+        if len(self._unsaved) == 0:
+            return
+
+        lines = [','.join(str(value) for value in row) for row in self._unsaved]
+        self.logger.info('Persisting new candles to csv: {}'.format(lines))
+
+        path = self._get_save_path(self.market)
+        if not os.path.isfile(path):
+            lines.insert(0, OHLC_CSV_HEADER)
+
+        append_lines(lines, path, fsync=True)
+        self._unsaved = []
+
+    def _insert_new_ohlc(self, candle: np.void) -> None:
+        if candle['date'] <= self.get_last_timestamp():
+            self.logger.info('Candle of {} is already stored'.format(candle['date']))
+            return
+
+        # unlike append, there is no check against the current time: the aggregator closes a candle with the
+        # first trade after it, which may come hours later (after hours without trades, or a long backfill)
+        row = (int(candle['date']), float(candle['open']), float(candle['high']), float(candle['low']),
+               float(candle['close']), float(candle['volume']))
+        self.logger.info('New OHLC: {}'.format(row))
+        self._append_row(row)
         self.persist()
 
-    def _reinit_state_on_opening_price(self, ticket: Dict[str, float]) -> None:
-        self.logger.info('New Opening price: {}'.format(ticket['price']))
-        self.has_open = True
-        self.open = ticket['price']
-        self.high = self.open
-        self.low = self.open
-        self.volume = 0
+    def _append_row(self, row: tuple) -> None:
+        self._rows.append(row)
+        self._unsaved.append(row)
+        self._data = None
+
+    def _rewrite_with_header(self, path: str, first_line: str) -> None:
+        # previous versions stored the file with the index of the dataframe as first column, so new lines
+        # would not match its columns. It is rewritten only once
+        self.logger.info('Rewriting {} with the header {}'.format(path, OHLC_CSV_HEADER))
+        if set(_COLUMNS).issubset(first_line.strip().split(',')):
+            dataframe = pd.read_csv(path)
+        else:
+            # no header, the columns are the ones of _COLUMNS, maybe after the index
+            dataframe = pd.read_csv(path, header=None)
+            if len(dataframe.columns) < len(_COLUMNS):
+                raise ValueError('{} has no header and less columns than {}'.format(path, OHLC_CSV_HEADER))
+
+            dataframe = dataframe.iloc[:, -len(_COLUMNS):]
+            dataframe.columns = _COLUMNS
 
-    def _update_on_new_price(self, ticket: Dict[str, float]) -> None:
-        self.high = ticket['price'] if ticket['price'] > self.high else self.high
-        self.low = ticket['price'] if ticket['price'] < self.low else self.low
-        self.volume += ticket['volume']
+        dataframe[list(_COLUMNS)].to_csv(path, index=False)
 
     def _get_save_path(self, market):
         return os.path.join(self.base_path, self.csv_name.format(market))
@@ -121,18 +180,18 @@ class BaseKrakenTicketHandler:
         self.market_data: Dict[str, KrakenHistoricalDataBase] = {}
         self.logger = logger
 
-    def init_open_data(self, market, open_price, high, low, volume):
+    def init_open_data(self, market, timestamp, open_price, high, low, volume):
+        """
+        :param timestamp: start of the hour of the candle in progress, as returned by the OHLC endpoint
+        """
         self._verify_market(market)
-        self.market_data[market].open = float(open_price)
-        self.market_data[market].high = float(high)
-        self.market_data[market].low = float(low)
-        self.market_data[market].volume = float(volume)
-        self.market_data[market].has_open = True
+        self.market_data[market].init_candle(float(timestamp), float(open_price), float(high), float(low),
+                                             float(volume))
         self.logger.info('Price init for market: {}. Open:'
                          ' {} Low: {} High: {} Volume: {}'.format(market, open_price, low, high, volume))
 
         now = int(datetime.datetime.now().timestamp())
-        last_timestamp = int(self.market_data[market].data['time'].values[-1])
+        last_timestamp = int(self.market_data[market].get_last_timestamp())
 
         if now - last_timestamp > 3600:
             raise ValueError('{}: Has not the updated data. Updated data is data with less than 3600 seconds'
@@ -1,6 +1,11 @@
+import asyncio
 import datetime
 import json
 import logging
+import os
+import tempfile
+import threading
+import time
 from unittest import TestCase, mock
 
 import numpy as np
@@ -8,8 +13,10 @@ import pandas as pd
 
 from core.config import root_config_from_dict
 from core.configCore import _config
+from krakenWebSocket.KrakenAsyncSocketHandler import KrakenAsyncSocketHandler
 from krakenWebSocket.KrakenIntegration import KrakenIntegration, KrakenSocketHandler, \
     _ticket_list_to_dict
+from krakenWebSocket.KrakenPersistors import KrakenPersistor
 from krakenWebSocket.KrakenTicketHandler import KrakenHistoricalDataBase
 
 df = pd.DataFrame(data=np.arange(12).reshape(2, 6),
@@ -51,12 +58,12 @@ class KrakenHistoricalDataTests(TestCase):
         last_datetime = last_datetime.replace(minute=0, second=0, microsecond=0).timestamp()
         last_row = appended.tail(1)
 
-        self.assertEqual(last_row['time'][0], int(last_datetime))
-        self.assertEqual(float(last_row['close'][0]), float(self.new_data['close']))
-        self.assertEqual(float(last_row['open'][0]), float(self.new_data['open']))
-        self.assertEqual(float(last_row['high'][0]), float(self.new_data['high']))
-        self.assertEqual(float(last_row['low'][0]), float(self.new_data['low']))
-        self.assertEqual(float(last_row['volumefrom'][0]), float(self.new_data['volume']))
+        self.assertEqual(last_row['time'].iloc[0], int(last_datetime))
+        self.assertEqual(float(last_row['close'].iloc[0]), float(self.new_data['close']))
+        self.assertEqual(float(last_row['open'].iloc[0]), float(self.new_data['open']))
+        self.assertEqual(float(last_row['high'].iloc[0]), float(self.new_data['high']))
+        self.assertEqual(float(last_row['low'].iloc[0]), float(self.new_data['low']))
+        self.assertEqual(float(last_row['volumefrom'].iloc[0]), float(self.new_data['volume']))
 
     def test_merge_fail_timestamp_diff(self):
         kraken = KrakenHistoricalDataBase('btc')
@@ -75,6 +82,122 @@ class KrakenHistoricalDataTests(TestCase):
             kraken.append(self.new_data)
 
 
+class KrakenHistoricalDataStreamingTests(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'cryptoCompare_btc.csv')
+        self.now = int(datetime.datetime.now().replace(minute=0, second=0, microsecond=0).timestamp())
+
+        lines = ['time,open,high,low,close,volumefrom']
+        lines += ['{},1,2,0.5,1.5,10'.format(self.now - 3600 * i) for i in range(10, 0, -1)]
+        with open(self.path, 'w') as file:
+            file.write('\n'.join(lines))
+
+        self.kraken = KrakenHistoricalDataBase('btc', window_size=4, grace_sec=5)
+        self.kraken.base_path = self.tmp_dir.name
+        self.kraken.load_data()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_keeps_only_the_window(self):
+        self.assertEqual(4, len(self.kraken.data))
+        self.assertEqual(self.now - 3600, self.kraken.get_last_timestamp())
+
+    def test_load_rewrites_a_file_without_header(self):
+        with open(self.path) as file:
+            lines = file.read().split('\n')[1:]
+
+        # without header, with and without the index of the dataframe as first column
+        for rows in (lines, ['{},{}'.format(i, line) for i, line in enumerate(lines)]):
+            with open(self.path, 'w') as file:
+                file.write('\n'.join(rows))
+
+            self.kraken.load_data()
+            self.assertEqual(4, len(self.kraken.data))
+            self.assertEqual(self.now - 3600, self.kraken.get_last_timestamp())
+            self.assertEqual(['time', 'open', 'high', 'low', 'close', 'volumefrom'],
+                             list(pd.read_csv(self.path).columns))
+
+    def test_persist_appends_the_new_candle(self):
+        self.kraken.append({'open': 1, 'high': 3, 'low': 1, 'close': 2, 'volume': 5,
+                            'last_timestamp_socket': self.now + 10})
+        self.kraken.persist()
+
+        stored = pd.read_csv(self.path)
+        self.assertEqual(['time', 'open', 'high', 'low', 'close', 'volumefrom'], list(stored.columns))
+        self.assertEqual(11, len(stored))
+        self.assertEqual([self.now, 1, 3, 1, 2, 5], stored.iloc[-1].tolist())
+        self.assertEqual(4, len(self.kraken.data))
+
+    def test_append_ticket_stores_the_hour_once_closed(self):
+        for timestamp, price in ((10, 2), (30, 3), (5, 1), (3603, 4), (20, 5), (3620, 6), (15, 7)):
+            self.kraken.append_ticket({'market': 'btc', 'timestamp': self.now + timestamp, 'price': price,
+                                       'volume': 1})
+
+        # the ticket at 20 was within the grace of 5 seconds, the one at 15 was not
+        stored = pd.read_csv(self.path)
+        self.assertEqual(11, len(stored))
+        self.assertEqual([self.now, 1, 5, 1, 3, 4], stored.iloc[-1].tolist())
+        self.assertEqual(1, self.kraken.aggregator.late_trades[3600])
+
+    def test_candle_closed_hours_later_is_stored(self):
+        lines = ['time,open,high,low,close,volumefrom']
+        lines += ['{},1,2,0.5,1.5,10'.format(self.now - 3600 * i) for i in range(10, 2, -1)]
+        with open(self.path, 'w') as file:
+            file.write('\n'.join(lines))
+
+        self.kraken.load_data()
+        # a trade two hours ago, and the next one now after a quiet hour: the candle is closed more than an
+        # hour after it started
+        self.kraken.append_ticket({'market': 'btc', 'timestamp': self.now - 7200 + 10, 'price': 2, 'volume': 1})
+        self.kraken.append_ticket({'market': 'btc', 'timestamp': self.now + 10, 'price': 3, 'volume': 1})
+
+        stored = pd.read_csv(self.path)
+        self.assertEqual(9, len(stored))
+        self.assertEqual([self.now - 7200, 2, 2, 2, 2, 1], stored.iloc[-1].tolist())
+
+    def test_init_candle_at_the_hour_of_the_rest_entry(self):
+        # the hour of the rest entry, not the one of the clock of this machine
+        self.kraken.init_candle(self.now + 3600, 10, 12, 9, 5)
+        self.kraken.append_ticket({'market': 'btc', 'timestamp': self.now + 3600 + 10, 'price': 11, 'volume': 1})
+
+        self.assertEqual((self.now + 3600, 10, 12, 9, 11, 6), self.kraken.aggregator.current())
+
+
+class KrakenPersistorTests(TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.csv_path = os.path.join(self.tmp_dir.name, 'kraken_btc_.csv')
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_migrate_csv_to_binary_store(self):
+        with open(self.csv_path, 'w') as file:
+            file.write('timestamp,open,high,low,close,volume\n1546300800,1,2,0.5,1.5,10\n1546304400,2,3,1,2.5,20')
+
+        persistor = KrakenPersistor('btc', self.tmp_dir.name)
+        self.assertEqual(1546304400, persistor.get_most_recent_timestamp())
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir.name, 'kraken_btc_.ohlc')))
+
+        persistor.persist([{'timestamp': 1546308000, 'open': 3, 'high': 4, 'low': 2, 'close': 3.5, 'volume': 30}])
+        records = KrakenPersistor('btc', self.tmp_dir.name).get_range()
+        self.assertEqual([1546300800, 1546304400, 1546308000], list(records['timestamp']))
+        self.assertEqual([10, 20, 30], list(records['volume']))
+
+    def test_migrate_csv_with_pandas_index(self):
+        # the previous versions wrote the csv with DataFrame.to_csv, index included and timestamps as floats
+        stored = pd.DataFrame({'timestamp': [1546300800.0, 1546304400.0], 'open': [1, 2], 'high': [2, 3],
+                               'low': [0.5, 1], 'close': [1.5, 2.5], 'volume': [10, 20]}, index=[5, 3])
+        stored.to_csv(self.csv_path)
+
+        records = KrakenPersistor('btc', self.tmp_dir.name).get_range()
+        self.assertEqual([1546300800, 1546304400], list(records['timestamp']))
+        self.assertEqual([1, 2], list(records['open']))
+        self.assertEqual([1.5, 2.5], list(records['close']))
+
+
 class DummyWebScocket:
     def __init__(self):
         self.initial_timestamp = 1534614057.321597
@@ -173,6 +296,27 @@ class DummyRequests:
         return response
 
 
+class DummyTradesRequests:
+    """
+    Answers each request to the Trades endpoint with the next page
+    """
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.params = []
+
+    def get(self, url, params):
+        self.params.append(params)
+        response = DummyResponse()
+        response.text = json.dumps({'error': [], 'result': {'XXBTZUSD': self.pages.pop(0), 'last': '1'}})
+        return response
+
+
+def _trade_message(*trades):
+    return [0, [[str(price), str(volume), str(timestamp), 'b', 'l', ''] for price, volume, timestamp in trades],
+            'trade', 'XBT/USD']
+
+
 @mock.patch('builtins.open', m)
 class KrakenIntegrationTest(TestCase):
     def setUp(self) -> None:
@@ -230,6 +374,105 @@ class KrakenIntegrationTest(TestCase):
             self.assertEqual(result, expected)
 
 
+class KrakenBackfillTests(TestCase):
+    def setUp(self) -> None:
+        market = {'subscription_pair': 'XBT/USD', 'ohlc_pair': 'XBTUSD', 'response_key': 'XXBTZUSD', 'key': 'btc',
+                  'completed': True}
+        with mock.patch('krakenWebSocket.KrakenIntegration.KrakenConfig', return_value=mock.Mock(btc=market)):
+            self.kraken = KrakenIntegration(root_config_from_dict(_config).crypto_compare)
+
+        self.kraken.logger = logger
+
+    def test_backfill_after_reconnect(self):
+        self.kraken.ticket_handler = mock.Mock()
+        self.kraken.requests = DummyTradesRequests([
+            [['99.0', '1.0', 100.5, 'b', 'l', '', 1], ['102.0', '2.0', 102.0, 's', 'l', '', 2],
+             ['103.0', '3.0', 103.0, 'b', 'l', '', 3]]
+        ])
+
+        self.kraken._on_ticket(_trade_message((100, 1, 100), (101, 1, 101)))
+        self.kraken._request_backfill(['XBT/USD'])
+        self.kraken._on_ticket(self.kraken.ticket_queue._items[0][1])
+        # the trade at 103 was recovered by the rest api too, only the one at 104 is new
+        self.kraken._on_ticket(_trade_message((103, 3, 103), (104, 4, 104)))
+
+        tickets = [call[0][0] for call in self.kraken.ticket_handler.on_new_ticket.call_args_list]
+        self.assertEqual([101, 102, 103, 104], [ticket['timestamp'] for ticket in tickets])
+        self.assertEqual([2, 2, 3, 4], [ticket['volume'] for ticket in tickets])
+        self.assertEqual([{'pair': 'XBTUSD', 'since': 101}], self.kraken.requests.params)
+
+    def test_backfill_keeps_other_trades_of_the_same_second(self):
+        self.kraken.ticket_handler = mock.Mock()
+        self.kraken.requests = DummyTradesRequests([
+            [['101.0', '1.0', 101.0, 'b', 'l', '', 1], ['102.0', '2.0', 101.0, 's', 'l', '', 2],
+             ['103.0', '3.0', 103.0, 'b', 'l', '', 3]]
+        ])
+
+        self.kraken._on_ticket(_trade_message((101, 1, 101)))
+        self.kraken._request_backfill(['XBT/USD'])
+        self.kraken._on_ticket(self.kraken.ticket_queue._items[0][1])
+        # the first trade at 103 was recovered already, the second one is a different trade of the same second
+        self.kraken._on_ticket(_trade_message((103, 3, 103), (104, 4, 103)))
+
+        tickets = [call[0][0] for call in self.kraken.ticket_handler.on_new_ticket.call_args_list]
+        self.assertEqual([(101, 1), (101, 2), (103, 3), (103, 4)],
+                         [(ticket['timestamp'], ticket['volume']) for ticket in tickets])
+
+    def test_alert_if_backfill_fails(self):
+        self.kraken.ticket_handler = mock.Mock()
+        self.kraken.alert_sender = mock.Mock()
+        self.kraken.requests = mock.Mock()
+        self.kraken.requests.get.return_value = DummyResponse()
+        self.kraken.requests.get.return_value.status_code = 500
+
+        self.kraken._on_ticket(_trade_message((101, 1, 101)))
+        self.kraken._request_backfill(['XBT/USD'])
+        self.kraken._on_ticket(self.kraken.ticket_queue._items[0][1])
+
+        self.kraken.alert_sender.send_error_alert.assert_called_once()
+        self.assertEqual(1, self.kraken.ticket_handler.on_new_ticket.call_count)
+
+
+class KrakenTicketQueueTests(TestCase):
+    def setUp(self) -> None:
+        market = {'subscription_pair': 'XBT/USD', 'ohlc_pair': 'XBTUSD', 'response_key': 'XXBTZUSD', 'key': 'btc',
+                  'completed': True}
+        with mock.patch('krakenWebSocket.KrakenIntegration.KrakenConfig', return_value=mock.Mock(btc=market)):
+            self.kraken = KrakenIntegration(root_config_from_dict(_config).crypto_compare)
+
+        self.kraken.logger = logger
+        self.release = threading.Event()
+        self.tickets = []
+
+    def slow_handler(self, ticket):
+        self.release.wait(5)
+        self.tickets.append(ticket)
+
+    def test_slow_consumer_doesnt_merge_trades_of_different_hours(self):
+        self.kraken.ticket_handler = mock.Mock()
+        self.kraken.ticket_handler.on_new_ticket.side_effect = self.slow_handler
+        queue = self.kraken.ticket_queue
+        queue.maxsize = 2
+        queue.start()
+
+        queue.put(_trade_message((100, 1, 3590)))
+        while queue.metrics.depth > 0:
+            time.sleep(0.001)
+
+        queue.put(_trade_message((101, 1, 3595)))
+        queue.put(_trade_message((102, 1, 3598)))
+        # the queue is full, merged into the previous message of the same hour
+        queue.put(_trade_message((103, 1, 3599)))
+        # the next hour is not merged, it waits until there is room
+        threading.Timer(0.05, self.release.set).start()
+        queue.put(_trade_message((104, 1, 3601)))
+        queue.stop()
+
+        self.assertEqual([(3590, 1), (3595, 1), (3599, 2), (3601, 1)],
+                         [(ticket['timestamp'], ticket['volume']) for ticket in self.tickets])
+        self.assertEqual(1, queue.metrics.coalesced)
+
+
 class KrakenAlertDummy:
     def __init__(self):
         self.error_call_count = 0
@@ -310,6 +553,129 @@ class KrakenSocketHandlerTests(TestCase):
         self.callback_count += 1
 
 
+class DummyAsyncWebSocket:
+    """
+    Answers the messages queued in responses, then waits forever (or fails, if fail_when_empty is set).
+    Answers a ping with a pong if answer_pings is set
+    """
+
+    def __init__(self, responses=(), answer_pings=True, fail_when_empty=False):
+        self.responses = asyncio.Queue()
+        for response in responses:
+            self.responses.put_nowait(json.dumps(response))
+
+        self.answer_pings = answer_pings
+        self.fail_when_empty = fail_when_empty
+        self.sent = []
+        self.closed = False
+
+    async def send(self, message):
+        self.sent.append(json.loads(message))
+        if self.answer_pings and self.sent[-1] == {'event': 'ping'}:
+            await self.responses.put(json.dumps({'event': 'pong'}))
+
+    async def recv(self):
+        if self.fail_when_empty and self.responses.empty():
+            raise ConnectionError('Dummy Exception')
+
+        return await self.responses.get()
+
+    async def close(self):
+        self.closed = True
+
+
+class KrakenAsyncSocketHandlerTests(TestCase):
+    def setUp(self) -> None:
+        self.sockets = []
+        self.responses = []
+        self.received = []
+        self.answer_pings = True
+        self.fail_when_empty = False
+        self.handler = KrakenAsyncSocketHandler(pairs_per_connection=2, ping_interval=0.05, pong_timeout=0.05,
+                                                connect=self._connect)
+        self.handler.alert_handler = KrakenAlertDummy()
+        self.handler.backoff_base_sec = 0
+        self.handler.logger = logger
+
+    def test_fan_out_to_the_consumers_of_each_channel_and_pair(self):
+        self.handler.subscribe(['XBT/USD', 'ETH/USD'], self._on_message)
+        self.handler.subscribe(['XBT/USD'], self._on_message, channel='book')
+        self.responses = [[{'event': 'heartbeat'}, [0, [], 'trade', 'XBT/USD'], [1, [], 'trade', 'ETH/USD']],
+                          [[2, {}, 'book-10', 'XBT/USD'], [3, [], 'trade', 'LTC/USD']]]
+
+        asyncio.run(self._run_until(3))
+
+        self.assertEqual(2, len(self.sockets))
+        self.assertEqual([{'event': 'subscribe', 'pair': ['XBT/USD', 'ETH/USD'], 'subscription': {'name': 'trade'}}],
+                         self.sockets[0].sent)
+        self.assertEqual([{'event': 'subscribe', 'pair': ['XBT/USD'], 'subscription': {'name': 'book'}}],
+                         self.sockets[1].sent)
+        # the order is kept within a connection, not between them
+        self.assertEqual({('trade', 'XBT/USD'), ('trade', 'ETH/USD'), ('book-10', 'XBT/USD')},
+                         {(m[-2], m[-1]) for m in self.received})
+        self.assertTrue(all(ws.closed for ws in self.sockets))
+
+    def test_stop_without_waiting_for_a_message(self):
+        self.handler.subscribe(['XBT/USD'], self._on_message)
+
+        async def run():
+            task = asyncio.ensure_future(self.handler.run())
+            await asyncio.sleep(0.01)
+            self.handler.stop()
+            await asyncio.wait_for(task, 1)
+
+        asyncio.run(run())
+        self.assertEqual([], self.received)
+        self.assertTrue(self.sockets[0].closed)
+
+    def test_ping_on_silence_and_reconnect_without_pong(self):
+        self.handler.subscribe(['XBT/USD'], self._on_message)
+        self.answer_pings = False
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(self.handler.run())
+
+        self.assertEqual(3, len(self.sockets))
+        self.assertEqual({'event': 'ping'}, self.sockets[0].sent[-1])
+        self.assertEqual(1, self.handler.alert_handler.error_call_count)
+
+    def test_reconnect_resets_the_attempts_after_a_message(self):
+        self.handler.subscribe(['XBT/USD'], self._on_message)
+        self.responses = [[[0, [], 'trade', 'XBT/USD']]] * 4
+        self.fail_when_empty = True
+        self.reconnected = []
+
+        async def on_reconnect(pairs):
+            self.reconnected.append(pairs)
+
+        self.handler.on_reconnect = on_reconnect
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(self.handler.run())
+
+        # 4 connections that received a message, and the 2 more of the limit of attempts
+        self.assertEqual(6, len(self.sockets))
+        self.assertEqual(4, len(self.received))
+        self.assertEqual([['XBT/USD']] * 5, self.reconnected)
+
+    async def _connect(self, url):
+        responses = self.responses[len(self.sockets)] if len(self.sockets) < len(self.responses) else []
+        ws = DummyAsyncWebSocket(responses, self.answer_pings, self.fail_when_empty)
+        self.sockets.append(ws)
+        return ws
+
+    async def _run_until(self, messages):
+        task = asyncio.ensure_future(self.handler.run())
+        while len(self.received) < messages:
+            await asyncio.sleep(0.01)
+
+        self.handler.stop()
+        await task
+
+    async def _on_message(self, message):
+        self.received.append(message)
+
+
 class KrakenDataBaseTest(TestCase):
     def setUp(self) -> None:
         array = np.asarray([[1561485600, 1561489200, 1561492800],